@@ -0,0 +1,346 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import types
+
+import numpy as np
+
+from common.audioconfig import SAMPLE_RATE, BUFFER_SIZE
+
+# config.py needs the machine's environment.py, which isn't in the repo (see
+# config.py). Without one, the benchmarks get the default calibration, as the
+# tests do (see tests/conftest.py).
+try:
+    import environment
+except ImportError:
+    environment = types.ModuleType("environment")
+    environment.ENVIRONMENT = "benchmark"
+    sys.modules["environment"] = environment
+
+# Microbenchmarks for the hot paths of the audio and the game rules. None of
+# them need audio hardware or a window. Each benchmark is run at a few sizes,
+# and timed per call of what it benchmarks (best and median of a few repeats).
+# Benchmarks whose modules can't be imported (ie, without aubio) are skipped.
+#
+# Run them all with:
+#   python benchmark.py
+# Options: --only <name prefix>, --repeat <n>, --json <file> to write the
+# results there, and --baseline <file> to compare against results written
+# before. Slowdowns beyond --threshold (a fraction, default 0.1) are reported,
+# and make the exit status 1, and so do results of the baseline that are
+# missing now (ie, skipped here but not there).
+
+MIN_MEASURE_TIME = 0.05 # seconds each measurement runs for, at least
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.1
+
+BUFFER_FRAMES = BUFFER_SIZE
+BENCH_WAVE = "data/basic_world/level0/background.wav"
+PITCHES_PER_BEAT = 15 # about how often the mic delivers a pitch during a beat
+
+# (name, sizes, setup). setup(size) does everything that isn't timed, and
+# returns the function to time.
+BENCHMARKS = []
+
+def benchmark(name, sizes):
+    def register(setup):
+        BENCHMARKS.append((name, sizes, setup))
+        return setup
+    return register
+
+
+@benchmark("mixer.generate", [1, 8, 32, 128])
+def bench_mixer(num_generators):
+    from common.mixer import Mixer
+    from common.note import NoteGenerator
+
+    mixer = Mixer()
+    for i in range(num_generators):
+        mixer.add(NoteGenerator(48 + i % 36, 0.1))
+    return lambda: mixer.generate(BUFFER_FRAMES, 2)
+
+
+@benchmark("note.generate", ["sine", "square", "sawtooth", "triangle"])
+def bench_note(timbre):
+    from common.note import NoteGenerator, Envelope
+
+    # long enough to never end
+    env = Envelope(NoteGenerator(60, 0.5, timbre=timbre), 0.02, 1, 3600, 1)
+    return lambda: env.generate(BUFFER_FRAMES, 2)
+
+
+@benchmark("wavegen.generate", ["file", "buffer"])
+def bench_wavegen(source):
+    from common.wavegen import WaveGenerator
+    from common.wavesrc import WaveFile, WaveBuffer
+
+    if source == "file":
+        wave = WaveFile(BENCH_WAVE)
+    else:
+        wave = WaveBuffer(BENCH_WAVE, 0, WaveFile(BENCH_WAVE).end)
+    gen = WaveGenerator(wave, loop=True)
+    return lambda: gen.generate(BUFFER_FRAMES, 2)
+
+
+# a scheduler with num_pending commands that never come due
+def pending_scheduler(num_pending):
+    from common.clock import AudioScheduler, SimpleTempoMap, kTicksPerQuarter
+
+    sched = AudioScheduler(SimpleTempoMap(120))
+    far = kTicksPerQuarter * 10 ** 6
+    for i in range(num_pending):
+        sched.post_at_tick(lambda tick, arg: None, far + i, deferred=i % 2 == 0)
+    return sched, far
+
+@benchmark("sched.post_at_tick", [10, 100, 1000])
+def bench_sched_post(num_pending):
+    sched, far = pending_scheduler(num_pending)
+
+    # post a command and take it back, so the number pending stays the same
+    def post():
+        sched.remove(sched.post_at_tick(lambda tick, arg: None, far // 2))
+    return post
+
+@benchmark("sched.generate", [10, 100, 1000])
+def bench_sched_generate(num_pending):
+    sched, far = pending_scheduler(num_pending)
+    return lambda: sched.generate(BUFFER_FRAMES, 2)
+
+
+@benchmark("pitch_detector.write", [256, 512, 1024])
+def bench_pitch_detector(num_frames):
+    from pitch_detector import PitchDetector
+
+    detector = PitchDetector()
+    t = np.arange(num_frames) / float(SAMPLE_RATE)
+    signal = (0.5 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    return lambda: detector.write(signal)
+
+
+# a beat's worth of pitches, as the voice controller gets them (see PitchController)
+@benchmark("pitch.add_pitch", ["steady", "noisy"])
+def bench_add_pitch(kind):
+    from music_controller import PitchController
+
+    controller = PitchController()
+    controller.music.set_tempo(120)
+    if kind == "steady":
+        pitches = [60.2] * PITCHES_PER_BEAT
+    else:
+        pitches = list(np.random.RandomState(0).choice([0, 60, 62, 64, 65, 67], PITCHES_PER_BEAT))
+
+    def beat():
+        for midi in pitches:
+            controller.receive_pitch(midi)
+        controller.get_music()
+    return beat
+
+
+# stands on the map. Like EnemyState, it's passable unless pacified.
+class Enemy(object):
+    def __init__(self, pacified):
+        self.pacified = pacified
+
+    def is_passable(self):
+        return not self.pacified
+
+# the level2 map with num_enemies Enemy on it, every other one pacified.
+# Returns the map and the enemies. The tests use it too (see tests/test_map_state.py).
+def crowded_map(num_enemies, seed = 0):
+    from simulation import MapState
+
+    map = MapState.from_file("data/basic_world/level2/advanced_map.txt")
+    free = np.argwhere(map.passable_mask)
+    squares = free[np.random.RandomState(seed).choice(len(free), num_enemies)]
+
+    enemies = []
+    map.start_new_timestep()
+    for i, square in enumerate(squares):
+        enemies.append(Enemy(i % 2 == 0))
+        map.add_enemy(tuple(square), enemies[-1])
+    return map, enemies
+
+@benchmark("map.is_square_passable", [0, 16, 256])
+def bench_is_square_passable(num_enemies):
+    map, enemies = crowded_map(num_enemies)
+    squares = [tuple(square) for square in np.argwhere(map.passable_mask)]
+    state = {"i": 0}
+
+    def check():
+        state["i"] = (state["i"] + 1) % len(squares)
+        map.is_square_passable(squares[state["i"]])
+    return check
+
+# the vectorized version, as projectiles use it, for 256 squares at once
+@benchmark("map.passable", [0, 16, 256])
+def bench_passable(num_enemies):
+    map, enemies = crowded_map(num_enemies)
+    free = np.argwhere(map.passable_mask)
+    squares = free[np.random.RandomState(1).choice(len(free), 256)]
+    return lambda: map.passable(squares)
+
+
+# an enemy group of num_enemies on an open map, with the player in the middle
+# of it. Enemies walk back and forth and shoot in all directions.
+def big_group(num_enemies):
+    from simulation import MapState, ProjectileSystem, EnemyGroupState
+
+    per_row = int(np.ceil(np.sqrt(num_enemies)))
+    side = per_row * 3 + 4
+    rows = ["w" * side] + ["w" + " " * (side - 2) + "w" for _ in range(side - 2)] + ["w" * side]
+    middle = side // 2
+    rows[middle] = rows[middle][:middle] + "p" + rows[middle][middle + 1:]
+    map = MapState.from_rows(rows)
+
+    enemies = []
+    for i in range(num_enemies):
+        enemies.append({"id": i, "init_pos": [2 + 3 * (i // per_row), 2 + 3 * (i % per_row)],
+                        "motions": [[0, 1], [0, -1]], "attacks": ["u", "", "r", "", "d", "", "l", ""],
+                        "p_attacks": ["", "", "", "u", "", "", "", "d"], "note": 60 + i % 12})
+    description = {"enemies": enemies, "melody": [e["note"] for e in enemies], "pacify": "all",
+                   "center": [middle, middle], "sound_thresh": side, "mel_thresh": side}
+    projectiles = ProjectileSystem()
+    return EnemyGroupState(description, map, projectiles), map, projectiles
+
+# a pitch held long enough to count, but never the right note
+def wrong_note():
+    from music_controller import Pitch
+
+    music = Pitch()
+    music.set_tempo(120)
+    for _ in range(PITCHES_PER_BEAT):
+        music.add_pitch(61)
+    return music
+
+@benchmark("enemy_group.on_beat", [4, 32, 256])
+def bench_group_on_beat(num_enemies):
+    group, map, projectiles = big_group(num_enemies)
+    music = wrong_note()
+
+    # the group's part of a beat of LevelSimulation
+    def beat():
+        map.start_new_timestep()
+        group.on_beat(map, music)
+        projectiles.on_beat(map)
+        projectiles.cull(map)
+    return beat
+
+@benchmark("enemy_group.check_note", [4, 32, 256])
+def bench_group_check_note(num_enemies):
+    group, map, projectiles = big_group(num_enemies)
+    music = wrong_note()
+
+    def check():
+        group.check_note(music, False)
+    return check
+
+
+# how long one call of func takes: the best and median of repeat
+# measurements, each running func as many times as takes MIN_MEASURE_TIME
+def measure(func, repeat):
+    loops = 1
+    while True:
+        elapsed = time_loops(func, loops)
+        if elapsed >= MIN_MEASURE_TIME:
+            break
+        loops = max(loops * 2, int(loops * MIN_MEASURE_TIME * 1.2 / max(elapsed, 1e-9)))
+
+    times = [time_loops(func, loops) / loops for _ in range(repeat)]
+    return {"best": min(times), "median": float(np.median(times)), "loops": loops}
+
+def time_loops(func, loops):
+    start = time.perf_counter()
+    for _ in range(loops):
+        func()
+    return time.perf_counter() - start
+
+def result_name(name, size):
+    return "%s[%s]" % (name, size)
+
+# runs the benchmarks whose names start with only. Returns the results and
+# the skipped benchmarks (with why), by result name.
+def run_benchmarks(only = "", repeat = DEFAULT_REPEAT):
+    results = {}
+    skipped = {}
+    for name, sizes, setup in BENCHMARKS:
+        if not name.startswith(only):
+            continue
+        for size in sizes:
+            key = result_name(name, size)
+            try:
+                func = setup(size)
+            except ImportError as e:
+                skipped[key] = str(e)
+                print("%-36s skipped (%s)" % (key, e))
+                continue
+            results[key] = measure(func, repeat)
+            print("%-36s %12s" % (key, format_time(results[key]["best"])))
+    return results, skipped
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.2f %s" % (seconds / scale, unit)
+    return "%.1f ns" % (seconds / 1e-9)
+
+# compares results (and the skipped ones) with baseline, as written by --json.
+# Returns the results that got slower than the baseline by more than
+# threshold: (name, baseline, now), slowest first, and the names of the
+# results the baseline has that were skipped here.
+def compare(results, skipped, baseline, threshold):
+    print("\n%-36s %12s %12s %8s" % ("vs baseline", "before", "now", "ratio"))
+    regressions = []
+    missing = []
+    for key in sorted(set(results) | set(skipped)):
+        if key in skipped:
+            if key in baseline["results"]:
+                missing.append(key)
+                print("%-36s %12s %12s  skipped here (%s)" % (key, format_time(baseline["results"][key]["best"]),
+                                                            "-", skipped[key]))
+            continue
+        if key not in baseline["results"]:
+            if key in baseline.get("skipped", {}):
+                print("%-36s %12s %12s  skipped in the baseline" % (key, "-", format_time(results[key]["best"])))
+            continue
+        before = baseline["results"][key]["best"]
+        now = results[key]["best"]
+        ratio = now / before
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append((key, before, now))
+            flag = " slower"
+        elif ratio < 1 - threshold:
+            flag = " faster"
+        print("%-36s %12s %12s %7.2fx%s" % (key, format_time(before), format_time(now), ratio, flag))
+    return sorted(regressions, key=lambda r: r[1] / r[2]), missing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the hot paths")
+    parser.add_argument("--only", default="", help="only run benchmarks whose names start with this")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with results written by --json before")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    results, skipped = run_benchmarks(args.only, args.repeat)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__,
+                       "machine": platform.machine(), "time": time.time(),
+                       "results": results, "skipped": skipped}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions, missing = compare(results, skipped, baseline, args.threshold)
+        if regressions:
+            print("\n%d slower than the baseline by more than %d%%" % (len(regressions), args.threshold * 100))
+        if missing:
+            print("\n%d in the baseline skipped here, so not compared" % len(missing))
+        if regressions or missing:
+            sys.exit(1)
@@ -15,13 +15,14 @@ sys.path.append('..')
 import pyaudio
 import numpy as np
 from common import core
+from common.audioconfig import SAMPLE_RATE, BUFFER_SIZE
 import time
 import os.path
 
 class Audio(object):
     # audio configuration parameters:
-    sample_rate = 44100
-    buffer_size = 512
+    sample_rate = SAMPLE_RATE
+    buffer_size = BUFFER_SIZE
     out_dev = None
     in_dev = None
 
@@ -0,0 +1,13 @@
+#####################################################################
+#
+# audioconfig.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+# audio configuration parameters. Audio (see audio.py) plays with these, and
+# everything that makes or reads audio gets them from here, so it can be used
+# without pyaudio or a window (ie, to replay a session or compile a level).
+SAMPLE_RATE = 44100
+BUFFER_SIZE = 512
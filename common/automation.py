@@ -0,0 +1,131 @@
+#####################################################################
+#
+# automation.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import numpy as np
+
+
+# A parameter (ie, gain) whose value changes at exact frames of an
+# AudioScheduler, either instantly or as a linear ramp.
+# Changes are not posted as scheduler commands. Instead, the generator that owns
+# the parameter calls render() once per buffer and gets per-frame values, so any
+# number of changes landing in one buffer still renders that buffer in one pass.
+class Automation(object):
+    def __init__(self, sched, value = 1.0):
+        super(Automation, self).__init__()
+        self.sched = sched
+        self.value = float(value)
+
+        # pending changes: (start_frame, end_frame, target_value), sorted by start
+        self.events = []
+
+        # ramp in progress: (from_frame, from_value, to_frame, to_value) or None
+        self.ramp = None
+
+    # jump to value at tick
+    def set_at_tick(self, tick, value):
+        self.ramp_at_tick(tick, value, 0)
+
+    # linearly move from the current value to value, starting at tick and
+    # lasting duration ticks.
+    def ramp_at_tick(self, tick, value, duration = 0):
+        start = self.sched.tick_to_frame(tick)
+        end = self.sched.tick_to_frame(tick + duration)
+        self.events.append((start, end, float(value)))
+        self.events.sort(key = lambda x: x[0])
+
+    # return the values for the next num_frames frames, starting at the
+    # scheduler's current frame. For speed, returns a single float if the value
+    # does not change during this block.
+    def render(self, num_frames):
+        start = self.sched.cur_frame
+        end = start + num_frames
+
+        if self.ramp is None and (not self.events or self.events[0][0] >= end):
+            return self.value
+
+        output = np.empty(num_frames)
+        frame = start
+        while frame < end:
+            next_event = self.events[0][0] if self.events else end
+            next_event = max(next_event, frame)
+
+            if self.ramp:
+                from_frame, from_value, to_frame, to_value = self.ramp
+                stop = min(to_frame, next_event, end)
+                frames = np.arange(frame, stop)
+                output[frame - start : stop - start] = from_value + \
+                    (to_value - from_value) * (frames - from_frame) / (to_frame - from_frame)
+                self.value = from_value + (to_value - from_value) * (stop - from_frame) / (to_frame - from_frame)
+                if stop == to_frame:
+                    self.value = to_value
+                    self.ramp = None
+                frame = stop
+            else:
+                stop = min(next_event, end)
+                output[frame - start : stop - start] = self.value
+                frame = stop
+
+            # start the next change. It interrupts any ramp still in progress.
+            if frame < end and self.events and self.events[0][0] <= frame:
+                ev_start, ev_end, target = self.events.pop(0)
+                if ev_end <= frame:
+                    self.value = target
+                    self.ramp = None
+                else:
+                    self.ramp = (frame, self.value, ev_end, target)
+
+        return output
+
+
+# Wraps a generator so that it starts and stops at exact frames and has a
+# sample-accurate gain Automation. The wrapped generator is only asked for the
+# frames it actually plays, so it always starts at its own frame 0.
+class ScheduledGenerator(object):
+    def __init__(self, sched, generator, gain = 1.0):
+        super(ScheduledGenerator, self).__init__()
+        self.sched = sched
+        self.generator = generator
+        self.gain = Automation(sched, gain)
+
+        # None means: start right away / play until the generator is done
+        self.start_frame = None
+        self.stop_frame = None
+
+    def start_at_tick(self, tick):
+        self.start_frame = self.sched.tick_to_frame(tick)
+
+    def stop_at_tick(self, tick):
+        self.stop_frame = self.sched.tick_to_frame(tick)
+
+    # stop right away
+    def release(self):
+        self.stop_frame = self.sched.cur_frame
+
+    def generate(self, num_frames, num_channels) :
+        start = self.sched.cur_frame
+        end = start + num_frames
+        output = np.zeros(num_frames * num_channels)
+
+        # in-buffer frame offsets where the generator plays
+        begin = 0 if self.start_frame is None else int(np.clip(self.start_frame - start, 0, num_frames))
+        finish = num_frames if self.stop_frame is None else int(np.clip(self.stop_frame - start, 0, num_frames))
+        keep_going = self.stop_frame is None or self.stop_frame > end
+
+        if finish > begin:
+            data, continue_flag = self.generator.generate(finish - begin, num_channels)
+            o_idx = begin * num_channels
+            output[o_idx : o_idx + len(data)] = data
+            keep_going = keep_going and continue_flag
+
+        gain = self.gain.render(num_frames)
+        if np.isscalar(gain):
+            output *= gain
+        else:
+            output *= np.repeat(gain, num_channels)
+
+        return (output, keep_going)
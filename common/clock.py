@@ -9,8 +9,10 @@
 #####################################################################
 
 import time
+import json
 import numpy as np
-from .audio import Audio
+from collections import deque
+from .audioconfig import SAMPLE_RATE
 
 
 # Simple time keeper object. It starts at 0 and knows how to pause
@@ -82,9 +84,17 @@ class SimpleTempoMap(object):
         slope = (kTicksPerQuarter * self.bpm) / 60.
         self.tick_offset = cur_tick - cur_time * slope
 
-    def get_tempo(self):
+    def get_tempo(self, time = 0):
         return self.bpm
 
+    def times_to_ticks(self, times) :
+        slope = (kTicksPerQuarter * self.bpm) / 60.
+        return (slope * np.asarray(times) + self.tick_offset).astype(int)
+
+    def ticks_to_times(self, ticks) :
+        slope = (kTicksPerQuarter * self.bpm) / 60.
+        return (np.asarray(ticks) - self.tick_offset) / slope
+
 # prints the tick and beat (assuming kTicksPerQuarter is ticks per beat)
 def tick_str(tick) :
     beat = float(tick) / kTicksPerQuarter
@@ -95,26 +105,77 @@ def tick_str(tick) :
 # where each point is (time, tick)
 # optionally pass in filepath instead which will
 # read the file to create the list of (time, tick) points
-# TempoMap will linearly interpolate this graph
+# TempoMap will linearly interpolate this graph. Past the last point, it
+# continues at the last tempo.
+#
+# The points are stored as numpy arrays. Single lookups remember the segment
+# they found last, so sequential lookups (ie, from a scheduler) are O(1).
+# times_to_ticks() / ticks_to_times() convert whole arrays at once.
 class TempoMap(object):
     def __init__(self, data = None, filepath = None):
         super(TempoMap, self).__init__()
 
-        if data == None:
+        if data is None:
             data = self._read_tempo_data(filepath)
 
-        assert(data[0] == (0,0))
+        assert(tuple(data[0]) == (0,0))
         assert(len(data) > 1)
 
-        self.times, self.ticks = list(zip(*data))
+        times, ticks = list(zip(*data))
+        self.times = np.array(times, dtype=np.float64)
+        self.ticks = np.array(ticks, dtype=np.float64)
+        assert(np.all(np.diff(self.times) > 0) and np.all(np.diff(self.ticks) > 0))
+
+        # per-segment slopes, in ticks per second and seconds per tick
+        self.tick_slopes = np.diff(self.ticks) / np.diff(self.times)
+        self.time_slopes = 1 / self.tick_slopes
+        self.last_seg = len(self.times) - 2
+
+        # segments found by the most recent lookups
+        self.time_seg = 0
+        self.tick_seg = 0
 
     def time_to_tick(self, time) :
-        tick = np.interp(time, self.times, self.ticks)
-        return tick
+        i = self.time_seg = self._find_segment(self.times, time, self.time_seg)
+        return self.ticks[i] + self.tick_slopes[i] * (time - self.times[i])
 
     def tick_to_time(self, tick) :
-        time = np.interp(tick, self.ticks, self.times)
-        return time
+        i = self.tick_seg = self._find_segment(self.ticks, tick, self.tick_seg)
+        return self.times[i] + self.time_slopes[i] * (tick - self.ticks[i])
+
+    def times_to_ticks(self, times) :
+        times = np.asarray(times, dtype=np.float64)
+        idx = self._find_segments(self.times, times)
+        return self.ticks[idx] + self.tick_slopes[idx] * (times - self.times[idx])
+
+    def ticks_to_times(self, ticks) :
+        ticks = np.asarray(ticks, dtype=np.float64)
+        idx = self._find_segments(self.ticks, ticks)
+        return self.times[idx] + self.time_slopes[idx] * (ticks - self.ticks[idx])
+
+    # tempo (in bpm) at the given time
+    def get_tempo(self, time = 0) :
+        i = self._find_segment(self.times, time, self.time_seg)
+        return self.tick_slopes[i] * 60. / kTicksPerQuarter
+
+    # return i such that points[i] <= x < points[i+1], clamped to the first and
+    # last segments. guess (and the segment after it) is checked before falling
+    # back to a binary search.
+    def _find_segment(self, points, x, guess):
+        if points[guess] <= x:
+            if guess == self.last_seg or x < points[guess + 1]:
+                return guess
+            if guess + 1 == self.last_seg or x < points[guess + 2]:
+                return guess + 1
+        elif guess == 0:
+            return 0
+
+        i = int(np.searchsorted(points, x, side='right')) - 1
+        return min(max(i, 0), self.last_seg)
+
+    def _find_segments(self, points, x):
+        idx = np.searchsorted(points, x, side='right') - 1
+        return np.clip(idx, 0, self.last_seg)
 
     def _read_tempo_data(self, filepath):
         data = [(0,0)]
@@ -136,6 +197,7 @@ class Scheduler(object):
         self.clock = clock
         self.tempo_map = tempo_map
         self.commands = []
+        self.stats = DispatchStats()
 
     def get_time(self) :
         return self.clock.get_time()
@@ -149,8 +211,6 @@ class Scheduler(object):
     # make sure tick is the first argument so sorting will work out
     # properly
     def post_at_tick(self, func, tick, arg = None) :
-        now_tick = self.get_tick()
-
         cmd = Command(tick, func, arg)
         self.commands.append(cmd)
         self.commands.sort(key = lambda x: x.tick)
@@ -170,7 +230,8 @@ class Scheduler(object):
         while self.commands:
             if self.commands[0].tick <= now_tick:
                 command = self.commands.pop(0)
-                command.execute()
+                now = self.get_time()
+                self.stats.run(command, self.tempo_map.tick_to_time(command.tick), now, -1)
             else:
                 break
 
@@ -185,12 +246,29 @@ class Scheduler(object):
 # AudioScheduler is a Scheduler and Clock built into one class.
 # It is ALSO a Generator. For it to work, it must be inserted into
 # and Audio generator chain.
+#
+# Commands come in two flavors:
+# - audio-rate commands (the default) are executed inside generate(), at the
+#   exact frame where they are due. Use these only for cheap, audio-related
+#   work like starting notes.
+#   If split is False, the command instead runs at the start of the buffer it
+#   is due in, so that the buffer is still rendered in one pass. Such commands
+#   should place their effect on the exact frame themselves, using automation
+#   (see automation.py, ie ScheduledGenerator.start_at_tick).
+# - deferred commands are only timestamped inside generate(). They are queued
+#   up and executed later from the main loop by on_update(). Use these for game
+#   logic and graphics so that slow callbacks can never stall audio output.
 class AudioScheduler(object):
     def __init__(self, tempo_map) :
         super(AudioScheduler, self).__init__()
         self.tempo_map = tempo_map
         self.commands = []
 
+        # deferred commands that came due in generate(), waiting for on_update()
+        self.deferred = deque()
+
+        self.stats = DispatchStats()
+
         self.generator = None
         self.cur_frame = 0
 
@@ -207,14 +285,24 @@ class AudioScheduler(object):
         # advance time and fire off commands for this time frame
         while self.commands:
             # find the exact frame at which the next command should happen
-            cmd_tick = self.commands[0].tick
-            cmd_time = self.tempo_map.tick_to_time(cmd_tick)
-            cmd_frame = int(cmd_time * Audio.sample_rate)
+            cmd_frame = self.tick_to_frame(self.commands[0].tick)
 
             if cmd_frame < end_frame:
-                o_idx = self._generate_until(cmd_frame, num_channels, output, o_idx)
                 command = self.commands.pop(0)
-                command.execute()
+                command.frame = cmd_frame
+                if command.deferred:
+                    # no need to split the buffer: just hand it to the main loop
+                    command.dispatch_frame = self.cur_frame
+                    command.dispatch_wall_time = time.time()
+                    self.deferred.append(command)
+                else:
+                    if command.split:
+                        o_idx = self._generate_until(cmd_frame, num_channels, output, o_idx)
+                        self._run(command, self.cur_frame, time.time())
+                    else:
+                        # runs at the start of the buffer, but places its
+                        # effect on its frame itself, so it's on time there
+                        self._run(command, max(self.cur_frame, cmd_frame), time.time())
             else:
                 break
 
@@ -240,18 +328,24 @@ class AudioScheduler(object):
 
 
     def get_time(self) :
-        return self.cur_frame / float(Audio.sample_rate)
+        return self.cur_frame / float(SAMPLE_RATE)
 
     def get_tick(self) :
         return self.tempo_map.time_to_tick(self.get_time())
 
-    # add a record for the function to call at the particular tick
-    def post_at_tick(self, func, tick, arg = None) :
-        now_time  = self.get_time()
-        post_time = self.tempo_map.tick_to_time(tick)
-
+    # the audio frame at which tick happens
+    def tick_to_frame(self, tick) :
+        return int(self.tempo_map.tick_to_time(tick) * SAMPLE_RATE)
+
+    # add a record for the function to call at the particular tick.
+    # if deferred is True, the function is called from on_update() instead of
+    # from the audio generate() call. cmd.frame holds the exact frame at which
+    # it was due.
+    # if split is False (and not deferred), the function is called at the start of
+    # the audio buffer the tick falls in, instead of splitting that buffer.
+    def post_at_tick(self, func, tick, arg = None, deferred = False, split = True) :
         # create a command to hold the function/arg and sort by tick
-        cmd = Command(tick, func, arg)
+        cmd = Command(tick, func, arg, deferred, split)
         self.commands.append(cmd)
         self.commands.sort(key = lambda x: x.tick)
         return cmd
@@ -261,6 +355,25 @@ class AudioScheduler(object):
         if cmd in self.commands:
             idx = self.commands.index(cmd)
             del self.commands[idx]
+        elif cmd in self.deferred:
+            self.deferred.remove(cmd)
+
+    # must be called from the main loop (ie, every frame). Executes, in order,
+    # the deferred commands that came due during previous generate() calls.
+    # commands are popped BEFORE executing them to handle re-entry properly.
+    def on_update(self):
+        while self.deferred:
+            command = self.deferred.popleft()
+            self._run(command, command.dispatch_frame, command.dispatch_wall_time)
+
+    # execute command and record how late it was. On this scheduler's timeline,
+    # lateness is how far past its target frame the command was dispatched,
+    # plus (for deferred commands) how long it then waited for the main loop.
+    def _run(self, command, dispatch_frame, dispatch_wall_time):
+        target_time = command.frame / float(SAMPLE_RATE)
+        dispatch_time = dispatch_frame / float(SAMPLE_RATE)
+        dispatch_time += time.time() - dispatch_wall_time
+        self.stats.run(command, target_time, dispatch_time, dispatch_frame)
 
     def now_str(self):
         time = self.get_time()
@@ -271,11 +384,16 @@ class AudioScheduler(object):
 
 
 class Command(object):
-    def __init__(self, tick, func, arg):
+    def __init__(self, tick, func, arg, deferred = False, split = True):
         super(Command, self).__init__()
         self.tick = int(tick)
         self.func = func
         self.arg = arg
+        self.deferred = deferred
+        self.split = split
+        self.frame = None # audio frame at which the command came due
+        self.dispatch_frame = None # cur_frame of the scheduler when it was dispatched
+        self.dispatch_wall_time = None
         self.did_it = False
 
     def execute(self):
@@ -287,6 +405,109 @@ class Command(object):
     def __repr__(self):
         return 'cmd:%d' % self.tick
 
+# Records, for every command a scheduler runs: the target time, the actual
+# dispatch time and frame (-1 if the scheduler has no frames), the wall-clock
+# time of execution and how long the callback took. Records are kept in a
+# fixed-size ring buffer, so the oldest ones get overwritten.
+# Times are in seconds. Summaries and histograms report lateness in ms.
+class DispatchStats(object):
+    def __init__(self, size = 4096):
+        super(DispatchStats, self).__init__()
+        self.size = size
+        self.count = 0 # total # of records ever made
+
+        self.names = []    # callback names. records refer to them by index
+        self.name_ids = {}
+
+        self.name_id = np.zeros(size, dtype=np.int32)
+        self.target_time = np.zeros(size)
+        self.dispatch_time = np.zeros(size)
+        self.dispatch_frame = np.zeros(size, dtype=np.int64)
+        self.wall_time = np.zeros(size)
+        self.duration = np.zeros(size)
+
+    # execute the command and record it.
+    def run(self, command, target_time, dispatch_time, dispatch_frame):
+        wall_time = time.time()
+        t_start = time.perf_counter()
+        command.execute()
+        duration = time.perf_counter() - t_start
+
+        name = getattr(command.func, '__qualname__', repr(command.func))
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+
+        idx = self.count % self.size
+        self.name_id[idx] = self.name_ids[name]
+        self.target_time[idx] = target_time
+        self.dispatch_time[idx] = dispatch_time
+        self.dispatch_frame[idx] = dispatch_frame
+        self.wall_time[idx] = wall_time
+        self.duration[idx] = duration
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    # return the records currently held (oldest first) as a dict of arrays,
+    # optionally only those of one callback name.
+    def get_records(self, name = None):
+        n = min(self.count, self.size)
+        order = (np.arange(n) + self.count - n) % self.size
+        if name is not None:
+            order = order[self.name_id[order] == self.name_ids.get(name, -1)]
+
+        return {'name': [self.names[i] for i in self.name_id[order]],
+                'target_time': self.target_time[order],
+                'dispatch_time': self.dispatch_time[order],
+                'dispatch_frame': self.dispatch_frame[order],
+                'wall_time': self.wall_time[order],
+                'duration': self.duration[order],
+                'lateness': self.dispatch_time[order] - self.target_time[order]}
+
+    # return (counts, bin_edges) of the lateness (in ms) of one callback name
+    def lateness_histogram(self, name, bin_ms = 5, max_ms = 200):
+        lateness = self.get_records(name)['lateness'] * 1000
+        edges = np.arange(-max_ms, max_ms + bin_ms, bin_ms)
+        counts, edges = np.histogram(np.clip(lateness, -max_ms, max_ms), bins=edges)
+        return counts, edges
+
+    # return {name: {stat: value}} with lateness and duration stats in ms
+    def summary(self):
+        result = {}
+        for name in self.names:
+            recs = self.get_records(name)
+            if len(recs['lateness']) == 0:
+                continue
+            lateness = recs['lateness'] * 1000
+            duration = recs['duration'] * 1000
+            result[name] = {
+                'count': len(lateness),
+                'lateness_mean': float(np.mean(lateness)),
+                'lateness_p50': float(np.percentile(lateness, 50)),
+                'lateness_p95': float(np.percentile(lateness, 95)),
+                'lateness_p99': float(np.percentile(lateness, 99)),
+                'lateness_max': float(np.max(lateness)),
+                'duration_mean': float(np.mean(duration)),
+                'duration_max': float(np.max(duration)),
+            }
+        return result
+
+    # write the summary, histograms and raw records as JSON
+    def export(self, filepath):
+        histograms = {}
+        for name in self.names:
+            counts, edges = self.lateness_histogram(name)
+            histograms[name] = {'counts': counts.tolist(), 'edges_ms': edges.tolist()}
+
+        records = self.get_records()
+        records = {k: (v if type(v) == list else v.tolist()) for k, v in records.items()}
+
+        with open(filepath, 'w') as f:
+            json.dump({'summary': self.summary(), 'histograms': histograms, 'records': records}, f)
+
+
 # helper function for quantization:
 def quantize_tick_up(tick, grid) :
     return tick - (tick % grid) + grid
@@ -2,19 +2,22 @@
 
 from kivy.uix.widget import Widget
 from kivy.clock import Clock
-from kivy.graphics import Color, Callback, Rotate, PushMatrix, PopMatrix, Translate, Quad
+from kivy.graphics import Callback, Mesh, RenderContext
 from kivy.graphics.opengl import glBlendFunc, GL_SRC_ALPHA, GL_ONE, GL_ZERO, GL_SRC_COLOR, GL_ONE_MINUS_SRC_COLOR, GL_ONE_MINUS_SRC_ALPHA, GL_DST_ALPHA, GL_ONE_MINUS_DST_ALPHA, GL_DST_COLOR, GL_ONE_MINUS_DST_COLOR
 from kivy.core.image import Image
 from kivy.logger import Logger
 from xml.dom.minidom import parse as parse_xml
-from .utils import random_variance, random_color_variance
+from .utils import random_variances, random_color_variances
 from kivy.properties import NumericProperty, BooleanProperty, ListProperty, StringProperty, ObjectProperty
 
 import sys
 import os
 import math
+from array import array
 
-__all__ = ['EMITTER_TYPE_GRAVITY', 'EMITTER_TYPE_RADIAL', 'Particle', 'ParticleSystem']
+import numpy as np
+
+__all__ = ['EMITTER_TYPE_GRAVITY', 'EMITTER_TYPE_RADIAL', 'ParticleSystem']
 
 
 EMITTER_TYPE_GRAVITY = 0
@@ -33,16 +36,77 @@ BLEND_FUNC = {0: GL_ZERO,
 }
 
 
-class Particle(object):
-    x, y, rotation, current_time = -256, -256, 0, 0
-    scale, total_time = 1.0, 0.
-    color = [1.0, 1.0, 1.0, 1.0]
-    color_delta = [0.0, 0.0, 0.0, 0.0]
-    start_x, start_y, velocity_x, velocity_y = 0, 0, 0, 0
-    radial_acceleration, tangent_acceleration = 0, 0
-    emit_radius, emit_radius_delta = 0, 0
-    emit_rotation, emit_rotation_delta = 0, 0
-    rotation_delta, scale_delta = 0, 0
+# every particle is drawn as a textured, colored quad in one Mesh. The default
+# shader has no per vertex color, so the particles get their own.
+VERTEX_FORMAT = [(b'vPosition', 2, 'float'), (b'vTexCoords0', 2, 'float'), (b'vColor', 4, 'float')]
+
+VERTEX_SHADER = '''
+$HEADER$
+attribute vec4 vColor;
+
+void main(void) {
+    frag_color = vColor;
+    tex_coord0 = vTexCoords0;
+    gl_Position = projection_mat * modelview_mat * vec4(vPosition.xy, 0.0, 1.0);
+}
+'''
+
+FRAGMENT_SHADER = '''
+$HEADER$
+
+void main(void) {
+    gl_FragColor = frag_color * texture2D(texture0, tex_coord0);
+}
+'''
+
+# corners of a particle's quad, in the order of a texture's tex_coords
+QUAD_CORNERS = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]])
+QUAD_INDICES = [0, 1, 2, 2, 3, 0]
+# Kivy meshes take ushort indices, so 65536 vertices, 4 per particle
+MAX_PARTICLES = 65536 // 4
+
+
+# the state of up to capacity particles, one array per attribute. The first
+# count entries are the living particles.
+class Particles(object):
+    FIELDS = ('x', 'y', 'start_x', 'start_y', 'velocity_x', 'velocity_y',
+              'radial_acceleration', 'tangent_acceleration',
+              'emit_radius', 'emit_radius_delta', 'emit_rotation', 'emit_rotation_delta',
+              'scale', 'scale_delta', 'rotation', 'rotation_delta',
+              'current_time', 'total_time')
+
+    def __init__(self, capacity):
+        super(Particles, self).__init__()
+        self.count = 0
+        self.capacity = 0
+        for name in self.FIELDS:
+            setattr(self, name, np.zeros(0))
+        self.color = np.zeros((0, 4))
+        self.color_delta = np.zeros((0, 4))
+        self.resize(capacity)
+
+    # keeps as many living particles as fit
+    def resize(self, capacity):
+        capacity = int(capacity)
+        keep = min(self.count, capacity)
+        for name in self.FIELDS + ('color', 'color_delta'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:])
+            new[:keep] = old[:keep]
+            setattr(self, name, new)
+        self.count = keep
+        self.capacity = capacity
+
+    # moves the particles where keep is True to the front, in order
+    def compact(self, keep):
+        n = self.count
+        kept = np.count_nonzero(keep)
+        if kept == n:
+            return
+        for name in self.FIELDS + ('color', 'color_delta'):
+            array = getattr(self, name)
+            array[:kept] = array[:n][keep]
+        self.count = kept
 
 
 class ParticleSystem(Widget):
@@ -61,6 +125,8 @@ class ParticleSystem(Widget):
     start_rotation_variance = NumericProperty(0)
     end_rotation = NumericProperty(0)
     end_rotation_variance = NumericProperty(0)
+    emitter_x = NumericProperty(0)
+    emitter_y = NumericProperty(0)
     emitter_x_variance = NumericProperty(100)
     emitter_y_variance = NumericProperty(100)
     gravity_x = NumericProperty(0)
@@ -88,20 +154,29 @@ class ParticleSystem(Widget):
     _is_paused = BooleanProperty(False)
 
     def __init__(self, config, **kwargs):
+        # particles are drawn with their own shader (see VERTEX_SHADER)
+        self.canvas = RenderContext(use_parent_projection=True, use_parent_modelview=True)
+        self.canvas.shader.vs = VERTEX_SHADER
+        self.canvas.shader.fs = FRAGMENT_SHADER
+        self.particles = Particles(0)
+        self.mesh = Mesh(fmt=VERTEX_FORMAT, mode='triangles')
+        self.canvas.add(self.mesh)
+        # the mesh's vertices and indices are built in here, and handed to it
+        # as float / ushort arrays rather than lists of Python numbers
+        self.vertex_buffer = np.zeros((0, 4, 8), dtype=np.float32)
+        self.index_buffer = np.zeros(0, dtype=np.uint16)
+        self.rendered_count = 0 # particles in the mesh
+
         super(ParticleSystem, self).__init__(**kwargs)
-        self.capacity = 0
-        self.particles = list()
-        self.particles_dict = dict()
         self.emission_time = 0.0
         self.frame_time = 0.0
-        self.num_particles = 0
 
         if config is not None:
             self._parse_config(config)
         self.emission_rate = self.max_num_particles / self.life_span
-        self.initial_capacity = self.max_num_particles
-        self.max_capacity = self.max_num_particles
-        self._raise_capacity(self.initial_capacity)
+        self.max_capacity = self._clamp_capacity(self.max_num_particles)
+        self.particles.resize(self.max_capacity)
+        self.mesh.texture = self.texture
 
         with self.canvas.before:
             Callback(self._set_blend_func)
@@ -110,6 +185,10 @@ class ParticleSystem(Widget):
 
         Clock.schedule_once(self._update, self.update_interval)
 
+    @property
+    def num_particles(self):
+        return self.particles.count
+
     def start(self, duration=sys.maxsize):
         if self.emission_rate != 0:
             self.emission_time = duration
@@ -117,25 +196,31 @@ class ParticleSystem(Widget):
     def stop(self, clear=False):
         self.emission_time = 0.0
         if clear:
-            self.num_particles = 0
-            self.particles_dict = dict()
-            self.canvas.clear()
+            self.particles.count = 0
+            self._render()
+
+    # emit count particles at once, from (x, y) or else the emitter's position
+    def burst(self, count, x=None, y=None):
+        count = min(int(count), int(self.max_capacity) - self.particles.count)
+        if count <= 0:
+            return
+        start = self.particles.count
+        self._init_particles(count, self.emitter_x if x is None else x, self.emitter_y if y is None else y)
+        self._advance_particles(slice(start, start + count), 0.0)
 
     def on_max_num_particles(self, instance, value):
-        self.max_capacity = value
-        if self.capacity < value:
-            self._raise_capacity(self.max_capacity - self.capacity)
-        elif self.capacity > value:
-            self._lower_capacity(self.capacity - self.max_capacity)
+        self.max_capacity = self._clamp_capacity(value)
+        self.particles.resize(self.max_capacity)
         self.emission_rate = self.max_num_particles / self.life_span
 
+    def _clamp_capacity(self, value):
+        if value > MAX_PARTICLES:
+            Logger.warning('Particle: %d particles asked for, but a mesh can only draw %d' % (value, MAX_PARTICLES))
+            return MAX_PARTICLES
+        return value
+
     def on_texture(self, instance, value):
-        for p in self.particles:
-            try:
-                self.particles_dict[p]['rect'].texture = self.texture
-            except KeyError:
-                # if particle isn't initialized yet, you can't change its texture.
-                pass
+        self.mesh.texture = value
 
     def on_life_span(self, instance, value):
         self.emission_rate = self.max_num_particles / value
@@ -221,182 +306,167 @@ class ParticleSystem(Widget):
         if not self._is_paused:
             Clock.schedule_once(self._update, self.update_interval)
 
-    def _create_particle(self):
-        return Particle()
+    # set up count new particles after the living ones, all emitted from (emitter_x, emitter_y)
+    def _init_particles(self, count, emitter_x, emitter_y):
+        p = self.particles
+        s = slice(p.count, p.count + count)
+        p.count += count
 
-    def _init_particle(self, particle):
-        life_span = random_variance(self.life_span, self.life_span_variance)
-        if life_span <= 0.0:
-            return
-
-        particle.current_time = 0.0
-        particle.total_time = life_span
+        # particles without a life span die right away
+        life_span = np.maximum(random_variances(self.life_span, self.life_span_variance, count), 0.0)
+        p.current_time[s] = 0.0
+        p.total_time[s] = life_span
+        life_span = np.maximum(life_span, 1e-6)
 
-        particle.x = random_variance(self.emitter_x, self.emitter_x_variance)
-        particle.y = random_variance(self.emitter_y, self.emitter_y_variance)
-        particle.start_x = self.emitter_x
-        particle.start_y = self.emitter_y
+        p.x[s] = random_variances(emitter_x, self.emitter_x_variance, count)
+        p.y[s] = random_variances(emitter_y, self.emitter_y_variance, count)
+        p.start_x[s] = emitter_x
+        p.start_y[s] = emitter_y
 
-        angle = random_variance(self.emit_angle, self.emit_angle_variance)
-        speed = random_variance(self.speed, self.speed_variance)
-        particle.velocity_x = speed * math.cos(angle)
-        particle.velocity_y = speed * math.sin(angle)
+        angle = random_variances(self.emit_angle, self.emit_angle_variance, count)
+        speed = random_variances(self.speed, self.speed_variance, count)
+        p.velocity_x[s] = speed * np.cos(angle)
+        p.velocity_y[s] = speed * np.sin(angle)
 
-        particle.emit_radius = random_variance(self.max_radius, self.max_radius_variance)
-        particle.emit_radius_delta = (self.max_radius - self.min_radius) / life_span
+        p.emit_radius[s] = random_variances(self.max_radius, self.max_radius_variance, count)
+        p.emit_radius_delta[s] = (self.max_radius - self.min_radius) / life_span
 
-        particle.emit_rotation = random_variance(self.emit_angle, self.emit_angle_variance)
-        particle.emit_rotation_delta = random_variance(self.rotate_per_second, self.rotate_per_second_variance)
+        p.emit_rotation[s] = random_variances(self.emit_angle, self.emit_angle_variance, count)
+        p.emit_rotation_delta[s] = random_variances(self.rotate_per_second, self.rotate_per_second_variance, count)
 
-        particle.radial_acceleration = random_variance(self.radial_acceleration, self.radial_acceleration_variance)
-        particle.tangent_acceleration = random_variance(self.tangential_acceleration, self.tangential_acceleration_variance)
+        p.radial_acceleration[s] = random_variances(self.radial_acceleration, self.radial_acceleration_variance, count)
+        p.tangent_acceleration[s] = random_variances(self.tangential_acceleration, self.tangential_acceleration_variance, count)
 
-        start_size = random_variance(self.start_size, self.start_size_variance)
-        end_size = random_variance(self.end_size, self.end_size_variance)
+        start_size = np.maximum(random_variances(self.start_size, self.start_size_variance, count), 0.1)
+        end_size = np.maximum(random_variances(self.end_size, self.end_size_variance, count), 0.1)
 
-        start_size = max(0.1, start_size)
-        end_size = max(0.1, end_size)
-
-        particle.scale = start_size / self.texture.width
-        particle.scale_delta = ((end_size - start_size) / life_span) / self.texture.width
+        p.scale[s] = start_size / self.texture.width
+        p.scale_delta[s] = ((end_size - start_size) / life_span) / self.texture.width
 
         # colors
-        start_color = random_color_variance(self.start_color, self.start_color_variance)
-        end_color = random_color_variance(self.end_color, self.end_color_variance)
+        start_color = random_color_variances(self.start_color, self.start_color_variance, count)
+        end_color = random_color_variances(self.end_color, self.end_color_variance, count)
 
-        particle.color_delta = [(end_color[i] - start_color[i]) / life_span for i in range(4)]
-        particle.color = start_color
+        p.color_delta[s] = (end_color - start_color) / life_span[:, np.newaxis]
+        p.color[s] = start_color
 
         # rotation
-        start_rotation = random_variance(self.start_rotation, self.start_rotation_variance)
-        end_rotation = random_variance(self.end_rotation, self.end_rotation_variance)
-        particle.rotation = start_rotation
-        particle.rotation_delta = (end_rotation - start_rotation) / life_span
-
-    def _advance_particle(self, particle, passed_time):
-        passed_time = min(passed_time, particle.total_time - particle.current_time)
-        particle.current_time += passed_time
-
+        start_rotation = random_variances(self.start_rotation, self.start_rotation_variance, count)
+        end_rotation = random_variances(self.end_rotation, self.end_rotation_variance, count)
+        p.rotation[s] = start_rotation
+        p.rotation_delta[s] = (end_rotation - start_rotation) / life_span
+
+    # advance the particles in slice s by passed_time (a number, or one per particle)
+    def _advance_particles(self, s, passed_time):
+        p = self.particles
+        current_time = p.current_time[s]
+        total_time = p.total_time[s]
+        passed_time = np.minimum(passed_time, total_time - current_time)
+        current_time += passed_time
+
+        x = p.x[s]
+        y = p.y[s]
         if self.emitter_type == EMITTER_TYPE_RADIAL:
-            particle.emit_rotation += particle.emit_rotation_delta * passed_time
-            particle.emit_radius -= particle.emit_radius_delta * passed_time
-            particle.x = self.emitter_x - math.cos(particle.emit_rotation) * particle.emit_radius
-            particle.y = self.emitter_y - math.sin(particle.emit_rotation) * particle.emit_radius
+            # particles circle the point they were emitted from
+            emit_rotation = p.emit_rotation[s]
+            emit_radius = p.emit_radius[s]
+            emit_rotation += p.emit_rotation_delta[s] * passed_time
+            emit_radius -= p.emit_radius_delta[s] * passed_time
+            x[:] = p.start_x[s] - np.cos(emit_rotation) * emit_radius
+            y[:] = p.start_y[s] - np.sin(emit_rotation) * emit_radius
 
-            if particle.emit_radius < self.min_radius:
-                particle.current_time = particle.total_time
+            done = emit_radius < self.min_radius
+            current_time[done] = total_time[done]
 
         else:
-            distance_x = particle.x - particle.start_x
-            distance_y = particle.y - particle.start_y
-            distance_scalar = math.sqrt(distance_x * distance_x + distance_y * distance_y)
-            if distance_scalar < 0.01:
-                distance_scalar = 0.01
+            distance_x = x - p.start_x[s]
+            distance_y = y - p.start_y[s]
+            distance_scalar = np.maximum(np.sqrt(distance_x * distance_x + distance_y * distance_y), 0.01)
 
             radial_x = distance_x / distance_scalar
             radial_y = distance_y / distance_scalar
-            tangential_x = radial_x
-            tangential_y = radial_y
-
-            radial_x *= particle.radial_acceleration
-            radial_y *= particle.radial_acceleration
-
-            new_y = tangential_x
-            tangential_x = -tangential_y * particle.tangent_acceleration
-            tangential_y = new_y * particle.tangent_acceleration
-
-            particle.velocity_x += passed_time * (self.gravity_x + radial_x + tangential_x)
-            particle.velocity_y += passed_time * (self.gravity_y + radial_y + tangential_y)
 
-            particle.x += particle.velocity_x * passed_time
-            particle.y += particle.velocity_y * passed_time
+            radial_acceleration = p.radial_acceleration[s]
+            tangent_acceleration = p.tangent_acceleration[s]
+            tangential_x = -radial_y * tangent_acceleration
+            tangential_y = radial_x * tangent_acceleration
 
-        particle.scale += particle.scale_delta * passed_time
-        particle.rotation += particle.rotation_delta * passed_time
+            velocity_x = p.velocity_x[s]
+            velocity_y = p.velocity_y[s]
+            velocity_x += passed_time * (self.gravity_x + radial_x * radial_acceleration + tangential_x)
+            velocity_y += passed_time * (self.gravity_y + radial_y * radial_acceleration + tangential_y)
 
-        particle.color = [particle.color[i] + particle.color_delta[i] * passed_time for i in range(4)]
+            x += velocity_x * passed_time
+            y += velocity_y * passed_time
 
-    def _raise_capacity(self, by_amount):
-        old_capacity = self.capacity
-        new_capacity = min(self.max_capacity, self.capacity + by_amount)
+        p.scale[s] += p.scale_delta[s] * passed_time
+        p.rotation[s] += p.rotation_delta[s] * passed_time
 
-        for i in range(int(new_capacity - old_capacity)):
-            self.particles.append(self._create_particle())
-
-        self.num_particles = int(new_capacity)
-        self.capacity = new_capacity
-
-    def _lower_capacity(self, by_amount):
-        old_capacity = self.capacity
-        new_capacity = max(0, self.capacity - by_amount)
-
-        for i in range(int(old_capacity - new_capacity)):
-            try:
-                self.canvas.remove(self.particles_dict[self.particles.pop()]['rect'])
-            except:
-                pass
-
-        self.num_particles = int(new_capacity)
-        self.capacity = new_capacity
+        p.color[s] += p.color_delta[s] * np.reshape(passed_time, (-1, 1))
 
     def _advance_time(self, passed_time):
-        particle_index = 0
+        p = self.particles
 
         # advance existing particles
-        while particle_index < self.num_particles:
-            particle = self.particles[particle_index]
-            if particle.current_time < particle.total_time:
-                self._advance_particle(particle, passed_time)
-                particle_index += 1
-            else:
-                if particle_index != self.num_particles - 1:
-                    next_particle = self.particles[self.num_particles - 1]
-                    self.particles[self.num_particles - 1] = particle
-                    self.particles[particle_index] = next_particle
-                self.num_particles -= 1
-                if self.num_particles == 0:
-                    Logger.debug('Particle: COMPLETE')
+        n = p.count
+        p.compact(p.current_time[:n] < p.total_time[:n])
+        if p.count == 0 and n > 0:
+            Logger.debug('Particle: COMPLETE')
+        self._advance_particles(slice(0, p.count), passed_time)
 
         # create and advance new particles
         if self.emission_time > 0:
             time_between_particles = 1.0 / self.emission_rate
             self.frame_time += passed_time
 
-            while self.frame_time > 0:
-                if self.num_particles < self.max_capacity:
-                    if self.num_particles == self.capacity:
-                        self._raise_capacity(self.capacity)
-
-                    particle = self.particles[self.num_particles]
-                    self.num_particles += 1
-                    self._init_particle(particle)
-                    self._advance_particle(particle, self.frame_time)
-
-                self.frame_time -= time_between_particles
+            if self.frame_time > 0:
+                # one particle per time_between_particles, the first one
+                # frame_time ago, for as many as there is room for. The rest
+                # wait for room. Those older than a life span would be dead
+                # already, so they are dropped.
+                due = int(math.ceil(self.frame_time / time_between_particles))
+                count = max(0, min(due, int(self.max_capacity) - p.count))
+                if count > 0:
+                    start = p.count
+                    self._init_particles(count, self.emitter_x, self.emitter_y)
+                    ages = self.frame_time - np.arange(count) * time_between_particles
+                    self._advance_particles(slice(start, start + count), ages)
+                self.frame_time = min(self.frame_time - count * time_between_particles, self.life_span)
 
             if self.emission_time != sys.maxsize:
                 self.emission_time = max(0.0, self.emission_time - passed_time)
 
+    # rebuild the mesh with one quad per living particle
     def _render(self):
-        if self.num_particles == 0:
+        p = self.particles
+        n = p.count
+        if n == 0:
+            if self.rendered_count:
+                self.mesh.vertices = []
+                self.mesh.indices = []
+                self.rendered_count = 0
             return
-        for i in range(self.num_particles):
-            particle = self.particles[i]
-            size = (self.texture.size[0] * particle.scale, self.texture.size[1] * particle.scale)
-            if particle not in self.particles_dict:
-                self.particles_dict[particle] = dict()
-                color = particle.color[:]
-                with self.canvas:
-                    self.particles_dict[particle]['color'] = Color(color[0], color[1], color[2], color[3])
-                    PushMatrix()
-                    self.particles_dict[particle]['translate'] = Translate()
-                    self.particles_dict[particle]['rotate'] = Rotate()
-                    self.particles_dict[particle]['rotate'].set(particle.rotation, 0, 0, 1)
-                    self.particles_dict[particle]['rect'] = Quad(texture=self.texture, points=(-size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5,  size[1] * 0.5, -size[0] * 0.5,  size[1] * 0.5))
-                    self.particles_dict[particle]['translate'].xy = (particle.x, particle.y)
-                    PopMatrix()
-            else:
-                self.particles_dict[particle]['rotate'].angle = particle.rotation
-                self.particles_dict[particle]['translate'].xy = (particle.x, particle.y)
-                self.particles_dict[particle]['color'].rgba = particle.color
-                self.particles_dict[particle]['rect'].points = (-size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5,  size[1] * 0.5, -size[0] * 0.5,  size[1] * 0.5)
+
+        if len(self.vertex_buffer) < n:
+            self.vertex_buffer = np.zeros((p.capacity, 4, 8), dtype=np.float32)
+            # capacity is at most MAX_PARTICLES, so the indices fit in ushorts
+            self.index_buffer = (np.arange(p.capacity)[:, np.newaxis] * 4 + QUAD_INDICES).astype(np.uint16).ravel()
+
+        width, height = self.texture.size
+        scale = p.scale[:n, np.newaxis]
+        # rotations are in radians
+        angle = p.rotation[:n, np.newaxis]
+        cos, sin = np.cos(angle), np.sin(angle)
+        corner_x = QUAD_CORNERS[:, 0] * width * scale
+        corner_y = QUAD_CORNERS[:, 1] * height * scale
+
+        # 4 corners per particle: x, y, u, v, r, g, b, a
+        vertices = self.vertex_buffer[:n]
+        vertices[:, :, 0] = p.x[:n, np.newaxis] + corner_x * cos - corner_y * sin
+        vertices[:, :, 1] = p.y[:n, np.newaxis] + corner_x * sin + corner_y * cos
+        vertices[:, :, 2:4] = np.reshape(self.texture.tex_coords, (4, 2))
+        vertices[:, :, 4:] = p.color[:n, np.newaxis, :]
+        self.mesh.vertices = array('f', vertices.tobytes())
+        if n != self.rendered_count:
+            self.mesh.indices = array('H', self.index_buffer[:n * 6].tobytes())
+            self.rendered_count = n
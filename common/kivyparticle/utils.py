@@ -2,7 +2,9 @@
 
 import random
 
-__all__ = ['random_variance', 'random_color_variance']
+import numpy as np
+
+__all__ = ['random_variance', 'random_color_variance', 'random_variances', 'random_color_variances']
 
 
 def random_variance(base, variance):
@@ -11,3 +13,12 @@ def random_variance(base, variance):
 
 def random_color_variance(base, variance):
     return [min(max(0.0, (random_variance(base[i], variance[i]))), 1.0) for i in range(4)]
+
+
+def random_variances(base, variance, count):
+    return base + variance * (np.random.random(count) * 2.0 - 1.0)
+
+
+def random_color_variances(base, variance, count):
+    colors = np.asarray(base) + np.asarray(variance) * (np.random.random((count, 4)) * 2.0 - 1.0)
+    return np.clip(colors, 0.0, 1.0)
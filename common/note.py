@@ -9,7 +9,7 @@
 #####################################################################
 
 import numpy as np
-from .audio import Audio
+from .audioconfig import SAMPLE_RATE
 
 # Twelevth root of 2
 kTRT = pow(2.0, 1.0/12.0)
@@ -43,7 +43,7 @@ class NoteGenerator(object):
 
     def generate(self, num_frames, num_channels) :
         # create time series from frame range
-        time = np.arange(self.frame, self.frame + num_frames) / Audio.sample_rate 
+        time = np.arange(self.frame, self.frame + num_frames) / SAMPLE_RATE 
 
         # frequency
         omega = (2.0 * np.pi) * self.freq
@@ -83,8 +83,8 @@ class Envelope(object):
         self.generator = generator
 
         # attack / decay time parameters (converted from seconds to frames)
-        self.attack_frames = round(attack_time * Audio.sample_rate)
-        self.decay_frames =  round(decay_time * Audio.sample_rate)
+        self.attack_frames = round(attack_time * SAMPLE_RATE)
+        self.decay_frames =  round(decay_time * SAMPLE_RATE)
 
         # attack / decay envelope shapes
         self.n1 = n1
@@ -10,13 +10,13 @@
 
 import numpy as np
 from . import fluidsynth
-from .audio import Audio
+from .audioconfig import SAMPLE_RATE
 
 # create another kind of generator that generates audio based on the fluid
 # synth synthesizer
 class Synth(fluidsynth.Synth, object):
     def __init__(self, filepath, gain = 0.8):
-        super(Synth, self).__init__(gain, samplerate=Audio.sample_rate)
+        super(Synth, self).__init__(gain, samplerate=SAMPLE_RATE)
         self.sfid = self.sfload(filepath)
         if self.sfid == -1:
             raise Exception('Error in fluidsynth.sfload(): cannot open ' + filepath)
@@ -10,7 +10,7 @@
 
 import numpy as np
 import wave
-from .audio import Audio
+from .audioconfig import SAMPLE_RATE
 
 # Interface for reading data from a wave file. Does not store this data locally.
 # Simple call to get_frames() to get data in format we like (numpy array, float32)
@@ -24,7 +24,7 @@ class WaveFile(object):
 
         # for now, we will only accept 16 bit files and the sample rate must match
         assert(self.sampwidth == 2)
-        assert(self.sr == Audio.sample_rate)
+        assert(self.sr == SAMPLE_RATE)
 
     # read an arbitrary chunk of data from the file
     def get_frames(self, start_frame, end_frame) :
@@ -34,7 +34,7 @@ class WaveFile(object):
         raw_bytes = self.wave.readframes(end_frame - start_frame)
 
         # convert raw data to numpy array, assuming int16 arrangement
-        samples = np.fromstring(raw_bytes, dtype = np.int16)
+        samples = np.frombuffer(raw_bytes, dtype = np.int16)
 
         # convert from integer type to floating point, and scale to [-1, 1]
         samples = samples.astype(np.float32)
@@ -102,9 +102,9 @@ class SongRegions(object):
             # time values are in seconds
             (start_sec, x, len_sec, name) = line.strip().split('\t')
 
-            # convert time (in seconds) to frames. Assumes Audio.sample_rate
-            start_f = int( float(start_sec) * Audio.sample_rate )
-            len_f = int( float(len_sec) * Audio.sample_rate )
+            # convert time (in seconds) to frames. Assumes SAMPLE_RATE
+            start_f = int( float(start_sec) * SAMPLE_RATE )
+            len_f = int( float(len_sec) * SAMPLE_RATE )
 
             self.regions.append(AudioRegion(name, start_f, len_f))
 
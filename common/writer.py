@@ -11,7 +11,7 @@
 import numpy as np
 import os.path
 import wave
-from .audio import Audio
+from .audioconfig import SAMPLE_RATE
 
 class AudioWriter(object):
     def __init__(self, filebase, output_wave=True):
@@ -72,7 +72,7 @@ def write_wave_file(buf, num_channels, name):
     f = wave.open(name, 'w')
     f.setnchannels(num_channels)
     f.setsampwidth(2)
-    f.setframerate(Audio.sample_rate)
+    f.setframerate(SAMPLE_RATE)
     buf = buf * (2**15)
     buf = buf.astype(np.int16)
     f.writeframes(buf.tostring())
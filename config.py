@@ -7,6 +7,22 @@ from environment import ENVIRONMENT # THIS MUST EXIST, BUT DON'T PUSH IT TO REPO
 # TODO: define other environments and calibrate values
 HALF_BEAT_TICKS = 240
 POP_THRESHOLD_RATIO = 1.0
+# if set (ie 'sched_stats_%s.json'), each level writes its scheduler lateness
+# stats there when it unloads. %s is replaced by the level name.
+SCHED_STATS_FILE = None
+# tint the squares that will be dangerous on the next beat (see DangerPreview)
+SHOW_DANGER_PREVIEW = False
+# levels start this many beats in, to get to a late part of a level quickly
+LEVEL_START_BEAT = 0
+# if set (ie 'session.dunjlog'), every input of the session is recorded there.
+# REPLAY_FILE plays such a session back instead of the keyboard and mic (see replay.py)
+INPUT_LOG_FILE = None
+REPLAY_FILE = None
+# budgets frame_budget.py holds a level to: the p99 of how long a frame's
+# on_update takes (ms), and the p99 of how long a buffer of audio takes to
+# generate, as a fraction of how long it plays for
+FRAME_BUDGET_MS = 1000 / 60
+AUDIO_LOAD_BUDGET = 0.5
 if ENVIRONMENT == 'mac':
     EPSILON_BEFORE = 40 / 960
     EPSILON_AFTER = 140 / 960
@@ -0,0 +1,32 @@
+from kivy.graphics.instructions import InstructionGroup
+from kivy.graphics import Color, Mesh
+
+import numpy as np
+
+PREVIEW_COLOR = (1, 0.2, 0.2, 0.3)
+
+# tints the squares that will be dangerous on the next beat, as predicted by
+# the level's danger tables (see DangerTables). Drawn in the map's world units,
+# as one Mesh with a quad per square.
+class DangerPreview(InstructionGroup):
+    def __init__(self, sim, map):
+        super(DangerPreview, self).__init__()
+        self.sim = sim
+        self.map = map
+
+        self.add(Color(*PREVIEW_COLOR))
+        self.mesh = Mesh(mode='triangles')
+        self.add(self.mesh)
+
+    # call once the simulation finished its beat
+    def on_beat(self):
+        rows, cols = np.nonzero(self.sim.danger_preview())
+        n = len(rows)
+
+        # world position of a tile is (col, -row)
+        vertices = np.zeros((n, 4, 4))
+        vertices[:, :, 0] = cols[:, np.newaxis] + [0, 1, 1, 0]
+        vertices[:, :, 1] = -rows[:, np.newaxis] + [0, 0, 1, 1]
+        indices = np.arange(n)[:, np.newaxis] * 4 + [0, 1, 2, 2, 3, 0]
+        self.mesh.vertices = vertices.ravel().tolist()
+        self.mesh.indices = indices.ravel().tolist()
@@ -3,12 +3,14 @@ os.environ['KIVY_IMAGE'] = 'sdl2'
 
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
-from kivy.graphics import PushMatrix, PopMatrix
+from kivy.graphics import PushMatrix, PopMatrix, Mesh
 from kivy.clock import Clock as kivyClock
 
 from entity import Entity, EntityGraphic
+from sprites import get_texture, set_sprite
 from common.gfxutil import CRectangle, AnimGroup
 import numpy as np
+import colorsys
 
 
 PROJECTILE_SPEED = 10
@@ -18,248 +20,198 @@ BOUNCE_TIME = 0.15
 # maximum bounce height as a function of tile size
 MAX_BOUNCE_HEIGHT = 0.5
 
+# enemy colors come from a table of rgba by hue (one per pitch class) and
+# saturation (in SATURATION_STEPS steps), at full value. Value just scales rgb.
+SATURATION_STEPS = 32
+HSV_LUT = np.array([[colorsys.hsv_to_rgb(hue / 12, sat / SATURATION_STEPS, 1) + (1,)
+                     for sat in range(SATURATION_STEPS + 1)] for hue in range(12)])
+
+# draws an EnemyState
 class Enemy(Entity):
-    def __init__(self, desc, action_description, map, is_enemy_pacified, should_p_attack):
+    def __init__(self, state, sprites, map, motion):
         super(Enemy, self).__init__()
-        # TODO
-        # init_pos is (row, col)
-        # action_description is a class with the methods
-        # get_next_pos(prev_pos) which accepts and returns (row, col)
-        # get_next_attack() which returns "u", "d", "l", "r", or "" for which direction to shoot
-        #    or to indicate not to shoot.
-        # map is a Map object that should be used to convert from tiles (row, col) to pixels (x, y)
-        #   using the tile_to_pixels() function
-        self.id = desc["id"]
-        self.pos = desc["init_pos"]
-        self.note = desc["note"] # the note is either the MIDI pitch which pacifies it, or -1 if the enemy group type is "all"
+        # state is an EnemyState
+        # sprites is a dict with the "angry", "pacified" and "projectile" sprites
+        # map is the Map object that this is drawn on (in its world units)
+        # motion is the MotionSystem that moves the graphic
+        self.state = state
+        self.id = state.id
+        self.note = state.note # the note is either the MIDI pitch which pacifies it, or -1 if the enemy group type is "all"
         self.map = map
-        self.actions = action_description
-        # this is a callback from enemy_group, which takes in an enemy id and returns
-        # whether it is pacified or not (usually just call it with your own id)
-        self.is_enemy_pacified = is_enemy_pacified
-        self.should_p_attack = should_p_attack
-
-        pixel_pos = self.map.tile_to_pixels(self.pos)
 
-        self.sprites = desc["sprites"]
-        if self.is_pacified():
-            sprite = desc["sprites"]["pacified"]
+        self.sprites = sprites
+        self.pacified = self.is_pacified()
+        if self.pacified:
+            sprite = sprites["pacified"]
         else:
-            sprite = desc["sprites"]["angry"]
-        self.graphic = EnemyGraphic(self.pos, sprite, map)
+            sprite = sprites["angry"]
+        self.graphic = EnemyGraphic(state.pos, sprite, map, motion)
         self.draw_graphics()
-        self.projectiles = AnimGroup()
-        self.add(self.projectiles)
 
-    # return the next projectile, or None if no projectile is being created
-    def get_projectile(self):
-        next_attack = self.actions.get_next_attack(self.should_p_attack(self.id))
-        if next_attack != '':
-            p_pos = np.array(self.pos)
-            return Projectile(p_pos, next_attack, self.map, self.sprites["projectile"])
-        return None
+        # last (hue, saturation step, value) set by set_color
+        self.color_key = None
 
+    # only touches the graphic when the enemy became pacified or angry.
+    # Returns True if the enemy just became pacified
     def update_sprite(self):
-        if self.is_enemy_pacified(self.id):
+        pacified = self.is_pacified()
+        if pacified == self.pacified:
+            return False
+        self.pacified = pacified
+        if pacified:
             self.graphic.set_sprite(self.sprites["pacified"])
         else:
             self.graphic.set_sprite(self.sprites["angry"])
+        return pacified
 
-    def on_beat(self, map, music, movement):
+    def on_beat(self):
         # move the enemy
-        self.pos = self.actions.get_next_pos(self.pos)
-        # self.graphic.pos = self.map.tile_to_pixels(self.pos)
-        self.graphic.set_position(self.pos)
+        self.graphic.set_position(self.state.pos)
 
         # update the sprite to a pacified or angry one
-        if self.is_pacified():
-            self.graphic.set_sprite(self.sprites["pacified"])
-        else:
-            self.graphic.set_sprite(self.sprites["angry"])
-
-        projectile = self.get_projectile()
-        if projectile is not None:
-            self.projectiles.add(projectile)
-
-        for p in self.projectiles.objects:
-            p.on_beat(map, music, movement)
-
-        # add the enemy to the map so it knows where they are
-        # using its add_enemy(self, position, enemy):
-        map.add_enemy(self.pos, self)
+        self.update_sprite()
 
     def is_pacified(self):
-        return self.is_enemy_pacified(self.id)
-
-    def is_passable(self):
-        # once pacified, the player cannot accidentally run into a pacified enemy and get killed
-        return not self.is_pacified()
+        return self.state.is_pacified()
 
     def set_color(self, s, v, base_midi):
-        hue = ((self.note - base_midi) % 12) / 12
-        rgba = Color(hue, s, v, mode='hsv').rgba
-        self.graphic.set_color(rgba)
+        key = ((self.note - base_midi) % 12, int(round(s * SATURATION_STEPS)), v)
+        if key == self.color_key:
+            return
+        self.color_key = key
+        hue, sat, value = key
+        r, g, b, a = HSV_LUT[hue, sat]
+        self.graphic.set_color((r * value, g * value, b * value, a))
 
     def on_update(self, dt=None):
-        self.projectiles.on_update()
         return self.graphic.on_update()
 
 
 class EnemyGraphic(EntityGraphic):
-    def __init__(self, init_pos, sprite, map):
+    def __init__(self, init_pos, sprite, map, motion):
         super(EnemyGraphic, self).__init__()
-        self.pos = init_pos
-        self.next_pos = self.pos
         self.map = map
+        self.motion = motion
         self.color = Color(rgba=(1,1,1,0))
 
         self.add(self.color)
 
         if sprite:
-            self.rect = Rectangle(pos=self.map.tile_to_pixels(self.pos), size=map.tile_size(), source=sprite)
+            self.rect = Rectangle(pos=self.map.tile_to_world(init_pos), size=(1, 1), texture=get_texture(sprite))
         else:
-            self.rect = Rectangle(pos=self.map.tile_to_pixels(self.pos), size=map.tile_size(), color=(1,0.8,0.8))
+            self.rect = Rectangle(pos=self.map.tile_to_world(init_pos), size=(1, 1), color=(1,0.8,0.8))
         self.add(self.rect)
 
+        self.index = motion.add(self.rect, init_pos, ENEMY_SPEED)
+
     def set_position(self, new_pos):
-        self.next_pos = new_pos
+        self.motion.set_goal(self.index, new_pos)
 
     def set_sprite(self, sprite):
         self.sprite = sprite
-        self.rect.source = sprite
+        set_sprite(self.rect, sprite)
 
     def set_color(self, color):
         self.color.rgba = color
 
+    # moving is done by the MotionSystem
     def on_update(self, dt=None):
-        dt = kivyClock.frametime
-
-        disp = np.array(self.next_pos) - np.array(self.pos)
-        dist = np.linalg.norm(disp)
-
-        if dist < dt * ENEMY_SPEED:
-            self.pos = self.next_pos
-        else:
-            delta = disp * dt * ENEMY_SPEED / dist
-            self.pos = self.pos + delta
-
-        self.rect.pos = self.map.tile_to_pixels(self.pos)
-        self.rect.size = self.map.tile_size()
-
         return True
 
-# map a direction character to a deltax and deltay
-direction_map = {
-    'u': (-1, 0),
-    'd': (1, 0),
-    'l': (0, -1),
-    'r': (0, 1)
-}
-
-
-# The class that keeps track of projectiles and their positions, and moves them
-class Projectile(Entity):
-    def __init__(self, init_pos, dir, map, sprite):
-        super(Projectile, self).__init__()
-        self.pos = np.array(init_pos)
-        self.next_pos = self.pos
-        # the direction is "u", "d", "l", or "r"
-        self.dir = dir
+# draws all the projectiles of a ProjectileSystem (in world units), moving and
+# bouncing them towards their next positions. Everything is done on arrays, with one row per
+# living projectile, and drawn with one Mesh per projectile sprite. The vertex
+# buffers are kept between frames and only grow, and the indices only change
+# when the number of projectiles of a sprite does.
+class ProjectileLayer(InstructionGroup):
+    def __init__(self, state, map, sprites):
+        super(ProjectileLayer, self).__init__()
+        # state is a ProjectileSystem
+        # sprites is the projectile sprite of each of the state's owners
+        self.state = state
         self.map = map
 
-        self.graphic = ProjectileGraphic(init_pos, map)
-        # self.draw_graphics()
-        # self.add(self.graphic)
-        pixel_pos = self.map.tile_to_pixels(self.pos)
-        self.pixel_size = np.array(map.tile_size())*0.5
-
-        # self.add(Color(0,0.8,0.8))
-        self.rect = Rectangle(pos=pixel_pos, size=map.tile_size(), source=sprite)
-
-        # self.rect = Rectangle(pos=pixel_pos + self.pixel_size / 2, size=self.pixel_size, source=sprite)
-        self.add(self.rect)
-
-        # keep track of where we are in the bounce
-        self.bouncing = False
-        self.bounce_prog = 0
-
-    # returns the next position
-    def get_next_pos(self):
-        return self.pos + direction_map[self.dir]
-
-    def set_next_pos(self, next_pos):
-        self.next_pos = next_pos
+        names = sorted(set(sprites))
+        self.owner_sprite = np.array([names.index(s) for s in sprites], dtype=int)
+
+        self.add(Color(1, 1, 1))
+        self.meshes = []
+        self.tex_coords = []
+        self.vertices = [] # 4 corners per projectile: x, y, u, v
+        self.num_drawn = [] # projectiles in each mesh's indices
+        for name in names:
+            texture = get_texture(name)
+            mesh = Mesh(mode='triangles', texture=texture)
+            self.meshes.append(mesh)
+            self.tex_coords.append(np.array(texture.tex_coords, dtype=float).reshape(4, 2))
+            self.vertices.append(np.zeros((0, 4, 4)))
+            self.num_drawn.append(0)
+            self.add(mesh)
+
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.pos = np.zeros((0, 2))
+        self.next_pos = np.zeros((0, 2))
+        self.sprite = np.zeros(0, dtype=int)
+        self.bounce_prog = np.zeros(0)
+
+    # catch up with the state after its beat. Projectiles that were already
+    # drawn keep going from where they are, new ones start where they were shot.
+    def on_beat(self):
+        state = self.state
+        slots = state.live_slots()
+        ids = state.ids[slots]
+
+        pos = state.pos[slots].astype(float)
+        if len(self.ids):
+            old = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+            found = self.ids[old] == ids
+            pos[found] = self.pos[old[found]]
+
+        self.ids = ids
+        self.pos = pos
+        self.next_pos = state.next_pos[slots].astype(float)
+        self.sprite = self.owner_sprite[state.owner[slots]]
+        self.bounce_prog = np.zeros(len(slots))
 
     # give the deltay based on the progress of the bounce
     def get_deltay_bounce(self):
-        return 2 * self.bounce_prog ** 2 - 2 * self.bounce_prog
-
-    def on_beat(self, map, music, movement):
-        next_pos = self.get_next_pos()
-        self.set_next_pos(next_pos)
-        self.bouncing = True
-        self.bounce_prog = 0
-        map.add_enemy(next_pos, self)
-
-    def is_passable(self):
-        return True
+        b = self.bounce_prog
+        return np.where(b > 1, 0, 2 * b ** 2 - 2 * b)
 
     def on_update(self, dt=None):
         dt = kivyClock.frametime
         self.bounce_prog += dt / BOUNCE_TIME
-        if self.bounce_prog > 1:
-            self.bouncing = False
-            deltay = 0
-        else:
-            deltay = self.get_deltay_bounce()
-
-        disp = self.next_pos - self.pos
-        dist = np.linalg.norm(disp)
-
-        if dist < dt * PROJECTILE_SPEED:
-            self.pos = self.next_pos
-        else:
-            delta = disp * dt * PROJECTILE_SPEED / dist
-            self.pos = self.pos + delta
-
-        # self.rect.pos = self.map.tile_to_pixels(self.pos) + self.pixel_size / 2
-        self.rect.pos = self.map.tile_to_pixels(self.pos + [deltay, 0])
-
-        return self.map.is_square_passable(self.next_pos)
-        # return self.pos[0] > 0 and self.pos[1] > 0 and self.pos[1] < self.map.map_size()[1] and self.pos[0] < self.map.map_size()[0]
-
-
-class ProjectileGraphic(EntityGraphic):
-    def __init__(self, init_pos, map):
-        super(ProjectileGraphic, self).__init__()
-        self.pos = init_pos
-        self.next_pos = init_pos
-        self.map = map
-
-        pixel_pos = self.map.tile_to_pixels(self.pos)
-        self.pixel_size = np.array(map.tile_size())*0.5
-
-        # self.add(Color(0,0.8,0.8))
-        self.rect = Rectangle(pos=pixel_pos + self.pixel_size / 2, size=self.pixel_size)
-        # self.rect = Rectangle(pos=(10, 10), size=(100, 100), source='./data/sprite/crappy_enemy.PNG')
-        self.add(self.rect)
-
-    def set_next_pos(self, next_pos):
-        self.next_pos = next_pos
-
-    def on_update(self, dt=None):
-        dt = kivyClock.frametime
 
         disp = self.next_pos - self.pos
-        dist = np.linalg.norm(disp)
+        dist = np.sqrt(np.sum(disp ** 2, axis=1))
+        arrived = dist <= dt * PROJECTILE_SPEED
+        self.pos[arrived] = self.next_pos[arrived]
+        moving = ~arrived
+        self.pos[moving] += disp[moving] * (dt * PROJECTILE_SPEED / dist[moving])[:, np.newaxis]
+
+        # world x is col, world y is -row
+        x = self.pos[:, 1]
+        y = -(self.pos[:, 0] + self.get_deltay_bounce())
+
+        for i, mesh in enumerate(self.meshes):
+            sel = self.sprite == i
+            n = np.count_nonzero(sel)
+            if n > len(self.vertices[i]):
+                self.grow(i, n)
+            vertices = self.vertices[i][:n]
+            vertices[:, :, 0] = x[sel][:, np.newaxis] + [0, 1, 1, 0]
+            vertices[:, :, 1] = y[sel][:, np.newaxis] + [0, 0, 1, 1]
+            mesh.vertices = vertices.ravel().tolist()
+            if n != self.num_drawn[i]:
+                self.num_drawn[i] = n
+                indices = np.arange(n)[:, np.newaxis] * 4 + [0, 1, 2, 2, 3, 0]
+                mesh.indices = indices.ravel().tolist()
 
-        if dist < dt * PROJECTILE_SPEED:
-            self.pos = self.next_pos
-        else:
-            delta = disp * dt * PROJECTILE_SPEED / dist
-            self.pos = self.pos + delta
-
-        self.rect.pos = self.map.tile_to_pixels(self.pos) + self.pixel_size / 2
+        return True
 
-        return self.pos[0] > 0 and self.pos[1] > 0 and self.pos[1] < self.map.map_size()[1] and self.pos[0] < self.map.map_size()[0]
-        # return True
+    # make room for at least n projectiles of sprite i. Texture coordinates
+    # never change, so they are only filled in here.
+    def grow(self, i, n):
+        vertices = np.zeros((max(n, 2 * len(self.vertices[i]), 16), 4, 4))
+        vertices[:, :, 2:] = self.tex_coords[i]
+        self.vertices[i] = vertices
@@ -1,6 +1,10 @@
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
 from kivy.graphics import PushMatrix, PopMatrix, Translate
+import numpy as np
+
+# this is the amount of time during which an entity bounces in sec
+BOUNCE_TIME = 0.15
 
 class Entity(InstructionGroup):
     def __init__(self):
@@ -9,7 +13,8 @@ class Entity(InstructionGroup):
     def draw_graphics(self):
         self.add(self.graphic)
 
-    def on_beat(self, map, music, movement):
+    # called after a beat, once the state this entity draws has changed
+    def on_beat(self):
         pass
 
     def on_update(self, dt=None):
@@ -21,3 +26,70 @@ class EntityGraphic(InstructionGroup):
 
     def on_update(self):
         pass
+
+# Moves entity graphics towards their goal positions (in tiles) and bounces
+# them, all at once: positions, goals, speeds and bounce progress of every
+# entity are kept in arrays with one row per entity. Each frame they advance
+# in one step, and only the rectangles whose drawn position changed get written.
+class MotionSystem(object):
+    def __init__(self):
+        super(MotionSystem, self).__init__()
+        self.rects = []
+        self.pos = np.zeros((0, 2))
+        self.goal = np.zeros((0, 2))
+        self.speed = np.zeros(0) # tiles per second
+        self.bounce_prog = np.zeros(0) # bouncing while <= 1
+        self.bounce_scale = np.zeros(0) # height of the bounce
+        self.drawn = np.zeros((0, 2)) # world (x, y) last written to each rect
+
+    # rect is drawn at position (row, col) in world units. Returns the entity's index.
+    def add(self, rect, position, speed):
+        self.rects.append(rect)
+        self.pos = np.vstack((self.pos, [position]))
+        self.goal = np.vstack((self.goal, [position]))
+        self.speed = np.append(self.speed, speed)
+        self.bounce_prog = np.append(self.bounce_prog, 2.0)
+        self.bounce_scale = np.append(self.bounce_scale, 1.0)
+        self.drawn = np.vstack((self.drawn, [(position[1], -position[0])]))
+        return len(self.rects) - 1
+
+    def get_goal(self, index):
+        return self.goal[index]
+
+    def set_goal(self, index, position):
+        self.goal[index] = position
+
+    # every entity is at its goal right away, without bouncing
+    def snap(self):
+        self.pos[:] = self.goal
+        self.bounce_prog[:] = 2.0
+
+    def start_bounce(self, index, scale = 1.0):
+        self.bounce_prog[index] = 0
+        self.bounce_scale[index] = scale
+
+    def set_bounce_scale(self, index, scale):
+        self.bounce_scale[index] = scale
+
+    def on_update(self, dt):
+        self.bounce_prog += dt / BOUNCE_TIME
+
+        disp = self.goal - self.pos
+        dist = np.sqrt(np.sum(disp ** 2, axis=1))
+        step = dt * self.speed
+        arrived = dist <= step
+        self.pos[arrived] = self.goal[arrived]
+        moving = ~arrived
+        self.pos[moving] += disp[moving] * (step[moving] / dist[moving])[:, np.newaxis]
+
+        p = self.bounce_prog
+        deltay = np.where(p <= 1, self.bounce_scale * (p ** 2 - p), 0)
+
+        # world x is col, world y is -row
+        x = self.pos[:, 1]
+        y = -(self.pos[:, 0] + deltay)
+        changed = np.flatnonzero((x != self.drawn[:, 0]) | (y != self.drawn[:, 1]))
+        for i in changed:
+            self.rects[i].pos = (x[i], y[i])
+        self.drawn[changed, 0] = x[changed]
+        self.drawn[changed, 1] = y[changed]
@@ -0,0 +1,330 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from common.core import run
+from common.audio import Audio
+from common.wavesrc import WaveFile
+from common.note import midi_to_frequency
+from common.clock import DispatchStats, kTicksPerQuarter
+from kivy.app import App
+
+from game import Game
+from replay import BEAT_ON_EXACT
+from screen_loader import WORLD
+from config import FRAME_BUDGET_MS, AUDIO_LOAD_BUDGET
+
+# Plays a real level of the game for a number of beats and checks that it
+# stays within its frame budget: the p99 of how long each frame's on_update
+# takes, and the p99 of the audio load (how long a buffer takes to generate,
+# as a fraction of how long it plays). Callback costs are taken from the
+# level's scheduler stats. They are reported per command and per beat, but
+# aren't held to a budget.
+#
+# The game runs in its window, as usual, but on a VirtualAudio instead of the
+# sound card. The player is scripted: one move per beat (u, d, l, r, or . to
+# stand still), cycled, and a voice that sings the level's melodies, one note
+# a beat, or a recorded voice track (a mono wav file).
+#
+# Run it with:
+#   python frame_budget.py [level name]
+# Options: --beats <n>, --warmup <beats not measured at the start>,
+# --moves <script>, --voice <wav file>, --frame-budget <ms>,
+# --audio-budget <fraction> and --json <file> to write the results there.
+# Going over either budget makes the exit status 1.
+
+FRAME_PERIOD = 1 / 60 # seconds of audio that play every frame
+DEFAULT_BEATS = 64
+DEFAULT_WARMUP = 2 # textures load and caches fill
+DEFAULT_MOVES = "rrll"
+MOVE_KEYS = {"u": "up", "d": "down", "l": "left", "r": "right"}
+
+VOICE_GAIN = 0.3
+NOTE_LENGTH = 0.8 # fraction of the beat the voice sings for
+RECORDS_PER_BEAT = 16 # room in the scheduler's stats, so none get overwritten
+
+
+# Stands in for Audio without a sound card. Every on_update plays FRAME_PERIOD
+# seconds of audio to nowhere, in buffers of Audio.buffer_size, and hears as
+# much of voice (a mono WaveSource, or silence if None). Audio time only passes
+# as the game updates, so the game plays the same however long frames take.
+class VirtualAudio(object):
+    def __init__(self, num_channels, listen_func = None, input_func = None, num_input_channels = 1):
+        super(VirtualAudio, self).__init__()
+
+        assert(num_channels == 1 or num_channels == 2)
+        assert(num_input_channels == 1)
+        self.num_channels = num_channels
+        self.listen_func = listen_func
+        self.input_func = input_func
+        self.num_input_channels = num_input_channels
+
+        self.voice = None
+        self.generator = None
+        self.cpu_time = 0
+
+        self.frame = 0 # frames played so far
+        self.due_frames = 0. # frames that should have played by now
+        self.buffer_times = [] # (first frame, seconds it took to generate) of each buffer
+
+    def close(self):
+        pass
+
+    def set_generator(self, gen):
+        self.generator = gen
+
+    # same as Audio.get_cpu_load
+    def get_cpu_load(self):
+        return 1000 * self.cpu_time
+
+    def on_update(self):
+        self.due_frames += FRAME_PERIOD * Audio.sample_rate
+        while self.frame + Audio.buffer_size <= self.due_frames:
+            self.play_buffer()
+
+    def play_buffer(self):
+        num_frames = Audio.buffer_size
+
+        if self.input_func:
+            frames = np.zeros(num_frames, dtype=np.float32)
+            if self.voice:
+                data = self.voice.get_frames(self.frame, self.frame + num_frames)
+                frames[:len(data)] = data
+            self.input_func(frames, self.num_input_channels)
+
+        if self.generator:
+            t_start = time.perf_counter()
+            data, continue_flag = self.generator.generate(num_frames, self.num_channels)
+            dt = time.perf_counter() - t_start
+
+            assert len(data) == num_frames * self.num_channels, \
+                "asked for (%d * %d) frames but got %d" % (num_frames, self.num_channels, len(data))
+            self.buffer_times.append((self.frame, dt))
+            self.cpu_time = 0.9 * self.cpu_time + 0.1 * dt
+
+            if self.listen_func:
+                self.listen_func(data, self.num_channels)
+            if not continue_flag:
+                self.generator = None
+
+        self.frame += num_frames
+
+
+# A voice singing notes (midi pitches, 0 for a rest) one a beat, on the beats
+# of sched. Same interface as WaveFile, so it can be the voice of a VirtualAudio.
+class SyntheticVoice(object):
+    def __init__(self, notes, sched):
+        super(SyntheticVoice, self).__init__()
+        self.notes = np.array(notes)
+        self.sched = sched
+        self.beat_frames = [0] # first frame of each beat, as far as asked for
+
+    def get_frames(self, start_frame, end_frame):
+        while self.beat_frames[-1] < end_frame:
+            tick = len(self.beat_frames) * kTicksPerQuarter
+            self.beat_frames.append(self.sched.tick_to_frame(tick))
+        beat_frames = np.array(self.beat_frames)
+
+        frames = np.arange(start_frame, end_frame)
+        beat = np.searchsorted(beat_frames, frames, side='right') - 1
+        beat_start = beat_frames[beat]
+        beat_length = beat_frames[beat + 1] - beat_start
+
+        notes = self.notes[beat % len(self.notes)]
+        singing = (notes != 0) & (frames - beat_start < NOTE_LENGTH * beat_length)
+        phase = 2 * np.pi * midi_to_frequency(notes) * frames / Audio.sample_rate
+        return (VOICE_GAIN * singing * np.sin(phase)).astype(np.float32)
+
+    def get_num_channels(self):
+        return 1
+
+
+# The game, started on the level of a BudgetRun, with scripted keys. It times
+# every on_update, and stops the app once the run has all its beats.
+class BudgetGame(Game):
+    def __init__(self, budget_run):
+        super(BudgetGame, self).__init__(VirtualAudio, budget_run.screen_index)
+        self.budget_run = budget_run
+        self.level = self.screen
+
+        self.level.sched.stats = DispatchStats(RECORDS_PER_BEAT * (budget_run.total_beats() + 1))
+        self.audio.voice = budget_run.make_voice(self.level)
+
+        self.beat = 0 # beats started so far
+        self.frame_times = [] # (beat, seconds the frame took) of each frame
+        self.done = False
+
+        self.move_beat = 0 # beat of the next scripted move
+        self.held_key = None
+        self.release_frame = 0
+
+    def on_command(self, kind):
+        super(BudgetGame, self).on_command(kind)
+        if kind == BEAT_ON_EXACT:
+            self.beat += 1
+
+    def on_update(self):
+        if self.done:
+            return
+        self.play_moves()
+
+        t_start = time.perf_counter()
+        super(BudgetGame, self).on_update()
+        self.frame_times.append((self.beat, time.perf_counter() - t_start))
+
+        # the level can also end early, with the player at the exit
+        if self.beat > self.budget_run.total_beats() or self.screen is not self.level:
+            self.done = True
+            self.budget_run.finish(self)
+            App.get_running_app().stop()
+
+    # press each beat's key on its beat, and let go half a beat later
+    def play_moves(self):
+        sched = self.level.sched
+        if self.held_key and sched.cur_frame >= self.release_frame:
+            self.release_key((0, self.held_key))
+            self.held_key = None
+
+        beat_tick = self.move_beat * kTicksPerQuarter
+        if sched.cur_frame >= sched.tick_to_frame(beat_tick):
+            moves = self.budget_run.moves
+            move = moves[self.move_beat % len(moves)]
+            if move in MOVE_KEYS and not self.held_key:
+                self.held_key = MOVE_KEYS[move]
+                self.release_frame = sched.tick_to_frame(beat_tick + kTicksPerQuarter // 2)
+                self.press_key((0, self.held_key), [])
+            self.move_beat += 1
+
+
+# stats of values: count, p50, p99 and max
+def summarize(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {"count": 0, "p50": 0., "p99": 0., "max": 0.}
+    return {"count": len(values),
+            "p50": float(np.percentile(values, 50)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(np.max(values))}
+
+
+# One run of a level: the settings, and the results once the game finished it
+class BudgetRun(object):
+    def __init__(self, screen_index, beats, warmup = DEFAULT_WARMUP, moves = DEFAULT_MOVES, voice_path = None):
+        super(BudgetRun, self).__init__()
+        self.screen_index = screen_index
+        self.beats = beats
+        self.warmup = warmup
+        self.moves = moves
+        self.voice_path = voice_path
+        self.results = None
+
+    def total_beats(self):
+        return self.warmup + self.beats
+
+    # the recorded voice track, or else the level's melodies, one after another
+    def make_voice(self, level):
+        if self.voice_path:
+            return WaveFile(self.voice_path)
+        notes = [note for state in level.sim.enemy_groups for note in state.melody]
+        return SyntheticVoice(notes or [0], level.sched)
+
+    # plays the level, and returns the results (None if the game crashed)
+    def play(self):
+        run(lambda: BudgetGame(self))
+        return self.results
+
+    # everything after the warmup beats, in ms (audio load as a fraction)
+    def finish(self, game):
+        level = game.level
+        sched = level.sched
+        start_frame = sched.tick_to_frame(self.warmup * kTicksPerQuarter)
+        beat_frames = [sched.tick_to_frame(b * kTicksPerQuarter) for b in range(self.warmup, self.total_beats() + 1)]
+        buffer_seconds = Audio.buffer_size / Audio.sample_rate
+
+        frame_times = [dt * 1000 for beat, dt in game.frame_times if beat > self.warmup]
+        audio_load = [dt / buffer_seconds for frame, dt in game.audio.buffer_times
+                      if start_frame <= frame < beat_frames[-1]]
+
+        # callbacks dispatched on measured beats, by command and by beat
+        records = sched.stats.get_records()
+        measured = (records['dispatch_frame'] >= start_frame) & (records['dispatch_frame'] < beat_frames[-1])
+        names = np.array(records['name'])[measured]
+        durations = records['duration'][measured] * 1000
+        beats = np.searchsorted(beat_frames, records['dispatch_frame'][measured], side='right') - 1
+        per_beat = np.bincount(beats, weights=durations, minlength=self.beats)
+
+        self.results = {
+            "level": level.level_name,
+            "beats": max(game.beat - self.warmup - 1, 0),
+            "level_ended": game.screen is not level,
+            "frame_ms": summarize(frame_times),
+            "audio_load": summarize(audio_load),
+            "callbacks_per_beat_ms": summarize(per_beat),
+            "callbacks_ms": {name: summarize(durations[names == name]) for name in sorted(set(names))},
+        }
+
+
+# (what, p99, budget) of each budget results go over
+def over_budget(results, frame_budget, audio_budget):
+    over = []
+    if results["frame_ms"]["p99"] > frame_budget:
+        over.append(("frame time (ms)", results["frame_ms"]["p99"], frame_budget))
+    if results["audio_load"]["p99"] > audio_budget:
+        over.append(("audio load", results["audio_load"]["p99"], audio_budget))
+    return over
+
+def print_results(results):
+    print("\n%s: %d beats%s" % (results["level"], results["beats"],
+                                " (the player reached the exit)" if results["level_ended"] else ""))
+    print("%-40s %8s %8s %8s %8s" % ("", "count", "p50", "p99", "max"))
+    rows = [("frame time (ms)", results["frame_ms"]),
+            ("audio load", results["audio_load"]),
+            ("callbacks per beat (ms)", results["callbacks_per_beat_ms"])]
+    rows += [("  " + name, stats) for name, stats in sorted(results["callbacks_ms"].items())]
+    for what, stats in rows:
+        print("%-40s %8d %8.3f %8.3f %8.3f" % (what, stats["count"], stats["p50"], stats["p99"], stats["max"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Play a level and check it keeps within its frame budget")
+    parser.add_argument("level", nargs="?", help="name of the level (default: the first one)")
+    parser.add_argument("--beats", type=int, default=DEFAULT_BEATS)
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP)
+    parser.add_argument("--moves", default=DEFAULT_MOVES, help="a move each beat, cycled: u, d, l, r or .")
+    parser.add_argument("--voice", help="a mono wav file to sing instead of the level's melodies")
+    parser.add_argument("--frame-budget", type=float, default=FRAME_BUDGET_MS, help="p99 frame time (ms)")
+    parser.add_argument("--audio-budget", type=float, default=AUDIO_LOAD_BUDGET, help="p99 audio load")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with open(WORLD + "/game_info.txt") as game_info:
+        screens = [line.strip().split(" ") for line in game_info]
+    levels = [i for i, (screen_type, name) in enumerate(screens)
+              if screen_type == "level" and args.level in (None, name)]
+    if not levels:
+        parser.error("no level named %s in %s" % (args.level, WORLD))
+    if not args.moves or any(move not in MOVE_KEYS and move != "." for move in args.moves):
+        parser.error("moves must be made of u, d, l, r and .")
+    if args.voice and WaveFile(args.voice).get_num_channels() != 1:
+        parser.error("the voice track must be mono")
+
+    results = BudgetRun(levels[0], args.beats, args.warmup, args.moves, args.voice).play()
+    if results is None:
+        print("the game stopped before finishing the run")
+        sys.exit(2)
+
+    print_results(results)
+    over = over_budget(results, args.frame_budget, args.audio_budget)
+    results["budgets"] = {"frame_ms": args.frame_budget, "audio_load": args.audio_budget}
+    results["over_budget"] = [what for what, p99, budget in over]
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    for what, p99, budget in over:
+        print("over budget: p99 %s is %.3f, budget %.3f" % (what, p99, budget))
+    sys.exit(1 if over else 0)
@@ -1,39 +1,59 @@
-from common.core import BaseWidget, run, lookup
+from common.core import BaseWidget, run, lookup, register_terminate_func
 from common.audio import Audio
 from common.mixer import Mixer
 from common.wavegen import WaveGenerator
-from common.wavesrc import WaveBuffer, WaveFile, make_wave_buffers
-from common.clock import SimpleTempoMap, AudioScheduler, kTicksPerQuarter, quantize_tick_up
+from common.automation import ScheduledGenerator
+from common.clock import AudioScheduler, kTicksPerQuarter, quantize_tick_up
 
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
 from kivy.graphics import PushMatrix, PopMatrix
 from kivy.core.window import Window
 from kivy.clock import Clock as kivyClock
+from common.kivyparticle import ParticleSystem
 
 from map import Map
 from voice_controller import VoiceController
 from keyboard_controller import KeyboardController
 from player import Player
-from enemy_group import EnemyGroup, enemy_groups_from_spec
+from enemy_group import EnemyGroup
+from enemy import ProjectileLayer
+from entity import MotionSystem
+from danger_preview import DangerPreview
+from level_driver import LevelDriver
+from replay import InputRecorder, InputPlayer, read_log, key_value, \
+    BEAT_ON, BEAT_ON_EXACT, HALF_BEAT, BEAT_OFF, KEY_DOWN, KEY_UP, PITCH, CHECK
+from screen_loader import WORLD, ScreenLoader
+from sprites import get_texture
 from beat_bar import BeatBar
 from pitch_bar import PitchBar
-from config import EPSILON_BEFORE, EPSILON_AFTER, HALF_BEAT_TICKS
+from config import EPSILON_BEFORE, EPSILON_AFTER, HALF_BEAT_TICKS, SCHED_STATS_FILE, LEVEL_START_BEAT, \
+    INPUT_LOG_FILE, REPLAY_FILE, SHOW_DANGER_PREVIEW
 
 import numpy as np
-
-WORLD = "data/basic_world"
+import time
 
 MAP_WIDTH_RATIO = 1
 MAP_HEIGHT_RATIO = .8
 
-RESET_PAUSE_TIME = 2 # total time spent between death and moving again
-RESET_MOVE_BACK_TIME = 1 # time at which the player moves back to start
-
 SPLASH_WIDTH_TO_HEIGHT = 16/9
 
+# celebratory particles when enemies get pacified, in world units (tiles)
+PACIFY_BURST_SPRITE = "./data/sprites/note_proj_transp.png"
+PACIFY_BURST = dict(max_num_particles=4000, life_span=0.8, life_span_variance=0.3,
+                    start_size=0.35, start_size_variance=0.1, end_size=0.05, end_size_variance=0.02,
+                    emit_angle=np.pi / 2, emit_angle_variance=np.pi,
+                    emitter_x_variance=0.1, emitter_y_variance=0.1,
+                    speed=4, speed_variance=2, gravity_y=-6,
+                    radial_acceleration=0, tangential_acceleration=1, tangential_acceleration_variance=2,
+                    start_rotation_variance=np.pi, end_rotation_variance=np.pi,
+                    start_color=[1, 0.85, 0.3, 1], start_color_variance=[0.2, 0.2, 0.2, 0],
+                    end_color=[1, 0.5, 0.8, 0], end_color_variance=[0.2, 0.2, 0.2, 0],
+                    update_interval=0)
+
+# data is a SplashData
 class SplashScreen(InstructionGroup):
-    def __init__(self, splash_name, audio, game):
+    def __init__(self, data, audio, game):
         super(SplashScreen, self).__init__()
         self.game = game
 
@@ -50,10 +70,11 @@ class SplashScreen(InstructionGroup):
         print('splash screen size: ' + str(img_size))
         print('splash screen position: ' + str(img_pos))
         print('window size: ' + str(Window.size))
-        self.rect = Rectangle(pos=img_pos, size=img_size)
-        self.rect.source = "data/sprites/" + splash_name
+        self.rect = Rectangle(pos=img_pos, size=img_size, texture=get_texture(data.sprite))
         self.add(self.rect)
 
+        self.start_time = time.time()
+
     def unload(self):
         # TODO: clean up anything that needs cleaning up before this splash screen can
         # be removed. This includes removing any audio or scheduler callbacks
@@ -62,174 +83,240 @@ class SplashScreen(InstructionGroup):
     def on_key_down(self, keycode, modifiers):
         self.game.next_screen()
 
-    def receive_audio(self, frames, num_channels):
+    def receive_pitch(self):
+        pass
+
+    # there is no audio timeline, so frames are counted from when the screen came up
+    def get_frame(self):
+        return int((time.time() - self.start_time) * Audio.sample_rate)
+
+    def on_layout(self, win_size):
         pass
 
     def on_update(self):
         self.rect.size = Window.size
 
+# data is a LevelData, with everything the level needs from disk already loaded
 class Level(InstructionGroup):
-    def __init__(self, level_name, audio, music_controller, movement_controller, game):
+    def __init__(self, data, audio, music_controller, movement_controller, game):
         super(Level, self).__init__()
         self.game = game
         self.audio = audio
+        self.level_name = data.name
         self.mixer = Mixer()
-        with open(WORLD + "/" + level_name + "/music_timing.txt") as f:
-            tempo = int(f.readline().strip())
-            self.bg_music_beats_per_loop = int(f.readline().strip())
-        self.tempo_map = SimpleTempoMap(tempo)
+        self.bg_music_beats_per_loop = data.bg_music_beats_per_loop
+
+        self.tempo_map = data.tempo_map
         self.sched = AudioScheduler(self.tempo_map)
         self.audio.set_generator(self.sched)
         self.sched.set_generator(self.mixer)
 
-        self.bg_music_file = WaveFile(WORLD + "/" + level_name + "/background.wav")
+        self.bg_music_file = data.bg_music
         self.bg_music_gen = None
         self.bg_music_reset(0, None) # start music now
 
-        self.music_controller = music_controller
-        self.movement_controller = movement_controller
+        # the game rules, and the beats and inputs that run them. Everything
+        # below just draws (and plays) them
+        self.sim = data.sim
+        self.driver = LevelDriver(self.sim, data.tempo, music_controller, movement_controller)
 
-        self.music_controller.music.set_tempo(tempo)
-
-        self.map = Map(WORLD + "/" + level_name + "/advanced_map.txt", MAP_WIDTH_RATIO, MAP_HEIGHT_RATIO)
+        # the map and everything on it is drawn through the map's camera
+        self.map = Map(self.sim.map, MAP_WIDTH_RATIO, MAP_HEIGHT_RATIO, data.variants)
+        self.add(self.map.camera_start)
         self.add(self.map)
 
+        # squares that will be dangerous on the next beat
+        self.danger_preview = None
+        if SHOW_DANGER_PREVIEW:
+            self.danger_preview = DangerPreview(self.sim, self.map)
+            self.add(self.danger_preview)
+
         # pitch bar must be added AFTER enemy groups
         self.pitch_bar = PitchBar(57, MAP_WIDTH_RATIO, 1 - MAP_HEIGHT_RATIO)
-        self.music_controller.pitch_bar = self.pitch_bar
+        music_controller.pitch_bar = self.pitch_bar
 
-        self.restart_pause_time_remaining = 0
+        # moves the player and enemy graphics
+        self.motion = MotionSystem()
 
-        self.player = Player(self.map)
+        self.player = Player(self.sim.player, self.map, self.motion)
         self.add(self.player)
 
-        self.enemy_groups = enemy_groups_from_spec(WORLD + "/" + level_name + "/enemies.json",
-                                                    self.map, self.mixer, self.pitch_bar)
+        self.bursts = ParticleSystem(None, texture=get_texture(PACIFY_BURST_SPRITE), **PACIFY_BURST)
+
+        self.enemy_groups = [EnemyGroup(state, self.map, self.mixer, self.pitch_bar, self.motion, self.bursts)
+                             for state in self.sim.enemy_groups]
         for eg in self.enemy_groups:
             self.add(eg)
 
+        projectile_sprites = [None] * len(self.sim.projectiles.owners)
+        for state in self.sim.enemy_groups:
+            for enemy, desc in zip(state.enemies, state.description["enemies"]):
+                projectile_sprites[enemy.projectile_owner] = desc["sprites"]["projectile"]
+        self.projectiles = ProjectileLayer(self.sim.projectiles, self.map, projectile_sprites)
+        self.add(self.projectiles)
+        self.add(self.bursts.canvas)
+        self.add(self.map.camera_end)
+
         # pitch bar must be added last
         self.add(self.pitch_bar)
 
         next_beat = 0 # we know scheduler time is 0
-        next_pre_beat = next_beat - self.tempo_map.dt_to_tick(EPSILON_BEFORE)
-        next_post_beat = next_beat + self.tempo_map.dt_to_tick(EPSILON_AFTER)
+        next_pre_beat = self.offset_tick(next_beat, -EPSILON_BEFORE)
+        next_post_beat = self.offset_tick(next_beat, EPSILON_AFTER)
         next_half_beat = next_beat + HALF_BEAT_TICKS
 
-        self.cmd_beat_on = self.sched.post_at_tick(self.beat_on, next_pre_beat)
-        self.cmd_beat_on_exact = self.sched.post_at_tick(self.beat_on_exact, next_beat)
-        self.cmd_beat_off = self.sched.post_at_tick(self.beat_off, next_post_beat)
-        self.cmd_half_beat = self.sched.post_at_tick(self.half_beat, next_half_beat)
-
-        self.has_performed_beat_off = False
-
+        # only beat_note runs on the audio path. Everything else is game logic, so it
+        # is deferred to the main loop where it can't cause audio dropouts.
+        self.cmd_beat_note = self.sched.post_at_tick(self.beat_note, next_beat, split=False)
+        # beat_on and beat_off get the tick of their beat as arg, since the
+        # epsilon windows are in seconds and may span a different # of ticks each beat
+        self.cmd_beat_on = self.sched.post_at_tick(self.beat_on, next_pre_beat, next_beat, deferred=True)
+        self.cmd_beat_on_exact = self.sched.post_at_tick(self.beat_on_exact, next_beat, deferred=True)
+        self.cmd_beat_off = self.sched.post_at_tick(self.beat_off, next_post_beat, next_beat, deferred=True)
+        self.cmd_half_beat = self.sched.post_at_tick(self.half_beat, next_half_beat, deferred=True)
+
+        if self.game.start_beat:
+            self.seek(self.game.start_beat)
+
+    # jump the game to just before beat (see LevelSimulation.seek), and show
+    # everything where it is then. The music keeps going where it is.
+    def seek(self, beat):
+        self.driver.seek(beat)
+        for eg in self.enemy_groups:
+            eg.on_seek()
+        self.player.on_beat()
+        self.projectiles.on_beat()
+        if self.danger_preview is not None:
+            self.danger_preview.on_beat()
+        self.motion.snap()
+
+    # tick that is dt seconds after (or before, if negative) tick
+    def offset_tick(self, tick, dt):
+        return self.tempo_map.time_to_tick(self.tempo_map.tick_to_time(tick) + dt)
+
+    # audio commands below don't split the audio buffer. Instead, the generators
+    # they create start (and stop) on the exact frame of tick.
     def bg_music_reset(self, tick, _):
         self.cmd_bg_music_reset = self.sched.post_at_tick(self.bg_music_reset,
-                                    tick + kTicksPerQuarter * self.bg_music_beats_per_loop)
+                                    tick + kTicksPerQuarter * self.bg_music_beats_per_loop, split=False)
         if self.bg_music_gen:
-            self.bg_music_gen.release()
-        self.bg_music_gen = WaveGenerator(self.bg_music_file, loop=False) # we loop it explicitly
-        self.bg_music_gen.set_gain(3.0)
+            self.bg_music_gen.stop_at_tick(tick)
+        wave_gen = WaveGenerator(self.bg_music_file, loop=False) # we loop it explicitly
+        self.bg_music_gen = ScheduledGenerator(self.sched, wave_gen, gain=3.0)
+        self.bg_music_gen.start_at_tick(tick)
         self.mixer.add(self.bg_music_gen)
 
-    def beat_on(self, tick, _):
-        self.cmd_beat_on = self.sched.post_at_tick(self.beat_on, tick + kTicksPerQuarter)
-        self.map.start_new_timestep()
-        self.music_controller.beat_on()
-        self.movement_controller.beat_on()
+    def beat_note(self, tick, _):
+        self.cmd_beat_note = self.sched.post_at_tick(self.beat_note, tick + kTicksPerQuarter, split=False)
+        for eg in self.enemy_groups:
+            eg.play_beat_note(self.sched, tick)
+
+    def beat_on(self, tick, beat):
+        next_beat = beat + kTicksPerQuarter
+        self.cmd_beat_on = self.sched.post_at_tick(self.beat_on, self.offset_tick(next_beat, -EPSILON_BEFORE),
+                                                    next_beat, deferred=True)
+        self.game.on_command(BEAT_ON)
+        self.driver.beat_on()
 
         print("beat on")
 
     def beat_on_exact(self, tick, _):
-        self.cmd_beat_on_exact = self.sched.post_at_tick(self.beat_on_exact, tick + kTicksPerQuarter)
+        self.cmd_beat_on_exact = self.sched.post_at_tick(self.beat_on_exact, tick + kTicksPerQuarter, deferred=True)
+        self.game.on_command(BEAT_ON_EXACT)
         self.pitch_bar.on_enemy_note(0)
         for eg in self.enemy_groups:
             eg.on_beat_exact()
-            eg.on_beat(self.map, self.music_controller.get_music(), None)
+
+        self.driver.beat_on_exact()
+
+        for eg in self.enemy_groups:
+            eg.on_beat()
+        self.projectiles.on_beat()
+        if self.danger_preview is not None:
+            self.danger_preview.on_beat()
 
         self.player.on_beat_exact()
 
-        self.has_performed_beat_off = False
-        if self.movement_controller.is_ready():
+        if self.driver.is_ready():
             self.perform_beat_off()
 
         # self.player.on_beat_exact()
 
     def half_beat(self, tick, _):
-        self.cmd_half_beat = self.sched.post_at_tick(self.half_beat, tick + kTicksPerQuarter)
-        self.music_controller.beat_off()
-        music_input = self.music_controller.get_music()
+        self.cmd_half_beat = self.sched.post_at_tick(self.half_beat, tick + kTicksPerQuarter, deferred=True)
+        self.game.on_command(HALF_BEAT)
+        self.driver.half_beat()
 
         #for eg in self.enemy_groups:
         #    eg.on_half_beat(self.map, music_input)
 
-    def beat_off(self, tick, _):
-        self.cmd_beat_off = self.sched.post_at_tick(self.beat_off, tick + kTicksPerQuarter)
+    def beat_off(self, tick, beat):
+        next_beat = beat + kTicksPerQuarter
+        self.cmd_beat_off = self.sched.post_at_tick(self.beat_off, self.offset_tick(next_beat, EPSILON_AFTER),
+                                                    next_beat, deferred=True)
+        self.game.on_command(BEAT_OFF)
         self.perform_beat_off()
 
     def perform_beat_off(self):
-        if self.has_performed_beat_off:
+        at_exit = self.driver.beat_off()
+        if at_exit is None:
             return # already did it this round
-        self.has_performed_beat_off = True
-
-        self.movement_controller.beat_off()
-        movement = self.movement_controller.get_movement()
-
-        if self.restart_pause_time_remaining > 0:
-            # player can't move due to losing recently
-            self.restart_pause_time_remaining -= 1
-            if self.restart_pause_time_remaining == RESET_MOVE_BACK_TIME:
-                self.player.return_to_start()
-            elif self.restart_pause_time_remaining == 0:
-                self.player.set_disabled(False)
-        else:
-            self.player.on_beat(self.map, self.music_controller.get_music(), movement)
-
-            # handle game over
-            if self.map.is_square_dangerous(self.map.player_location()):
-                self.restart()
+        self.game.on_check(self.driver)
+        self.player.on_beat()
 
-            # handle move to next level
-            if self.map.is_player_at_exit():
-                self.game.next_screen()
+        # handle move to next level
+        if at_exit:
+            self.game.next_screen()
 
         print("beat off")
 
-    def receive_audio(self, frames, num_channels):
-        for eg in self.enemy_groups:
-            eg.check_note(self.map, self.music_controller.get_music(), False)
+    def receive_pitch(self):
+        # enemy groups show the results on their next on_update
+        self.driver.receive_pitch()
 
-    def restart(self):
-        self.player.set_disabled(True)
-        self.restart_pause_time_remaining = RESET_PAUSE_TIME
+    def get_frame(self):
+        return self.sched.cur_frame
 
     def unload(self):
+        self.sched.remove(self.cmd_beat_note)
         self.sched.remove(self.cmd_beat_off)
         self.sched.remove(self.cmd_beat_on)
         self.sched.remove(self.cmd_beat_on_exact)
         self.sched.remove(self.cmd_half_beat)
         self.sched.remove(self.cmd_bg_music_reset)
         self.bg_music_gen.release()
+        self.bursts.pause()
+
+        if SCHED_STATS_FILE:
+            self.sched.stats.export(SCHED_STATS_FILE % self.level_name)
 
     def on_key_down(self, keycode, modifiers):
-        if self.movement_controller.is_ready():
+        if self.driver.is_ready():
             self.perform_beat_off()
 
+    def on_layout(self, win_size):
+        self.map.on_layout(win_size)
+
     def on_update(self):
+        self.sched.on_update() # run game logic for beats that came due in the audio path
         self.map.on_update(kivyClock.frametime) # MUST UPDATE FIRST
         self.pitch_bar.on_update()
         #self.beat_bar.on_update()
         for eg in self.enemy_groups:
             eg.on_update(kivyClock.frametime)
+        self.projectiles.on_update()
         self.player.on_update()
+        self.motion.on_update(kivyClock.frametime)
 
 
+# make_audio makes the audio device (see VirtualAudio in frame_budget.py), and
+# screen_index is the screen in game_info.txt to start at
 class Game(BaseWidget):
-    def __init__(self):
+    def __init__(self, make_audio = Audio, screen_index = 0):
         super(Game, self).__init__()
 
         # audio setup
-        self.audio = Audio(2, input_func=self.receive_audio, num_input_channels = 1)
+        self.audio = make_audio(2, input_func=self.receive_audio, num_input_channels = 1)
 
         self.music_controller = VoiceController()
         self.movement_controller = KeyboardController()
@@ -239,19 +326,41 @@ class Game(BaseWidget):
         with open(WORLD + "/game_info.txt") as game_info:
             self.screens = [line.strip().split(" ") for line in game_info]
 
-        self.screen_index = 0
+        # the session's inputs can be recorded, or a recorded session played
+        # back in place of the keyboard and mic (see replay.py). A replay
+        # starts its levels where the recorded session did.
+        self.start_beat = LEVEL_START_BEAT
+        self.replay = None
+        if REPLAY_FILE:
+            log, self.start_beat = read_log(REPLAY_FILE)
+            self.replay = InputPlayer(log, self, self.start_beat)
+        self.recorder = None
+        if INPUT_LOG_FILE:
+            self.recorder = InputRecorder(INPUT_LOG_FILE, self.start_beat)
+            register_terminate_func(self.recorder.close)
+
+        self.screen_index = screen_index
         self.screen = None
+        self.next_screen_loader = None # loads the data of the screen after this one
         self.load_screen()
 
     def load_screen(self):
         screen_type, name = self.screens[self.screen_index]
+        if self.next_screen_loader is None:
+            self.next_screen_loader = ScreenLoader(self.screens[self.screen_index])
+        data = self.next_screen_loader.get()
+
         if screen_type == "splash":
-            self.screen = SplashScreen(name, self.audio, self)
+            self.screen = SplashScreen(data, self.audio, self)
         elif screen_type == "level":
-            self.screen = Level(name, self.audio, self.music_controller,
+            self.screen = Level(data, self.audio, self.music_controller,
                                 self.movement_controller, self)
         self.canvas.add(self.screen)
 
+        # load the next screen in the background while this one runs
+        next_index = (self.screen_index + 1) % len(self.screens)
+        self.next_screen_loader = ScreenLoader(self.screens[next_index])
+
     def unload_screen(self):
         self.screen.unload()
         self.canvas.remove(self.screen)
@@ -263,19 +372,65 @@ class Game(BaseWidget):
         self.load_screen()
 
     def on_update(self):
+        if self.replay:
+            self.replay.feed(self.screen.get_frame())
         self.screen.on_update()
         self.audio.on_update()
 
+    # the level calls this before each beat command, so that recorded inputs
+    # go in between the commands in the same order
+    def on_command(self, kind):
+        if self.recorder:
+            self.recorder.record(kind, self.screen_index, self.screen.get_frame())
+        if self.replay:
+            self.replay.on_command(kind)
+            self.report_desyncs()
+
+    # the level calls this once the player moved, with its LevelDriver
+    def on_check(self, driver):
+        if self.recorder:
+            self.recorder.record(CHECK, self.screen_index, self.screen.get_frame(), driver.digest())
+        if self.replay:
+            self.replay.on_check(driver.digest())
+            self.report_desyncs()
+
+    def report_desyncs(self):
+        for desync in self.replay.desyncs:
+            print("replay desync at " + desync)
+        del self.replay.desyncs[:]
+
+    # inputs from the devices are ignored while replaying
     def receive_audio(self, frames, num_channels):
-        self.music_controller.receive_audio(frames, num_channels)
-        self.screen.receive_audio(frames, num_channels)
+        if not self.replay:
+            self.receive_pitch(self.music_controller.detect_pitch(frames, num_channels))
 
     def on_key_down(self, keycode, modifiers):
+        if not self.replay:
+            self.press_key(keycode, modifiers)
+
+    def on_key_up(self, keycode):
+        if not self.replay:
+            self.release_key(keycode)
+
+    def receive_pitch(self, midi):
+        if self.recorder:
+            self.recorder.record(PITCH, self.screen_index, self.screen.get_frame(), midi)
+        self.music_controller.receive_pitch(midi)
+        self.screen.receive_pitch()
+
+    def press_key(self, keycode, modifiers):
+        if self.recorder:
+            self.recorder.record(KEY_DOWN, self.screen_index, self.screen.get_frame(), key_value(keycode))
         self.movement_controller.on_key_down(keycode, modifiers)
         self.screen.on_key_down(keycode, modifiers)
 
-    def on_key_up(self, keycode):
+    def release_key(self, keycode):
+        if self.recorder:
+            self.recorder.record(KEY_UP, self.screen_index, self.screen.get_frame(), key_value(keycode))
         self.movement_controller.on_key_up(keycode)
 
+    def on_layout(self, win_size):
+        self.screen.on_layout(win_size)
+
 if __name__ == '__main__':
     run(Game)
@@ -0,0 +1,62 @@
+import zlib
+
+# The game logic of a level, run the way Level's scheduler runs it: beat_on
+# (just before the beat), beat_on_exact (on the beat), half_beat, and beat_off
+# (just after the beat, or as soon as the player moves), with key presses and
+# pitches in between. It only touches the simulation and the controllers, so
+# a replay (see replay.py) can run it without a window or audio, and get the
+# same game as Level does.
+class LevelDriver(object):
+    def __init__(self, sim, tempo, music_controller, movement_controller):
+        super(LevelDriver, self).__init__()
+        self.sim = sim
+        self.music_controller = music_controller
+        self.movement_controller = movement_controller
+
+        self.music_controller.music.set_tempo(tempo)
+
+        self.has_performed_beat_off = False
+
+    def beat_on(self):
+        self.sim.beat_on()
+        self.music_controller.beat_on()
+        self.movement_controller.beat_on()
+
+    def beat_on_exact(self):
+        self.sim.beat_on_exact(self.music_controller.get_music)
+        self.has_performed_beat_off = False
+
+    def half_beat(self):
+        self.music_controller.beat_off()
+        self.music_controller.get_music()
+
+    # whether the player knows where to move, so beat_off needn't wait
+    def is_ready(self):
+        return self.movement_controller.is_ready()
+
+    # moves the player, once a beat. Returns None if the player already moved
+    # this beat, or else whether the player reached the exit.
+    def beat_off(self):
+        if self.has_performed_beat_off:
+            return None # already did it this round
+        self.has_performed_beat_off = True
+
+        self.movement_controller.beat_off()
+        return self.sim.beat_off(self.movement_controller.get_movement())
+
+    # the music controller got a new pitch
+    def receive_pitch(self):
+        self.sim.receive_audio(self.music_controller.get_music)
+
+    def seek(self, beat):
+        self.sim.seek(beat)
+        self.has_performed_beat_off = True # the player moves again on the next beat
+
+    # a number for everything the player has achieved so far: where the player
+    # is, deaths and pacified enemies. Two runs of a level that get the same
+    # digests after every beat_off played the same. Fits in a float32.
+    def digest(self):
+        sim = self.sim
+        state = (sim.beat, sim.player.get_position(), sim.deaths,
+                 [(eg.melody_complete, eg.get_pacified_enemies()) for eg in sim.enemy_groups])
+        return zlib.crc32(repr(state).encode()) & 0xffffff
@@ -0,0 +1,466 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import wave
+import zlib
+
+import numpy as np
+
+from common.audioconfig import SAMPLE_RATE
+from common.clock import SimpleTempoMap, TempoMap
+from common.wavesrc import WaveFile
+
+from simulation import MapState, ProjectileSystem, EnemyGroupState, LevelSimulation, \
+    MAP_TILES, PLAYER_START, EXIT, direction_map
+
+# A level pack is all of a level's files compiled into one file, so that a level
+# loads without parsing anything but a small header. The level directory is
+# checked while compiling, so a pack that loads is a level that works.
+#
+# Layout: PACK_MAGIC, then the format version and the header length (uint32s),
+# then the header (JSON), then the arrays. The header says where each array
+# starts and what its dtype and shape are. Arrays start on ARRAY_ALIGNMENT bytes,
+# so they can be used straight out of the memory-mapped file.
+#
+# The header also has the size and modification time of every file the pack
+# was compiled from. A pack that doesn't match its files any more is stale, and
+# the level is loaded from the files instead (see current_pack).
+#
+# Compile the levels of a world with:
+#   python level_pack.py [world dir]
+
+PACK_MAGIC = b'DUNJPACK'
+PACK_VERSION = 2
+PACK_NAME = 'level.pack' # in the level directory
+ARRAY_ALIGNMENT = 16
+
+# the files of a level directory that go into its pack. Only tempo_curve.txt
+# is optional.
+SOURCE_FILES = ("advanced_map.txt", "enemies.json", "music_timing.txt", "tempo_curve.txt", "background.wav")
+
+SPRITE_ROLES = ("angry", "pacified", "projectile")
+
+# attacks are stored as indices in here
+ATTACK_CODES = [""] + sorted(direction_map.keys())
+
+NUM_TILE_VARIANTS = 4
+
+# columns of the enemies table
+(E_GROUP, E_ID, E_ROW, E_COL, E_NOTE, E_ANGRY, E_PACIFIED, E_PROJECTILE,
+ E_MOTION_START, E_MOTION_COUNT, E_ATTACK_START, E_ATTACK_COUNT,
+ E_P_ATTACK_START, E_P_ATTACK_COUNT) = range(14)
+NUM_ENEMY_COLUMNS = 14
+
+
+class LevelPackError(Exception):
+    def __init__(self, level_dir, errors):
+        super(LevelPackError, self).__init__("%s:\n  %s" % (level_dir, "\n  ".join(errors)))
+        self.errors = errors
+
+
+def pack_path(level_dir):
+    return os.path.join(level_dir, PACK_NAME)
+
+# {name: [size, mtime in ns]} of the level's SOURCE_FILES, None for missing ones
+def source_stamps(level_dir):
+    stamps = {}
+    for name in SOURCE_FILES:
+        path = os.path.join(level_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamps[name] = [stat.st_size, stat.st_mtime_ns]
+        else:
+            stamps[name] = None
+    return stamps
+
+# the same level always gets the same floor variants
+def tile_variants(name, shape):
+    return np.random.RandomState(zlib.crc32(name.encode('utf-8'))).randint(0, NUM_TILE_VARIANTS, size=shape)
+
+
+#
+# Compiling
+#
+
+# read a level directory, checking everything. Returns (header, arrays) for
+# write_pack. Raises a LevelPackError listing every problem found.
+def read_level(level_dir):
+    errors = []
+    name = os.path.basename(os.path.normpath(level_dir))
+    # before reading, so a file changed while compiling makes the pack stale
+    header = {"name": name, "sources": source_stamps(level_dir)}
+    arrays = {}
+
+    map = read_map(os.path.join(level_dir, "advanced_map.txt"), errors)
+    if map is not None:
+        header["player_start"] = list(map.player_start_loc)
+        arrays["tiles"] = map.grid
+        arrays["in_map"] = map.in_map
+        arrays["variants"] = tile_variants(name, map.grid.shape).astype(np.uint8)
+
+    read_music(level_dir, header, arrays, errors)
+
+    specs = read_json(os.path.join(level_dir, "enemies.json"), errors)
+    if specs is not None:
+        read_enemies(specs, map, header, arrays, errors)
+
+    if errors:
+        raise LevelPackError(level_dir, errors)
+    return header, arrays
+
+# the MapState of the map file, or None if it's unusable
+def read_map(path, errors):
+    if not os.path.exists(path):
+        errors.append("missing %s" % path)
+        return None
+    with open(path) as f:
+        rows = f.read().strip().split("\n")
+
+    ok = True
+    for r, row in enumerate(rows):
+        for c, kind in enumerate(row):
+            if kind not in MAP_TILES:
+                errors.append("%s: unknown tile %r at row %d, col %d" % (path, kind, r, c))
+                ok = False
+    starts = sum(row.count(PLAYER_START) for row in rows)
+    if starts != 1:
+        errors.append("%s: needs exactly one player start ('%s'), has %d" % (path, PLAYER_START, starts))
+        ok = False
+    if not any(EXIT in row for row in rows):
+        errors.append("%s: has no exit ('%s')" % (path, EXIT))
+    return MapState.from_rows(rows) if ok else None
+
+def read_json(path, errors):
+    if not os.path.exists(path):
+        errors.append("missing %s" % path)
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError as e:
+        errors.append("%s: %s" % (path, e))
+        return None
+
+def read_music(level_dir, header, arrays, errors):
+    path = os.path.join(level_dir, "music_timing.txt")
+    if not os.path.exists(path):
+        errors.append("missing %s" % path)
+    else:
+        with open(path) as f:
+            lines = f.read().split()
+        try:
+            header["tempo"], header["beats_per_loop"] = int(lines[0]), int(lines[1])
+            if header["tempo"] <= 0 or header["beats_per_loop"] <= 0:
+                errors.append("%s: tempo and beats per loop must be positive" % path)
+        except (IndexError, ValueError):
+            errors.append("%s: needs the tempo and the beats per loop" % path)
+
+    path = os.path.join(level_dir, "tempo_curve.txt")
+    header["tempo_curve"] = None
+    if os.path.exists(path):
+        try:
+            tempo_map = TempoMap(filepath=path)
+            header["tempo_curve"] = [[time, tick] for time, tick in zip(tempo_map.times.tolist(), tempo_map.ticks.tolist())]
+        except Exception as e:
+            errors.append("%s: bad tempo curve (%s)" % (path, e))
+
+    path = os.path.join(level_dir, "background.wav")
+    if not os.path.exists(path):
+        errors.append("missing %s" % path)
+        return
+    try:
+        with wave.open(path) as f:
+            sample_width, sample_rate = f.getsampwidth(), f.getframerate()
+    except Exception as e:
+        errors.append("%s: not a wave file (%s)" % (path, e))
+        return
+    if sample_width != 2 or sample_rate != SAMPLE_RATE:
+        errors.append("%s: must be 16 bit at %d Hz, is %d bit at %d Hz" %
+                      (path, SAMPLE_RATE, sample_width * 8, sample_rate))
+        return
+    wave_file = WaveFile(path)
+    header["audio"] = {"num_channels": wave_file.num_channels, "sample_rate": wave_file.sr}
+    arrays["audio"] = wave_file.get_frames(0, wave_file.end)
+
+def read_enemies(specs, map, header, arrays, errors):
+    sprites = []
+    groups = []
+    enemies = []
+    motions = []
+    attacks = []
+    p_attacks = []
+
+    def sprite_index(path, where):
+        if path not in sprites:
+            if not sprite_exists(path):
+                errors.append("%s: unknown sprite %s" % (where, path))
+            sprites.append(path)
+        return sprites.index(path)
+
+    def attack_codes(actions, where):
+        codes = []
+        for attack in actions:
+            if attack not in ATTACK_CODES:
+                errors.append("%s: unknown attack %r" % (where, attack))
+                attack = ""
+            codes.append(ATTACK_CODES.index(attack))
+        return codes
+
+    for g, spec in enumerate(specs):
+        where = "enemies.json group %d" % g
+        missing = [key for key in ("enemies", "melody", "pacify", "center", "sound_thresh", "mel_thresh")
+                   if key not in spec]
+        if missing:
+            errors.append("%s: missing %s" % (where, ", ".join(missing)))
+            continue
+        if spec["pacify"] not in ("individual", "all"):
+            errors.append("%s: pacify must be 'individual' or 'all'" % where)
+        # the melody's notes pacify the enemies one by one
+        elif spec["pacify"] == "all" and len(spec["melody"]) != len(spec["enemies"]):
+            errors.append("%s: melody has %d notes, but the group has %d enemies" %
+                          (where, len(spec["melody"]), len(spec["enemies"])))
+
+        group = dict((key, value) for key, value in spec.items() if key != "enemies")
+        group["num_enemies"] = len(spec["enemies"])
+        groups.append(group)
+
+        for i, desc in enumerate(spec["enemies"]):
+            where = "enemies.json group %d enemy %d" % (g, i)
+            missing = [key for key in ("id", "init_pos", "motions", "attacks", "note", "sprites") if key not in desc]
+            missing += ["sprites.%s" % role for role in SPRITE_ROLES if role not in desc.get("sprites", {})]
+            if missing:
+                errors.append("%s: missing %s" % (where, ", ".join(missing)))
+                continue
+            # views find enemies by id
+            if desc["id"] != i:
+                errors.append("%s: id must be %d (its index in the group), not %s" % (where, i, desc["id"]))
+
+            row, col = desc["init_pos"]
+            if map is not None and not (map.in_bounds((row, col))[0] and map.in_map[row, col]):
+                errors.append("%s: init_pos %s is outside of the map" % (where, desc["init_pos"]))
+            elif map is not None and not map.passable_mask[row, col]:
+                errors.append("%s: init_pos %s is inside a wall" % (where, desc["init_pos"]))
+
+            # everywhere the motion cycle takes the enemy must be on the map too
+            pos = (row, col)
+            for motion in desc["motions"]:
+                if len(motion) != 2:
+                    errors.append("%s: motion %s must be (rows, cols)" % (where, motion))
+                    break
+                pos = (pos[0] + motion[0], pos[1] + motion[1])
+                if map is None:
+                    continue
+                if not (map.in_bounds(pos)[0] and map.in_map[pos]):
+                    errors.append("%s: motions take it to %s, outside of the map" % (where, list(pos)))
+                    break
+                elif not map.passable_mask[pos]:
+                    errors.append("%s: motions take it to %s, inside a wall" % (where, list(pos)))
+                    break
+            # pacified enemies go through p_attacks in step with attacks
+            if desc.get("p_attacks") and len(desc["p_attacks"]) < len(desc["attacks"]):
+                errors.append("%s: p_attacks has %d entries, fewer than attacks (%d)" %
+                              (where, len(desc["p_attacks"]), len(desc["attacks"])))
+
+            enemy = [0] * NUM_ENEMY_COLUMNS
+            enemy[E_GROUP] = g
+            enemy[E_ID] = desc["id"]
+            enemy[E_ROW], enemy[E_COL] = row, col
+            enemy[E_NOTE] = desc["note"]
+            enemy[E_ANGRY] = sprite_index(desc["sprites"]["angry"], where)
+            enemy[E_PACIFIED] = sprite_index(desc["sprites"]["pacified"], where)
+            enemy[E_PROJECTILE] = sprite_index(desc["sprites"]["projectile"], where)
+            enemy[E_MOTION_START], enemy[E_MOTION_COUNT] = len(motions), len(desc["motions"])
+            motions += [tuple(motion)[:2] for motion in desc["motions"]]
+            enemy[E_ATTACK_START], enemy[E_ATTACK_COUNT] = len(attacks), len(desc["attacks"])
+            attacks += attack_codes(desc["attacks"], where)
+            if "p_attacks" in desc:
+                enemy[E_P_ATTACK_START], enemy[E_P_ATTACK_COUNT] = len(p_attacks), len(desc["p_attacks"])
+                p_attacks += attack_codes(desc["p_attacks"], where)
+            else:
+                enemy[E_P_ATTACK_START], enemy[E_P_ATTACK_COUNT] = len(p_attacks), -1
+            enemies.append(enemy)
+
+    header["groups"] = groups
+    header["sprites"] = sprites
+    arrays["enemies"] = np.array(enemies, dtype=np.int32).reshape(-1, NUM_ENEMY_COLUMNS)
+    arrays["motions"] = np.array(motions, dtype=np.int32).reshape(-1, 2)
+    arrays["attacks"] = np.array(attacks, dtype=np.int8)
+    arrays["p_attacks"] = np.array(p_attacks, dtype=np.int8)
+
+# sprites are found without regard to case, like the SpriteManager does
+def sprite_exists(path):
+    directory, name = os.path.split(path)
+    if not os.path.isdir(directory):
+        return False
+    return name.lower() in [f.lower() for f in os.listdir(directory)]
+
+def write_pack(path, header, arrays):
+    header = dict(header, version=PACK_VERSION, arrays={})
+    names = sorted(arrays.keys())
+
+    # array offsets depend on the header's length, which depends on the offsets
+    # (as text), so leave room for them to grow and write the header padded.
+    offset = 0
+    for name in names:
+        header["arrays"][name] = [0, arrays[name].dtype.str, list(arrays[name].shape)]
+    header_bytes = len(json.dumps(header).encode('utf-8')) + 16 * len(names) + 64
+    start = align(len(PACK_MAGIC) + 8 + header_bytes)
+
+    offset = start
+    for name in names:
+        header["arrays"][name][0] = offset
+        offset = align(offset + arrays[name].nbytes)
+
+    text = json.dumps(header).encode('utf-8')
+    assert len(text) <= header_bytes
+    text += b' ' * (header_bytes - len(text))
+
+    with open(path, 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(struct.pack('<II', PACK_VERSION, header_bytes))
+        f.write(text)
+        for name in names:
+            f.seek(header["arrays"][name][0])
+            f.write(np.ascontiguousarray(arrays[name]).tobytes())
+        f.truncate(offset)
+
+def align(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+def compile_level(level_dir, path = None):
+    header, arrays = read_level(level_dir)
+    if path is None:
+        path = pack_path(level_dir)
+    write_pack(path, header, arrays)
+    return path
+
+
+#
+# Loading
+#
+
+# a compiled level, memory-mapped. The arrays are read-only views into the file.
+class LevelPack(object):
+    def __init__(self, path):
+        super(LevelPack, self).__init__()
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise Exception("%s is not a level pack" % path)
+        version, header_bytes = struct.unpack_from('<II', self.mmap, len(PACK_MAGIC))
+        if version != PACK_VERSION:
+            raise Exception("%s is version %d, not %d. Recompile it." % (path, version, PACK_VERSION))
+        start = len(PACK_MAGIC) + 8
+        self.header = json.loads(self.mmap[start:start + header_bytes].decode('utf-8'))
+
+        self.arrays = {}
+        for name, (offset, dtype, shape) in self.header["arrays"].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            self.arrays[name] = np.frombuffer(self.mmap, dtype, count, offset).reshape(shape)
+
+        self.name = self.header["name"]
+        self.tempo = self.header["tempo"]
+        self.beats_per_loop = self.header["beats_per_loop"]
+
+    def variants(self):
+        return self.arrays["variants"]
+
+    # the background song, as a WaveSource straight out of the file
+    def bg_music(self):
+        return PackedWave(self.arrays["audio"], self.header["audio"]["num_channels"])
+
+    # the groups as they are in enemies.json
+    def enemy_specs(self):
+        arrays = self.arrays
+        sprites = self.header["sprites"]
+        specs = [dict((key, value) for key, value in group.items() if key != "num_enemies")
+                 for group in self.header["groups"]]
+        for spec in specs:
+            spec["enemies"] = []
+
+        def attacks(codes, start, count):
+            return [ATTACK_CODES[code] for code in codes[start:start + count].tolist()]
+
+        for enemy in arrays["enemies"].tolist():
+            desc = {
+                "id": enemy[E_ID],
+                "init_pos": [enemy[E_ROW], enemy[E_COL]],
+                "note": enemy[E_NOTE],
+                "sprites": {"angry": sprites[enemy[E_ANGRY]],
+                            "pacified": sprites[enemy[E_PACIFIED]],
+                            "projectile": sprites[enemy[E_PROJECTILE]]},
+                "motions": arrays["motions"][enemy[E_MOTION_START]:enemy[E_MOTION_START] + enemy[E_MOTION_COUNT]].tolist(),
+                "attacks": attacks(arrays["attacks"], enemy[E_ATTACK_START], enemy[E_ATTACK_COUNT]),
+            }
+            if enemy[E_P_ATTACK_COUNT] >= 0:
+                desc["p_attacks"] = attacks(arrays["p_attacks"], enemy[E_P_ATTACK_START], enemy[E_P_ATTACK_COUNT])
+            specs[enemy[E_GROUP]]["enemies"].append(desc)
+        return specs
+
+    def tempo_map(self):
+        if self.header["tempo_curve"] is None:
+            return SimpleTempoMap(self.tempo)
+        return TempoMap(self.header["tempo_curve"])
+
+    # a fresh LevelSimulation of the level
+    def simulation(self):
+        map = MapState(np.array(self.arrays["tiles"]), self.header["player_start"], np.array(self.arrays["in_map"]))
+        projectiles = ProjectileSystem()
+        enemy_groups = [EnemyGroupState(desc, map, projectiles) for desc in self.enemy_specs()]
+        return LevelSimulation(map, enemy_groups, projectiles)
+
+
+# the LevelPack of a level directory, or None if it has none or it's stale:
+# compiled by another version, or from files that have changed since
+def current_pack(level_dir):
+    path = pack_path(level_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        start = f.read(len(PACK_MAGIC) + 8)
+    if len(start) < len(PACK_MAGIC) + 8 or start[:len(PACK_MAGIC)] != PACK_MAGIC or \
+            struct.unpack_from('<I', start, len(PACK_MAGIC))[0] != PACK_VERSION:
+        return None
+    pack = LevelPack(path)
+    if pack.header["sources"] != source_stamps(level_dir):
+        return None
+    return pack
+
+
+# WaveSource for audio that is already decoded (ie, in a LevelPack)
+class PackedWave(object):
+    def __init__(self, data, num_channels):
+        super(PackedWave, self).__init__()
+        self.data = data
+        self.num_channels = num_channels
+
+    def get_frames(self, start_frame, end_frame):
+        return self.data[start_frame * self.num_channels : end_frame * self.num_channels]
+
+    def get_num_channels(self):
+        return self.num_channels
+
+
+# compile every level of the world in world_dir
+def compile_world(world_dir):
+    ok = True
+    with open(os.path.join(world_dir, "game_info.txt")) as f:
+        screens = [line.strip().split(" ") for line in f if line.strip()]
+    for screen_type, name in screens:
+        if screen_type != "level":
+            continue
+        try:
+            path = compile_level(os.path.join(world_dir, name))
+            print("wrote %s" % path)
+        except LevelPackError as e:
+            print("error in %s" % e)
+            ok = False
+    return ok
+
+if __name__ == '__main__':
+    world_dir = sys.argv[1] if len(sys.argv) > 1 else "data/basic_world"
+    sys.exit(0 if compile_world(world_dir) else 1)
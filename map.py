@@ -1,108 +1,199 @@
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
-from kivy.graphics import PushMatrix, PopMatrix
+from kivy.graphics import PushMatrix, PopMatrix, Translate, Scale
+from kivy.graphics import Fbo, ClearColor, ClearBuffers
 from kivy.core.window import Window
 import numpy as np
 
-from map_tile import MapTile, PLAYER_START
+from map_tile import MapTile
+from simulation import VACUUM
 
 VIEW_SPEED = 8
 
+TILES_PER_SCREEN = 15 # along the shorter side of the window
+
+CHUNK_SIZE = 8 # tiles per side of a map chunk
+VIEW_MARGIN = 2 # tiles beyond the edges of the screen that still get graphics
+
+# draws a CHUNK_SIZE x CHUNK_SIZE square of the map. Chunks that scroll out of
+# view are recycled for the ones scrolling in.
+# Tiles never change on their own, so they are baked into a texture (with an
+# Fbo) once, and the chunk is drawn as a single textured square.
+class MapChunk(InstructionGroup):
+    def __init__(self, map):
+        super(MapChunk, self).__init__()
+        self.map = map
+        self.key = None # (chunk row, chunk col)
+        self.resolution = None # texture pixels per tile
+
+        self.fbo = Fbo(size=(1, 1))
+        self.fbo.add(ClearColor(0, 0, 0, 0))
+        self.fbo.add(ClearBuffers())
+        self.tiles = [MapTile(map) for _ in range(CHUNK_SIZE * CHUNK_SIZE)]
+        for tile in self.tiles:
+            self.fbo.add(tile)
+
+        self.add(Color(1, 1, 1))
+        self.rect = Rectangle(size=(CHUNK_SIZE, CHUNK_SIZE))
+        self.add(self.rect)
+
+    def assign(self, key):
+        self.key = key
+        kinds = self.map.state.kinds
+        rows, cols = self.map.map_size()
+        for i, tile in enumerate(self.tiles):
+            r = key[0] * CHUNK_SIZE + i // CHUNK_SIZE
+            c = key[1] * CHUNK_SIZE + i % CHUNK_SIZE
+            # vacuum looks just like the background, so it isn't drawn
+            if r < rows and c < cols and kinds[r][c] != VACUUM:
+                tile.set_tile((r, c), kinds[r][c], self.map.variants[r, c])
+            else:
+                tile.hide()
+
+        # world position of the bottom left corner of the bottom left tile
+        self.rect.pos = self.map.tile_to_world(((key[0] + 1) * CHUNK_SIZE - 1, key[1] * CHUNK_SIZE))
+        self.bake()
+
+    # render the tiles into the chunk's texture, at the map's current resolution
+    def bake(self):
+        resolution = self.map.tile_resolution()
+        if resolution != self.resolution:
+            self.resolution = resolution
+            self.fbo.size = (CHUNK_SIZE * resolution, CHUNK_SIZE * resolution)
+            for i, tile in enumerate(self.tiles):
+                row, col = divmod(i, CHUNK_SIZE)
+                tile.place((col * resolution, (CHUNK_SIZE - 1 - row) * resolution), resolution)
+
+        self.fbo.draw()
+        self.rect.texture = self.fbo.texture
+
+
+# draws a MapState and scrolls the view to follow the player. Only the chunks
+# of the map around the view have graphics.
+#
+# The map and everything on it are drawn in world units: tile (row, col) is
+# the unit square with its bottom left corner at (col, -row). camera_start
+# (which must come before any of them) maps world units to pixels, and
+# camera_end must come after them. Scrolling only changes the camera.
 class Map(InstructionGroup):
-    def __init__(self, map_filename, width_ratio, height_ratio):
+    def __init__(self, state, width_ratio, height_ratio, variants = None):
         super(Map, self).__init__()
+        self.state = state
         self.width_ratio = width_ratio
         self.height_ratio = height_ratio
 
-        with open(map_filename) as f:
-            rows = f.read().strip().split("\n")
-        for r, row in enumerate(rows):
-            for c, kind in enumerate(row):
-                if kind == PLAYER_START:
-                    self.player_start_loc = (r, c)
-
-        self.view_center = np.array(self.player_start_loc)
-        self.view_goal = np.array(self.player_start_loc)
-
-        self.tiles = [[MapTile(r, c, kind, self) for c, kind in enumerate(row)]
-                        for r, row in enumerate(rows)]
-        for row in self.tiles:
-            for tile in row:
-                self.add(tile)
-
-        # initialize per-timestep variables
-        self.player_loc = self.player_start_loc
-        self.start_new_timestep()
-
-    def start_new_timestep(self):
-        self.enemy_map = {}
-        # don't reset player loc so that there is still a valid loc eventually
-        # self.player_loc = None
-
-    def add_enemy(self, position, enemy):
-        # TODO: maybe force projectiles to die?
-        position = tuple(position)
-        if position not in self.enemy_map:
-            self.enemy_map[position] = []
-        self.enemy_map[position].append(enemy)
-
-    def add_player(self, position, player):
-        # TODO: maybe call player callback
-        self.player_loc = tuple(position)
-        self.view_goal = np.array(self.player_loc)
-
-    def is_square_passable(self, position):
-        if 0 <= position[0] < len(self.tiles) and 0 <= position[1] < len(self.tiles[0]):
-            enemies = self.enemy_map.get(tuple(position), [])
-            for enemy in enemies:
-                if not enemy.is_passable():
-                    return False
-            return self.tiles[position[0]][position[1]].is_passable()
-        else:
-            print('outside of map')
-            return False # outside of map isn't passable
-
-    def is_square_dangerous(self, position):
-        if position is None:
-            return False
-        enemies = self.enemy_map.get(tuple(position), [])
-        return len(enemies) > 0
-
-    def is_player_at_exit(self):
-        if self.player_loc is None:
-            return False
-        return self.tiles[self.player_loc[0]][self.player_loc[1]].is_exit()
-
-    def player_location(self):
-        return self.player_loc
-
-    def player_start_location(self):
-        return self.player_start_loc
+        self.view_center = np.array(state.player_start_location())
+        self.view_goal = np.array(state.player_start_location())
+
+        self.translate = Translate()
+        self.scale = Scale()
+        self.camera_start = InstructionGroup()
+        self.camera_start.add(PushMatrix())
+        self.camera_start.add(self.translate)
+        self.camera_start.add(self.scale)
+        self.camera_end = PopMatrix()
+
+        # which floor sprite each tile uses. Random unless given.
+        if variants is None:
+            variants = np.random.randint(0, 4, size=state.map_size())
+        self.variants = variants
+
+        self.chunks = {} # (chunk row, chunk col) -> MapChunk on screen
+        self.spare_chunks = []
+        self.on_layout(Window.size)
+
+    # the window size changed
+    def on_layout(self, win_size):
+        self.window_size = win_size
+        self.tile_side = min(win_size) / TILES_PER_SCREEN
+        self.update_camera()
+
+        # chunks are baked at one texture pixel per screen pixel
+        for chunk in self.chunks.values():
+            if chunk.resolution != self.tile_resolution():
+                chunk.bake()
+
+    def tile_resolution(self):
+        return max(int(round(self.tile_side)), 1)
+
+    # call if the MapState's tiles changed, to redraw the chunk holding position
+    def on_tile_changed(self, position):
+        key = (position[0] // CHUNK_SIZE, position[1] // CHUNK_SIZE)
+        if key in self.chunks:
+            self.chunks[key].assign(key)
 
     def map_size(self):
-        return len(self.tiles), len(self.tiles[0])
+        return self.state.map_size()
 
     def tile_size(self):
-        size = np.min(Window.size) / 15
-        return size, size
+        return self.tile_side, self.tile_side
+
+    # bottom left corner of tile position, in world units
+    def tile_to_world(self, position):
+        return position[1], -position[0]
 
     def tile_to_pixels(self, position):
         row, col = position
-        tile_width, tile_height = self.tile_size()
-        return (Window.width * self.width_ratio / 2 + (col - self.view_center[1] - .5) * tile_width,
-                Window.height * (1 - self.height_ratio / 2) - (row - self.view_center[0] + .5) * tile_height)
+        width, height = self.window_size
+        return (width * self.width_ratio / 2 + (col - self.view_center[1] - .5) * self.tile_side,
+                height * (1 - self.height_ratio / 2) - (row - self.view_center[0] + .5) * self.tile_side)
+
+    # point the camera at view_center, and give the chunks around it graphics
+    def update_camera(self):
+        width, height = self.window_size
+        side = self.tile_side
+        self.translate.xy = (width * self.width_ratio / 2 - (self.view_center[1] + .5) * side,
+                             height * (1 - self.height_ratio / 2) + (self.view_center[0] - .5) * side)
+        self.scale.xyz = (side, side, 1)
+        self.update_chunks()
 
     def on_update(self, dt):
+        self.view_goal = np.array(self.state.player_location())
+
         disp = self.view_goal - self.view_center
         dist = np.linalg.norm(disp)
+        if dist == 0:
+            return
         if dist <= dt * VIEW_SPEED:
             # can move to goal this step
             self.view_center = self.view_goal
         else:
             move = disp * dt * VIEW_SPEED / dist
             self.view_center = self.view_center + move
-
-        # update all tiles
-        for row in self.tiles:
-            for tile in row:
-                tile.on_update()
+        self.update_camera()
+
+    # (first, last) chunk rows and cols that are on screen, or within VIEW_MARGIN of it
+    def visible_chunks(self):
+        width, height = self.window_size
+        side = self.tile_side
+        # inverse of tile_to_pixels for the screen edges
+        center_x = width * self.width_ratio / 2
+        center_y = height * (1 - self.height_ratio / 2)
+        first_row = self.view_center[0] - .5 - (height - center_y) / side - VIEW_MARGIN
+        last_row = self.view_center[0] - .5 + center_y / side + VIEW_MARGIN
+        first_col = self.view_center[1] + .5 - center_x / side - VIEW_MARGIN
+        last_col = self.view_center[1] + .5 + (width - center_x) / side + VIEW_MARGIN
+
+        rows, cols = self.map_size()
+        r0 = max(int(np.floor(first_row)) // CHUNK_SIZE, 0)
+        r1 = min(int(np.floor(last_row)) // CHUNK_SIZE, (rows - 1) // CHUNK_SIZE)
+        c0 = max(int(np.floor(first_col)) // CHUNK_SIZE, 0)
+        c1 = min(int(np.floor(last_col)) // CHUNK_SIZE, (cols - 1) // CHUNK_SIZE)
+        return r0, r1, c0, c1
+
+    # recycle chunks that went out of view for the ones that came into view
+    def update_chunks(self):
+        r0, r1, c0, c1 = self.visible_chunks()
+        for key in list(self.chunks.keys()):
+            if not (r0 <= key[0] <= r1 and c0 <= key[1] <= c1):
+                chunk = self.chunks.pop(key)
+                self.remove(chunk)
+                self.spare_chunks.append(chunk)
+
+        for cr in range(r0, r1 + 1):
+            for cc in range(c0, c1 + 1):
+                if (cr, cc) not in self.chunks:
+                    chunk = self.spare_chunks.pop() if self.spare_chunks else MapChunk(self)
+                    chunk.assign((cr, cc))
+                    self.chunks[(cr, cc)] = chunk
+                    self.add(chunk)
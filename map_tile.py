@@ -1,23 +1,11 @@
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
 from kivy.graphics import PushMatrix, PopMatrix
-from random import randint
 
-EMPTY = " "
-PLAYER_START = "p"
-EXIT = "e"
-WALL = "w"
-DANGER_FLOOR = "."
-PREVIEW_FLOOR = "-"
-SIDE_WALL = "s"
-SIDE_WALL2 = "2"
-CORNER_L = "l"
-CORNER_R = "r"
-VACUUM = "v"
-CORNER_LI = "c"
-CORNER_RI = "i"
+from sprites import set_sprite
 
-VALID_TILES = [EMPTY, PLAYER_START, EXIT, WALL]
+from simulation import EMPTY, PLAYER_START, EXIT, WALL, DANGER_FLOOR, PREVIEW_FLOOR, SIDE_WALL, \
+    SIDE_WALL2, CORNER_L, CORNER_R, VACUUM, CORNER_LI, CORNER_RI, VALID_TILES
 
 SPRITE_MAP = {
     WALL: 'wall_wall.png',
@@ -33,61 +21,62 @@ SPRITE_MAP = {
 
 SPRITE_PREFIX = './data/sprites/'
 
+# number of different looking floor tiles (any variant is used mod these)
+NUM_EMPTY_VARIANTS = 4
+NUM_DANGER_VARIANTS = 2
+
+# return the (rgb, sprite) to draw a tile of kind with. variant picks one of
+# the floor sprites, so the same tile always looks the same.
+# Vacuum isn't drawn at all, so it has no sprite.
+def tile_appearance(kind, variant):
+    if kind == PLAYER_START or kind == PREVIEW_FLOOR:
+        kind = EMPTY # neither looks any different from empty
+
+    if kind == EMPTY:
+        return (0.5, 0.5, 0.6), SPRITE_PREFIX + SPRITE_MAP[EMPTY] + str(1 + variant % NUM_EMPTY_VARIANTS) + '.png'
+    elif kind == DANGER_FLOOR:
+        return (1, 1, 1), SPRITE_PREFIX + SPRITE_MAP[EMPTY] + str(1 + variant % NUM_DANGER_VARIANTS) + '.png'
+    elif kind == VACUUM:
+        return (0, 0, 0), None
+    elif kind in SPRITE_MAP:
+        return (1, 1, 1), SPRITE_PREFIX + SPRITE_MAP[kind]
+    else:
+        raise Exception("Cannot draw tile with name: %s" % kind)
+
+# draws one tile of the map into its chunk's texture. Tiles are recycled as
+# the view scrolls, so a MapTile can be set to any tile, or hidden.
 class MapTile(InstructionGroup):
-    def __init__(self, row, col, kind, map):
+    def __init__(self, map):
         super(MapTile, self).__init__()
-        if kind == PLAYER_START:
-            kind = EMPTY # replace since player start doesn't matter
-        elif kind == PREVIEW_FLOOR:
-            kind = EMPTY # replace since preview floor should just look like empty
-        self.position = (row, col)
-        self.kind = kind
         self.map = map
-        self.sprite = None
-
-        location = self.map.tile_to_pixels(self.position)
-
-        if kind == EMPTY:
-            self.add(Color(0.5, 0.5, 0.6))
-            self.sprite = SPRITE_PREFIX + SPRITE_MAP[EMPTY] + str(randint(1, 4)) + '.png'
-
-        elif kind == DANGER_FLOOR:
-            self.add(Color(1,1,1))
-            self.sprite = SPRITE_PREFIX + SPRITE_MAP[EMPTY] + str(randint(1, 2)) + '.png'
-
-
-
-        elif kind == EXIT:
-            self.add(Color(1,1,1))
-            self.sprite = SPRITE_PREFIX + SPRITE_MAP[kind]
-
-        elif kind == WALL:
-            self.add(Color(1,1,1))
-            self.sprite = SPRITE_PREFIX + SPRITE_MAP[kind]
+        self.position = None
+        self.kind = None
+        self.side = 0 # in pixels of the chunk's texture
 
-            # self.sprite = SPRITE_PREFIX + SPRITE_MAP[kind] + str(randint(1, 4)) + '.png'
-
-        elif kind == VACUUM:
-            self.add(Color(0, 0, 0))
-
-        elif kind in ["s", "2", "l", "r", "c", "i"]:
-            self.add(Color(1, 1, 1))
-            self.sprite = SPRITE_PREFIX + SPRITE_MAP[kind]
-        else:
-            raise Exception("Cannot draw tile with name: %s" % kind)
-
-        self.rect = Rectangle(pos=location, size=self.map.tile_size())
-        if self.sprite:
-            self.rect.source = self.sprite
+        self.color = Color(1, 1, 1)
+        self.add(self.color)
+        self.rect = Rectangle(size=(0, 0))
         self.add(self.rect)
 
-    def is_passable(self):
-        return self.kind not in [WALL, SIDE_WALL, SIDE_WALL2, CORNER_R, CORNER_RI, CORNER_L, CORNER_LI]
-
-    def is_exit(self):
-        return self.kind == EXIT
-
-    def on_update(self):
-        location = self.map.tile_to_pixels(self.position)
-        self.rect.pos = location
-        self.rect.size = self.map.tile_size()
+    def set_tile(self, position, kind, variant):
+        self.position = position
+        self.kind = kind
+        rgb, sprite = tile_appearance(kind, variant)
+        self.color.rgb = rgb
+        if sprite:
+            set_sprite(self.rect, sprite)
+        else:
+            self.rect.texture = None
+        self.rect.size = (self.side, self.side)
+
+    # where in its chunk's texture this tile goes
+    def place(self, pos, side):
+        self.side = side
+        self.rect.pos = pos
+        if self.position is not None:
+            self.rect.size = (side, side)
+
+    def hide(self):
+        self.position = None
+        self.kind = None
+        self.rect.size = (0, 0)
@@ -1,6 +1,3 @@
-from common.core import lookup
-from time import time
-
 class MovementController(object):
     def __init__(self):
         self.movement = (0, 0)
@@ -1,4 +1,5 @@
 from config import POP_THRESHOLD_RATIO
+import copy
 
 PITCH_SUSTAIN_THRESHOLD = 5
 SUSTAIN_TRAILING_BUFFER = 2
@@ -19,6 +20,32 @@ class MusicController(object):
     def get_music(self):
         pass
 
+# takes pitches (one midi number per bit of input, 0 for none) and hands out
+# the Pitch music they make up
+class PitchController(MusicController):
+    def __init__(self):
+        super(PitchController, self).__init__()
+
+        self.music = Pitch()
+
+    def get_music(self):
+        #self.music.finalize()
+
+        music = copy.copy(self.music)
+        events = []
+        for event in self.music.events[::-1]:
+            if len(events) < 3:
+                events.insert(0, event)
+            if not event.is_noisy():
+                break
+        self.music.events = events
+        return music
+
+    def receive_pitch(self, midi):
+        self.music.add_pitch(midi)
+        if self.pitch_bar:
+            self.pitch_bar.on_player_note(midi)
+
 class Music:
     def __init__(self):
         self.events = []
@@ -0,0 +1,84 @@
+import numpy as np
+import aubio
+
+from common.audioconfig import SAMPLE_RATE
+from config import SILENCE_THRESHOLD
+
+# The mic's pitch detection, without any graphics, so it can run (and be
+# benchmarked) without a window. Requires aubio (pip install aubio).
+
+
+# First-in First-out buffer used for buffering audio data
+class FIFOBuffer(object):
+    def __init__(self, buf_size = 4096, buf_type = float):
+        super(FIFOBuffer, self).__init__()
+
+        self.buf_type = buf_type
+        self.buffer = np.zeros(buf_size, dtype=buf_type)
+        self.write_ptr = 0
+
+    # how much space is available for writing
+    def get_write_available(self):
+        return len(self.buffer) - self.write_ptr
+
+    # how much data is available for reading
+    def get_read_available(self):
+        return self.write_ptr
+
+    # write 'signal' into buffer
+    def write(self, signal):
+        amt = len(signal)
+        L = len(self.buffer)
+        assert(self.write_ptr + amt <= L)
+        self.buffer[self.write_ptr:self.write_ptr+amt] = signal
+        self.write_ptr += amt
+
+    # read 'amt' values from buffer
+    def read(self, amt):
+        assert(amt <= self.write_ptr)
+        out = self.buffer[:amt].copy()
+        remaining = self.write_ptr - amt
+        self.buffer[0:remaining] = self.buffer[amt:self.write_ptr]
+        self.write_ptr = remaining
+        return out
+
+
+
+class PitchDetector(object):
+    def __init__(self):
+        super(PitchDetector, self).__init__()
+        # number of frames to present to the pitch detector each time
+        self.buffer_size = 1024
+
+        # set up the pitch detector
+        self.pitch_o = aubio.pitch("yin", 2048, self.buffer_size, SAMPLE_RATE)
+        self.pitch_o.set_tolerance(.5)
+        self.pitch_o.set_unit("midi")
+        self.pitch_o.set_silence(SILENCE_THRESHOLD)
+
+        # buffer allows for always delivering a fixed buffer size to the pitch detector
+        self.buffer = FIFOBuffer(self.buffer_size * 8, buf_type=np.float32)
+
+        self.cur_pitch = 0
+
+    # Add incoming data to pitch detector. Return estimated pitch as floating point
+    # midi value.
+    # Returns 0 if a strong pitch is not found.
+    def write(self, signal):
+        conf = 0
+
+        self.buffer.write(signal) # insert data
+
+        # read data in the fixed chunk sizes, as many as possible.
+        # keep only the highest confidence estimate of the pitches found.
+        while self.buffer.get_read_available() > self.buffer_size:
+            p, c = self._process_window(self.buffer.read(self.buffer_size))
+            if c > conf:
+                self.cur_pitch = p
+        return self.cur_pitch
+
+    # helper function for finding the pitch of the fixed buffer signal.
+    def _process_window(self, signal):
+        pitch = self.pitch_o(signal)[0]
+        conf = self.pitch_o.get_confidence()
+        return pitch, conf
@@ -1,81 +1,71 @@
 from kivy.graphics import Color, Ellipse, Line, Rectangle
-from kivy.clock import Clock as kivyClock
 
 import numpy as np
 
 from entity import Entity, EntityGraphic
+from sprites import get_texture
 
 PLAYER_SPEED = 10
 
-# this is the amount of time during which the note bounces in sec
-BOUNCE_TIME = 0.15
+PLAYER_SPRITE = "./data/sprites/note_char_mouth.png"
+
 # maximum bounce height as a function of tile size
 MAX_BOUNCE_HEIGHT = 0.5
 
+# draws a PlayerState
 class Player(Entity):
-    def __init__(self, map):
+    def __init__(self, state, map, motion):
         super(Player, self).__init__()
-        self.map = map
-        self.position = map.player_start_location()
-        self.graphic = PlayerGraphic(self.position, map)
+        self.state = state
+        self.disabled = state.disabled
+        self.graphic = PlayerGraphic(state.get_position(), map, motion)
         self.draw_graphics()
 
     def on_beat_exact(self):
         self.graphic.start_bounce()
 
-    def on_beat(self, map, music, movement):
-        delta = movement
-
-        # collision detection
-        new_pos = (self.position[0] + delta[0], self.position[1] + delta[1])
-        if self.map.is_square_passable(new_pos):
-            self.position = new_pos
-            self.graphic.set_position(self.position)
-
-        map.add_player(self.position, self)
-
-    def get_position(self):
-        return self.position
-
-    def return_to_start(self):
-        self.position = self.map.player_start_location()
-        self.graphic.set_position(self.position)
-        self.map.add_player(self.position, self)
+    # catch up with the state after the player moved (or was reset)
+    def on_beat(self):
+        position = self.state.get_position()
+        if tuple(self.graphic.goal_position) != tuple(position):
+            self.graphic.set_position(position)
 
-    def set_disabled(self, is_disabled):
-        self.graphic.set_disabled(is_disabled)
+        if self.state.disabled != self.disabled:
+            self.disabled = self.state.disabled
+            self.graphic.set_disabled(self.disabled)
 
 class PlayerGraphic(EntityGraphic):
-    def __init__(self, position, map):
+    def __init__(self, position, map, motion):
         super(PlayerGraphic, self).__init__()
 
-        self.position = np.array(position)
         self.goal_position = np.array(position)
         self.old_position = np.array(position)
         self.map = map
+        self.motion = motion
 
         self.color = Color(1, 1, 1)
         self.add(self.color)
 
-        self.rect = Rectangle(pos=map.tile_to_pixels(position), size=map.tile_size(), source="./data/sprites/note_char_mouth.png")
+        self.rect = Rectangle(pos=map.tile_to_world(position), size=(1, 1),
+                              texture=get_texture(PLAYER_SPRITE))
         self.add(self.rect)
 
-        # keep track of where we are in the bounce
-        self.bouncing = False
-        self.bounce_prog = 0
+        self.index = motion.add(self.rect, position, PLAYER_SPEED)
 
-    def get_deltay_bounce(self):
+    # the bounce is twice as high once the player has moved
+    def get_bounce_scale(self):
         if self.goal_position[0] != self.old_position[0] or self.goal_position[1] != self.old_position[1]:
-            return 2 * self.bounce_prog ** 2 - 2 * self.bounce_prog
-        return self.bounce_prog ** 2 - self.bounce_prog
+            return 2
+        return 1
 
     def start_bounce(self):
-        self.bouncing = True
-        self.bounce_prog = 0
+        self.motion.start_bounce(self.index, self.get_bounce_scale())
 
     def set_position(self, position):
         self.old_position = self.goal_position
         self.goal_position = np.array(position)
+        self.motion.set_goal(self.index, position)
+        self.motion.set_bounce_scale(self.index, self.get_bounce_scale())
 
     def set_disabled(self, is_disabled):
         if is_disabled:
@@ -83,26 +73,6 @@ class PlayerGraphic(EntityGraphic):
         else:
             self.color.rgb = (1, 1, 1)
 
+    # moving and bouncing is done by the MotionSystem
     def on_update(self):
-        dt = kivyClock.frametime
-
-        self.bounce_prog += dt / BOUNCE_TIME
-        if self.bounce_prog > 1 or self.bouncing == False:
-            self.bouncing = False
-            deltay = 0
-        elif self.bouncing:
-            deltay = self.get_deltay_bounce()
-        else:
-            deltay = 0
-
-        disp = self.goal_position - self.position
-        dist = np.linalg.norm(disp)
-
-        if dist < dt * PLAYER_SPEED:
-            self.position = self.goal_position
-        else:
-            delta = disp * dt * PLAYER_SPEED / dist
-            self.position = self.position + delta
-
-        self.rect.pos = self.map.tile_to_pixels(self.position + [deltay, 0])
-        self.rect.size = self.map.tile_size()
+        pass
@@ -0,0 +1,263 @@
+import struct
+import sys
+import time
+
+import numpy as np
+
+from keyboard_controller import KeyboardController
+from music_controller import PitchController
+from level_driver import LevelDriver
+from screen_loader import WORLD, load_screen_data
+
+# A session log has every input of a game session (key presses and the pitches
+# heard by the mic), in between markers for the level's beat commands, all in
+# the order the game handled them. Playing it back gives the same game: the
+# same beats, deaths and pacified enemies. The game checks that as it goes
+# with a digest of the level (see LevelDriver.digest) after every beat_off.
+#
+# Layout: LOG_MAGIC, the format version (uint32), the beat the session's levels
+# started at (uint32, see LEVEL_START_BEAT in config.py), then LOG_RECORD
+# records to the end of the file. Each record has the screen it happened on and the audio
+# frame of that screen's scheduler (for splash screens, the time since the
+# screen came up, in frames).
+#
+# Record a session by setting INPUT_LOG_FILE in config.py, and play one back in
+# the game (in real time) with REPLAY_FILE. Play one back without a window or
+# audio, as fast as possible, with:
+#   python replay.py <session log>
+
+LOG_MAGIC = b'DUNJLOG\0'
+LOG_VERSION = 2
+LOG_HEADER = struct.Struct("<II") # version, start beat
+LOG_RECORD = np.dtype([("kind", "<u1"), ("screen", "<u2"), ("frame", "<u4"), ("value", "<f4")])
+RECORD_STRUCT = struct.Struct("<BHIf") # same layout as LOG_RECORD
+
+# record kinds. Inputs have a key or a midi pitch as value, checks a digest.
+BEAT_ON, BEAT_ON_EXACT, HALF_BEAT, BEAT_OFF, KEY_DOWN, KEY_UP, PITCH, CHECK = range(8)
+INPUTS = (KEY_DOWN, KEY_UP, PITCH)
+COMMANDS = (BEAT_ON, BEAT_ON_EXACT, HALF_BEAT, BEAT_OFF)
+KIND_NAMES = ["beat_on", "beat_on_exact", "half_beat", "beat_off", "key_down", "key_up", "pitch", "check"]
+
+# keys are stored as indices in here. Only the arrow keys matter to the
+# controllers, so every other key is OTHER_KEY.
+KEY_NAMES = ["up", "down", "left", "right"]
+OTHER_KEY = -1
+
+
+class ReplayError(Exception):
+    pass
+
+
+def key_value(keycode):
+    return KEY_NAMES.index(keycode[1]) if keycode[1] in KEY_NAMES else OTHER_KEY
+
+def value_keycode(value):
+    return (0, KEY_NAMES[int(value)] if value != OTHER_KEY else "")
+
+
+# writes a session log as the game goes
+class InputRecorder(object):
+    def __init__(self, path, start_beat = 0):
+        super(InputRecorder, self).__init__()
+        self.file = open(path, 'wb')
+        self.file.write(LOG_MAGIC + LOG_HEADER.pack(LOG_VERSION, start_beat))
+
+    def record(self, kind, screen, frame, value = 0):
+        self.file.write(RECORD_STRUCT.pack(kind, screen, frame, value))
+        # once a beat, so a crashed session still has most of its log
+        if kind == BEAT_ON_EXACT:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# returns the log's records and the beat its levels started at
+def read_log(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = len(LOG_MAGIC) + LOG_HEADER.size
+    if data[:len(LOG_MAGIC)] != LOG_MAGIC:
+        raise ReplayError("%s is not a session log" % path)
+    version, = struct.unpack_from("<I", data, len(LOG_MAGIC))
+    if version != LOG_VERSION:
+        raise ReplayError("%s has version %d, expected %d" % (path, version, LOG_VERSION))
+    start_beat, = struct.unpack_from("<I", data, len(LOG_MAGIC) + 4)
+    # a log cut off in the middle of a record just loses that record
+    count = (len(data) - header) // LOG_RECORD.itemsize
+    return np.frombuffer(data, dtype=LOG_RECORD, count=count, offset=header), start_beat
+
+
+# Plays a session log back into a game (Game, or a HeadlessGame) in place of
+# its keyboard and mic. Inputs go in at their frame, or before the command
+# that came after them, whichever is first. The game tells it about every
+# command and check, which must come in the same order as in the log.
+# start_beat is the beat the levels started at when the log was recorded,
+# which the game must start them at too.
+class InputPlayer(object):
+    def __init__(self, log, game, start_beat = 0):
+        super(InputPlayer, self).__init__()
+        self.log = log
+        self.game = game
+        self.start_beat = start_beat
+        self.index = 0 # next record
+        self.desyncs = [] # descriptions of the records that didn't match
+
+    def is_done(self):
+        return self.index == len(self.log)
+
+    # feed the inputs up to the next command or check, if they are on the
+    # current screen and their frame has come (or any frame, if frame is None)
+    def feed(self, frame = None):
+        while self.index < len(self.log):
+            kind, screen, rec_frame, value = self.log[self.index]
+            if kind not in INPUTS or screen != self.game.screen_index:
+                break
+            if frame is not None and rec_frame > frame:
+                break
+            self.index += 1
+            if kind == KEY_DOWN:
+                self.game.press_key(value_keycode(value), [])
+            elif kind == KEY_UP:
+                self.game.release_key(value_keycode(value))
+            else:
+                self.game.receive_pitch(float(value))
+
+    # the game is about to run command kind
+    def on_command(self, kind):
+        self.feed()
+        self.expect(kind)
+
+    # the player moved, and digest is what the level looks like now
+    def on_check(self, digest):
+        self.expect(CHECK, digest)
+
+    def expect(self, kind, value = None):
+        what = KIND_NAMES[kind] if value is None else "%s %d" % (KIND_NAMES[kind], value)
+        if self.is_done():
+            self.desyncs.append("record %d: log ended, game did %s" % (self.index, what))
+            return
+        rec_kind, screen, frame, rec_value = self.log[self.index]
+        if rec_kind != kind or screen != self.game.screen_index or (value is not None and rec_value != value):
+            self.desyncs.append("record %d (screen %d, frame %d): log has %s %d, game did %s on screen %d" %
+                                (self.index, screen, frame, KIND_NAMES[rec_kind], rec_value,
+                                 what, self.game.screen_index))
+            # the game went its own way, so the rest of the log is no use
+            self.index = len(self.log)
+            return
+        self.index += 1
+
+
+# Runs the game from a session log without a window or audio: screens are
+# loaded the way Game loads them, and levels are run by a LevelDriver.
+# Commands run when the log says they ran, so no time has to pass.
+class HeadlessGame(object):
+    def __init__(self, log, start_beat = 0):
+        super(HeadlessGame, self).__init__()
+        with open(WORLD + "/game_info.txt") as game_info:
+            self.screens = [line.strip().split(" ") for line in game_info]
+
+        self.music_controller = PitchController()
+        self.movement_controller = KeyboardController()
+        self.player = InputPlayer(log, self, start_beat)
+
+        # what happened in each level played: (name, beats, deaths, pacified groups, seconds)
+        self.results = []
+
+        self.screen_index = 0
+        self.load_screen()
+
+    def load_screen(self):
+        screen_type, name = self.screens[self.screen_index]
+        data = load_screen_data(self.screens[self.screen_index])
+        self.driver = None
+        if screen_type == "level":
+            self.driver = LevelDriver(data.sim, data.tempo, self.music_controller, self.movement_controller)
+            # same as Level
+            if self.player.start_beat:
+                self.driver.seek(self.player.start_beat)
+        self.level_name = name
+        self.start_time = time.time()
+
+    def finish_screen(self):
+        if self.driver:
+            sim = self.driver.sim
+            self.results.append((self.level_name, sim.beat, sim.deaths,
+                                 sum(eg.melody_complete for eg in sim.enemy_groups),
+                                 time.time() - self.start_time))
+
+    def next_screen(self):
+        self.finish_screen()
+        self.screen_index = (self.screen_index + 1) % len(self.screens)
+        self.load_screen()
+
+    def run(self):
+        log = self.player.log
+        while not self.player.is_done():
+            self.player.feed()
+            if self.player.is_done():
+                break
+            kind = log[self.player.index]["kind"]
+            if kind in COMMANDS:
+                self.run_command(kind)
+            else:
+                # a check (or input for another screen) nothing led up to
+                self.player.expect(kind)
+        self.finish_screen()
+        return self.player.desyncs
+
+    def run_command(self, kind):
+        self.player.on_command(kind)
+        if self.driver is None:
+            return
+        if kind == BEAT_ON:
+            self.driver.beat_on()
+        elif kind == BEAT_ON_EXACT:
+            self.driver.beat_on_exact()
+            if self.driver.is_ready():
+                self.perform_beat_off()
+        elif kind == HALF_BEAT:
+            self.driver.half_beat()
+        elif kind == BEAT_OFF:
+            self.perform_beat_off()
+
+    # same as Level.perform_beat_off
+    def perform_beat_off(self):
+        at_exit = self.driver.beat_off()
+        if at_exit is None:
+            return
+        self.player.on_check(self.driver.digest())
+        if at_exit:
+            self.next_screen()
+
+    # same as Game and its screens
+    def press_key(self, keycode, modifiers):
+        self.movement_controller.on_key_down(keycode, modifiers)
+        if self.driver is None:
+            self.next_screen() # any key ends a splash screen
+        elif self.driver.is_ready():
+            self.perform_beat_off()
+
+    def release_key(self, keycode):
+        self.movement_controller.on_key_up(keycode)
+
+    def receive_pitch(self, midi):
+        self.music_controller.receive_pitch(midi)
+        if self.driver:
+            self.driver.receive_pitch()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("usage: python replay.py <session log>")
+        sys.exit(2)
+
+    start = time.time()
+    game = HeadlessGame(*read_log(sys.argv[1]))
+    desyncs = game.run()
+    for name, beats, deaths, pacified, seconds in game.results:
+        print("%s: %d beats, %d deaths, %d groups pacified (%.3fs)" % (name, beats, deaths, pacified, seconds))
+    print("replayed %d records in %.3fs" % (len(game.player.log), time.time() - start))
+    for desync in desyncs:
+        print("desync at " + desync)
+    sys.exit(1 if desyncs else 0)
@@ -0,0 +1,120 @@
+import threading
+
+from common.clock import SimpleTempoMap, TempoMap
+from common.wavesrc import WaveFile, WaveBuffer
+
+from simulation import LevelSimulation
+from level_pack import current_pack
+
+import os
+
+WORLD = "data/basic_world"
+
+# Everything a screen needs from disk, loaded without touching any graphics, so
+# it can be done on a worker thread (see ScreenLoader), or without Kivy at all
+# (see replay.py). The screen itself is made from it on the main thread.
+
+class SplashData(object):
+    def __init__(self, splash_name):
+        super(SplashData, self).__init__()
+        self.name = splash_name
+        self.sprite = "data/sprites/" + splash_name
+
+    def sprites(self):
+        return [self.sprite]
+
+# A level is loaded from its compiled pack (see level_pack.py) if it has an up
+# to date one, or else from its files.
+class LevelData(object):
+    def __init__(self, level_name):
+        super(LevelData, self).__init__()
+        self.name = level_name
+        level_dir = WORLD + "/" + level_name
+
+        pack = current_pack(level_dir)
+        if pack is not None:
+            self.load_pack(pack)
+        else:
+            self.load_files(level_dir)
+
+    def load_pack(self, pack):
+        self.tempo = pack.tempo
+        self.bg_music_beats_per_loop = pack.beats_per_loop
+        self.tempo_map = pack.tempo_map()
+        self.bg_music = pack.bg_music()
+        self.sim = pack.simulation()
+        self.variants = pack.variants()
+
+    def load_files(self, level_dir):
+        with open(level_dir + "/music_timing.txt") as f:
+            self.tempo = int(f.readline().strip())
+            self.bg_music_beats_per_loop = int(f.readline().strip())
+
+        # songs that change tempo come with a tempo curve: lines of
+        # "<time in seconds>\t<beats since the previous line>"
+        tempo_curve_path = level_dir + "/tempo_curve.txt"
+        if os.path.exists(tempo_curve_path):
+            self.tempo_map = TempoMap(filepath=tempo_curve_path)
+        else:
+            self.tempo_map = SimpleTempoMap(self.tempo)
+
+        # the whole song, decoded
+        bg_music_path = level_dir + "/background.wav"
+        self.bg_music = WaveBuffer(bg_music_path, 0, WaveFile(bg_music_path).end)
+
+        self.sim = LevelSimulation.from_dir(level_dir)
+        self.variants = None # random
+
+    # paths of the sprites the level will show
+    def sprites(self):
+        # the graphics modules need Kivy, so only a ScreenLoader gets here
+        from map_tile import tile_appearance, NUM_EMPTY_VARIANTS, NUM_DANGER_VARIANTS
+        from player import PLAYER_SPRITE
+
+        sprites = set([PLAYER_SPRITE])
+        kinds = set(kind for row in self.sim.map.kinds for kind in row)
+        for kind in kinds:
+            for variant in range(max(NUM_EMPTY_VARIANTS, NUM_DANGER_VARIANTS)):
+                sprite = tile_appearance(kind, variant)[1]
+                if sprite:
+                    sprites.add(sprite)
+        for state in self.sim.enemy_groups:
+            for desc in state.description["enemies"]:
+                sprites.update(desc["sprites"].values())
+        return sorted(sprites)
+
+# the data for a line of game_info.txt: (screen type, name)
+def load_screen_data(screen):
+    screen_type, name = screen
+    if screen_type == "splash":
+        return SplashData(name)
+    elif screen_type == "level":
+        return LevelData(name)
+    raise Exception("Unknown screen type: %s" % screen_type)
+
+# loads the data for a screen on a worker thread, and decodes its sprites so the
+# screen can be made without waiting on the disk. get() waits for it.
+class ScreenLoader(object):
+    def __init__(self, screen):
+        super(ScreenLoader, self).__init__()
+        self.screen = screen
+        self.data = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True # don't keep the game from quitting
+        self.thread.start()
+
+    def run(self):
+        try:
+            data = load_screen_data(self.screen)
+            from sprites import preload_sprites
+            preload_sprites(data.sprites())
+            self.data = data
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.data
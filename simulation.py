@@ -0,0 +1,1306 @@
+import json
+from functools import reduce
+from math import gcd
+import numpy as np
+
+# The game rules, without any graphics. Everything in here can run without a
+# window (or audio), one beat at a time. The Kivy classes (Map, Player, Enemy,
+# EnemyGroup, Level) are views that read from these objects.
+
+EMPTY = " "
+PLAYER_START = "p"
+EXIT = "e"
+WALL = "w"
+DANGER_FLOOR = "."
+PREVIEW_FLOOR = "-"
+SIDE_WALL = "s"
+SIDE_WALL2 = "2"
+CORNER_L = "l"
+CORNER_R = "r"
+VACUUM = "v"
+CORNER_LI = "c"
+CORNER_RI = "i"
+
+VALID_TILES = [EMPTY, PLAYER_START, EXIT, WALL]
+
+# all tile kinds a map file may contain
+MAP_TILES = [EMPTY, PLAYER_START, EXIT, WALL, DANGER_FLOOR, PREVIEW_FLOOR, SIDE_WALL, SIDE_WALL2,
+             CORNER_L, CORNER_R, VACUUM, CORNER_LI, CORNER_RI]
+
+IMPASSABLE_TILES = [WALL, SIDE_WALL, SIDE_WALL2, CORNER_R, CORNER_RI, CORNER_L, CORNER_LI]
+
+RESET_PAUSE_TIME = 2 # total time spent between death and moving again
+RESET_MOVE_BACK_TIME = 1 # time at which the player moves back to start
+
+# enemy groups fall asleep once the player is this many squares beyond the
+# farthest they can reach (or be heard). Enough to keep sleeping groups off screen.
+WAKE_MARGIN = 14
+BROADPHASE_BUCKET_SIZE = 16 # squares per side of a broadphase bucket
+# groups whose attack cycles take longer than this many beats to repeat get no
+# DangerTable, since it would take too much memory (see DangerTable)
+MAX_DANGER_PERIOD = 256
+
+# how an enemy group behaves on a beat, for its DangerTable: whether it shoots
+# its p_attacks, and whether its enemies block projectiles (pacified enemies
+# do). MIXED if its enemies don't all behave the same, or the group behaves in
+# a way that isn't tabulated.
+ANGRY = 0 # attacks, not blocking
+CALM = 1 # attacks, blocking (ie, the player is out of the melody threshold, which pacifies everyone)
+PACIFIED = 2 # p_attacks, blocking
+MIXED = -1
+DANGER_MODES = [ANGRY, CALM, PACIFIED]
+
+# map a direction character to a deltax and deltay
+direction_map = {
+    'u': (-1, 0),
+    'd': (1, 0),
+    'l': (0, -1),
+    'r': (0, 1)
+}
+DIRECTIONS = "udlr" # order of MapState.flight
+
+
+# normalize a tile kind from a map file to the kind that matters for rules and drawing
+def tile_kind(kind):
+    if kind == PLAYER_START:
+        return EMPTY # replace since player start doesn't matter
+    elif kind == PREVIEW_FLOOR:
+        return EMPTY # replace since preview floor should just look like empty
+    elif kind not in MAP_TILES:
+        raise Exception("Unknown tile: %s" % kind)
+    return kind
+
+# tiles are stored as uint8 codes: the index of their kind in MAP_TILES
+TILE_CODES = dict((kind, code) for code, kind in enumerate(MAP_TILES))
+
+
+# Keeps track of which entities are on which squares during one beat.
+# Everything is in preallocated arrays. A cell only counts if its stamp matches
+# the current generation, so clear() is O(1) no matter how many entities there are.
+# The entities on a cell form a linked list through head / next_entity, and
+# their cells and whether they may block movement are kept by entity too.
+class OccupancyGrid(object):
+    def __init__(self, shape, capacity = 64):
+        super(OccupancyGrid, self).__init__()
+        self.shape = shape
+        self.generation = 1
+        self.stamp = np.zeros(shape, dtype=np.int64)
+        self.counts = np.zeros(shape, dtype=np.int32)
+        self.head = np.full(shape, -1, dtype=np.int32)
+
+        self.entities = [None] * capacity
+        self.next_entity = np.full(capacity, -1, dtype=np.int32)
+        self.entity_cells = np.zeros((capacity, 2), dtype=np.int32)
+        self.entity_blocking = np.zeros(capacity, dtype=bool)
+        self.num_entities = 0
+
+    def clear(self):
+        self.generation += 1
+        self.num_entities = 0
+
+    # entities off the map are not tracked, since nothing can be there
+    def add(self, position, entity, blocking):
+        r, c = position
+        if not (0 <= r < self.shape[0] and 0 <= c < self.shape[1]):
+            return
+
+        if self.stamp[r, c] != self.generation:
+            self.stamp[r, c] = self.generation
+            self.counts[r, c] = 0
+            self.head[r, c] = -1
+
+        idx = self.num_entities
+        if idx == len(self.entities):
+            self.entities.extend([None] * idx)
+            self.next_entity = np.concatenate((self.next_entity, np.full(idx, -1, dtype=np.int32)))
+            self.entity_cells = np.concatenate((self.entity_cells, np.zeros((idx, 2), dtype=np.int32)))
+            self.entity_blocking = np.concatenate((self.entity_blocking, np.zeros(idx, dtype=bool)))
+        self.entities[idx] = entity
+        self.next_entity[idx] = self.head[r, c]
+        self.head[r, c] = idx
+        self.entity_cells[idx] = r, c
+        self.entity_blocking[idx] = blocking
+        self.num_entities += 1
+
+        self.counts[r, c] += 1
+
+    # add many entities at once. They are counted but not kept in the
+    # occupant lists, so they must never block.
+    def add_many(self, positions):
+        positions = positions[(positions[:, 0] >= 0) & (positions[:, 0] < self.shape[0]) &
+                              (positions[:, 1] >= 0) & (positions[:, 1] < self.shape[1])]
+        rows, cols = positions[:, 0], positions[:, 1]
+
+        stale = self.stamp[rows, cols] != self.generation
+        if stale.any():
+            r, c = rows[stale], cols[stale]
+            self.stamp[r, c] = self.generation
+            self.counts[r, c] = 0
+            self.head[r, c] = -1
+
+        np.add.at(self.counts, (rows, cols), 1)
+
+    # positions is an array of (row, col), all on the map
+    def counts_at(self, positions):
+        rows, cols = positions[:, 0], positions[:, 1]
+        return np.where(self.stamp[rows, cols] == self.generation, self.counts[rows, cols], 0)
+
+    def count(self, position):
+        r, c = position
+        return self.counts[r, c] if self.stamp[r, c] == self.generation else 0
+
+    # the entities on a cell, most recently added first
+    def occupants(self, position):
+        r, c = position
+        if self.stamp[r, c] != self.generation:
+            return
+        idx = self.head[r, c]
+        while idx != -1:
+            yield self.entities[idx]
+            idx = self.next_entity[idx]
+
+
+# flight[d, r, c] is how many squares a projectile shot from (r, c) in
+# DIRECTIONS[d] can fly before the next square isn't passable. Walls never
+# move, so this is worked out once per map, a row or column at a time.
+def flight_distances(passable_mask):
+    rows, cols = passable_mask.shape
+    flight = np.zeros((len(DIRECTIONS), rows, cols), dtype=np.int32)
+    up, down, left, right = flight # views, in the order of DIRECTIONS
+    for r in range(1, rows):
+        up[r] = np.where(passable_mask[r - 1], up[r - 1] + 1, 0)
+    for r in range(rows - 2, -1, -1):
+        down[r] = np.where(passable_mask[r + 1], down[r + 1] + 1, 0)
+    for c in range(1, cols):
+        left[:, c] = np.where(passable_mask[:, c - 1], left[:, c - 1] + 1, 0)
+    for c in range(cols - 2, -1, -1):
+        right[:, c] = np.where(passable_mask[:, c + 1], right[:, c + 1] + 1, 0)
+    return flight
+
+
+class MapState(object):
+    # grid holds the TILE_CODES of the tiles. in_map is False for squares that
+    # are padding rather than part of the map, which are never passable.
+    def __init__(self, grid, player_start_loc, in_map = None):
+        super(MapState, self).__init__()
+        self.grid = grid
+        self.player_start_loc = tuple(player_start_loc)
+        self.in_map = np.ones(grid.shape, dtype=bool) if in_map is None else in_map
+
+        self.kinds = [[MAP_TILES[code] for code in row] for row in self.grid]
+
+        # what the tiles themselves allow. Enemies on top are checked separately.
+        self.passable_mask = ~np.isin(self.grid, [TILE_CODES[kind] for kind in IMPASSABLE_TILES]) & self.in_map
+        self.exit_mask = self.grid == TILE_CODES[EXIT]
+        self.flight = flight_distances(self.passable_mask)
+
+        self.occupancy = OccupancyGrid(self.grid.shape)
+        # blocking[r, c] is whether an enemy on the square stops things from
+        # moving in, for bulk queries. See blocking_mask().
+        self.blocking = np.zeros(self.grid.shape, dtype=bool)
+        self.blocking_key = None
+
+        # initialize per-timestep variables
+        self.player_loc = self.player_start_loc
+        self.start_new_timestep()
+
+    # rows are the lines of a map file
+    @staticmethod
+    def from_rows(rows):
+        player_start_loc = None
+        for r, row in enumerate(rows):
+            for c, kind in enumerate(row):
+                if kind == PLAYER_START:
+                    player_start_loc = (r, c)
+        if player_start_loc is None:
+            raise Exception("Map has no player start")
+
+        # short rows are padded with vacuum
+        width = max(len(row) for row in rows)
+        grid = np.full((len(rows), width), TILE_CODES[VACUUM], dtype=np.uint8)
+        in_map = np.zeros((len(rows), width), dtype=bool)
+        for r, row in enumerate(rows):
+            grid[r, :len(row)] = [TILE_CODES[tile_kind(kind)] for kind in row]
+            in_map[r, :len(row)] = True
+        return MapState(grid, player_start_loc, in_map)
+
+    @staticmethod
+    def from_file(map_filename):
+        with open(map_filename) as f:
+            rows = f.read().strip().split("\n")
+        return MapState.from_rows(rows)
+
+    def start_new_timestep(self):
+        self.occupancy.clear()
+        # don't reset player loc so that there is still a valid loc eventually
+        # self.player_loc = None
+
+    # blocking is False for entities that never stop anything from moving in
+    def add_enemy(self, position, enemy, blocking = True):
+        # TODO: maybe force projectiles to die?
+        self.occupancy.add(position, enemy, blocking)
+
+    # projectiles never block, so they are added in bulk
+    def add_projectiles(self, positions):
+        self.occupancy.add_many(positions)
+
+    def add_player(self, position, player):
+        self.player_loc = tuple(position)
+
+    def in_bounds(self, positions):
+        positions = np.asarray(positions).reshape(-1, 2)
+        rows, cols = self.grid.shape
+        return (positions[:, 0] >= 0) & (positions[:, 0] < rows) & \
+               (positions[:, 1] >= 0) & (positions[:, 1] < cols)
+
+    # positions is an array of (row, col). Returns a bool array: whether each
+    # square can be entered. Outside of the map isn't passable.
+    def passable(self, positions):
+        positions = np.asarray(positions, dtype=int).reshape(-1, 2)
+        result = self.in_bounds(positions)
+        inside = positions[result]
+        result[result] = self.passable_mask[inside[:, 0], inside[:, 1]]
+
+        candidates = np.flatnonzero(result)
+        result[candidates] = ~self.enemies_block(positions[candidates])
+        return result
+
+    # positions is an array of (row, col). Returns a bool array: whether each
+    # square has an enemy (or projectile) on it.
+    def dangerous(self, positions):
+        positions = np.asarray(positions, dtype=int).reshape(-1, 2)
+        result = self.in_bounds(positions)
+        result[result] = self.occupancy.counts_at(positions[result]) > 0
+        return result
+
+    # how many squares a projectile shot from position in dir ("u", "d", "l" or
+    # "r") flies before it hits a wall (or leaves the map)
+    def flight_distance(self, position, dir):
+        r, c = position
+        rows, cols = self.grid.shape
+        if not (0 <= r < rows and 0 <= c < cols):
+            return 0
+        return int(self.flight[DIRECTIONS.index(dir), r, c])
+
+    # positions is an array of (row, col), all on the map. Returns a bool
+    # array: whether an enemy on each square stops things from moving in.
+    def enemies_block(self, positions):
+        positions = np.asarray(positions, dtype=int).reshape(-1, 2)
+        return self.blocking_mask()[positions[:, 0], positions[:, 1]]
+
+    # the blocking squares, worked out (with one index assignment) at the first
+    # bulk query after an enemy was added, and kept until the next one is, the
+    # timestep ends, or enemies_changed() is called
+    def blocking_mask(self):
+        occupancy = self.occupancy
+        key = (occupancy.generation, occupancy.num_entities)
+        if key != self.blocking_key:
+            self.blocking_key = key
+            self.blocking.fill(False)
+            n = occupancy.num_entities
+            blocking = [i for i in np.flatnonzero(occupancy.entity_blocking[:n])
+                        if not occupancy.entities[i].is_passable()]
+            cells = occupancy.entity_cells[blocking]
+            self.blocking[cells[:, 0], cells[:, 1]] = True
+        return self.blocking
+
+    # enemies on the map may have become passable (or stopped being), ie when
+    # notes were judged
+    def enemies_changed(self):
+        self.blocking_key = None
+
+    def _enemies_passable(self, position):
+        for enemy in self.occupancy.occupants(position):
+            if not enemy.is_passable():
+                return False
+        return True
+
+    # whether the tile itself can be entered, ignoring whatever is on it
+    def is_tile_passable(self, position):
+        r, c = position
+        rows, cols = self.grid.shape
+        return 0 <= r < rows and 0 <= c < cols and bool(self.passable_mask[r, c])
+
+    def is_square_passable(self, position):
+        r, c = position
+        rows, cols = self.grid.shape
+        if not (0 <= r < rows and 0 <= c < cols and self.passable_mask[r, c]):
+            return False # outside of map isn't passable
+        return self._enemies_passable((r, c))
+
+    def is_square_dangerous(self, position):
+        if position is None:
+            return False
+        r, c = position
+        if not (0 <= r < self.grid.shape[0] and 0 <= c < self.grid.shape[1]):
+            return False
+        return self.occupancy.count((r, c)) > 0
+
+    def is_player_at_exit(self):
+        if self.player_loc is None:
+            return False
+        return bool(self.exit_mask[self.player_loc])
+
+    def player_location(self):
+        return self.player_loc
+
+    def player_start_location(self):
+        return self.player_start_loc
+
+    def map_size(self):
+        return self.grid.shape
+
+
+class PlayerState(object):
+    def __init__(self, map):
+        super(PlayerState, self).__init__()
+        self.map = map
+        self.position = map.player_start_location()
+        self.disabled = False
+
+    def on_beat(self, movement):
+        delta = movement
+
+        # collision detection
+        new_pos = (self.position[0] + delta[0], self.position[1] + delta[1])
+        if self.map.is_square_passable(new_pos):
+            self.position = new_pos
+
+        self.map.add_player(self.position, self)
+
+    def get_position(self):
+        return self.position
+
+    def return_to_start(self):
+        self.position = self.map.player_start_location()
+        self.map.add_player(self.position, self)
+
+
+# All projectiles of a level, as a struct of arrays: one row per projectile.
+# Slots of dead projectiles are reused once the next beat starts. Every
+# projectile gets a unique, increasing id so views can follow it around as
+# slots get compacted.
+#
+# Projectiles fly straight and walls never move, so each one knows from the
+# start on which beat it flies into a wall (see MapState.flight). Only
+# enemies in the way still have to be looked at every beat.
+class ProjectileSystem(object):
+    def __init__(self, capacity = 64):
+        super(ProjectileSystem, self).__init__()
+        self.pos = np.zeros((capacity, 2), dtype=int)
+        self.next_pos = np.zeros((capacity, 2), dtype=int)
+        self.dir = np.zeros((capacity, 2), dtype=int) # (drow, dcol) per beat
+        self.owner = np.zeros(capacity, dtype=np.int32) # index into owners
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.expires = np.zeros(capacity, dtype=np.int64) # beat on which it hits a wall
+        self.count = 0 # slots in use, dead or alive
+        self.next_id = 0
+        self.beat = 0 # number of on_beat() calls so far
+
+        # whatever shot the projectiles (ie, EnemyState), so views can draw them differently
+        self.owners = []
+
+    def add_owner(self, owner):
+        self.owners.append(owner)
+        return len(self.owners) - 1
+
+    # dir is "u", "d", "l", or "r". The projectile starts at pos and makes its
+    # first move on the next on_beat(), unless it is spawned having already made
+    # moves moves (ie, when catching up with beats that were skipped).
+    def spawn(self, pos, dir, owner, map, moves = 0):
+        if self.count == len(self.alive):
+            self._grow()
+        i = self.count
+        delta = direction_map[dir]
+        # the k-th move takes it to pos + k * delta, and the one after the
+        # last passable square is into the wall
+        self.expires[i] = self.beat + map.flight_distance(pos, dir) + 1 - moves
+        self.pos[i] = (pos[0] + delta[0] * max(moves - 1, 0), pos[1] + delta[1] * max(moves - 1, 0))
+        self.next_pos[i] = (pos[0] + delta[0] * moves, pos[1] + delta[1] * moves)
+        self.dir[i] = delta
+        self.owner[i] = owner
+        self.ids[i] = self.next_id
+        self.alive[i] = True
+        self.count += 1
+        self.next_id += 1
+
+    def _grow(self):
+        for name in ("pos", "next_pos", "dir", "owner", "ids", "alive", "expires"):
+            arr = getattr(self, name)
+            setattr(self, name, np.concatenate((arr, np.zeros_like(arr))))
+
+    # drop every projectile. Ids keep going up, so views don't mistake new
+    # projectiles for old ones.
+    def clear(self):
+        self.alive[:self.count] = False
+        self.count = 0
+
+    # drop dead projectiles, keeping the rest in order
+    def _compact(self):
+        n = self.count
+        keep = np.flatnonzero(self.alive[:n])
+        if len(keep) == n:
+            return
+        for arr in (self.pos, self.next_pos, self.dir, self.owner, self.ids, self.alive, self.expires):
+            arr[:len(keep)] = arr[keep]
+        self.count = len(keep)
+
+    # every projectile moves one square
+    def on_beat(self, map):
+        self._compact()
+        self.beat += 1
+        n = self.count
+        self.pos[:n] = self.next_pos[:n]
+        self.next_pos[:n] += self.dir[:n]
+        map.add_projectiles(self.next_pos[:n])
+
+    # projectiles die once they fly into something they can't pass through.
+    # Call once all entities have been added to the map this beat.
+    def cull(self, map):
+        n = self.count
+        alive = self.expires[:n] > self.beat
+        self.alive[:n] = alive
+        # everything still flying is on the map, on a passable tile
+        flying = np.flatnonzero(alive)
+        self.alive[flying] = ~map.enemies_block(self.next_pos[flying])
+
+    # slots of the living projectiles
+    def live_slots(self):
+        return np.flatnonzero(self.alive[:self.count])
+
+
+class EnemyState(object):
+    def __init__(self, desc, action_description, is_enemy_pacified, should_p_attack, projectiles):
+        super(EnemyState, self).__init__()
+        # init_pos is (row, col)
+        # action_description is an EnemyActionDescription
+        self.id = desc["id"]
+        self.init_pos = tuple(desc["init_pos"])
+        self.pos = self.init_pos
+        self.note = desc["note"] # the note is either the MIDI pitch which pacifies it, or -1 if the enemy group type is "all"
+        self.actions = action_description
+        # this is a callback from the enemy group, which takes in an enemy id and returns
+        # whether it is pacified or not (usually just call it with your own id)
+        self.is_enemy_pacified = is_enemy_pacified
+        self.should_p_attack = should_p_attack
+
+        # the level's ProjectileSystem, which this enemy shoots into
+        self.projectiles = projectiles
+        self.projectile_owner = projectiles.add_owner(self)
+
+        self.p_attacking = False # whether the most recent attack was a p_attack
+
+    # back to where the enemy was before the first beat
+    def reset(self):
+        self.pos = self.init_pos
+        self.actions.motion_index = 0
+        self.actions.attack_index = 0
+        self.p_attacking = False
+
+    # shoot the next projectile, if there is one this beat
+    def attack(self, map):
+        self.p_attacking = self.should_p_attack(self.id)
+        next_attack = self.actions.get_next_attack(self.p_attacking)
+        if next_attack != '':
+            self.projectiles.spawn(self.pos, next_attack, self.projectile_owner, map)
+
+    def on_beat(self, map):
+        # move the enemy
+        self.pos = self.actions.get_next_pos(self.pos)
+
+        self.attack(map)
+
+        # add the enemy to the map so it knows where they are
+        map.add_enemy(self.pos, self)
+
+    def is_pacified(self):
+        return self.is_enemy_pacified(self.id)
+
+    def is_passable(self):
+        # once pacified, the player cannot accidentally run into a pacified enemy and get killed
+        return not self.is_pacified()
+
+    # the squares this enemy walks on, over and over. None if it wanders off for good.
+    def walking_squares(self):
+        motions = self.actions.motions
+        if sum(m[0] for m in motions) != 0 or sum(m[1] for m in motions) != 0:
+            return None
+
+        positions = [self.pos]
+        for drow, dcol in motions:
+            positions.append((positions[-1][0] + drow, positions[-1][1] + dcol))
+        return positions
+
+    # every square this enemy or its projectiles could ever be on, judging by
+    # the walls only. None if the enemy wanders off for good.
+    def reachable_squares(self, map):
+        positions = self.walking_squares()
+        if positions is None:
+            return None
+
+        dirs = set(self.actions.attacks + (self.actions.p_attacks or [])) - set([""])
+        squares = list(positions)
+        for pos in positions:
+            for dir in dirs:
+                drow, dcol = direction_map[dir]
+                square = pos
+                while True:
+                    square = (square[0] + drow, square[1] + dcol)
+                    squares.append(square)
+                    if not map.is_tile_passable(square):
+                        break
+        return squares
+
+    # move and attack on the next beat, without touching the map. Returns the
+    # direction of the attack, or ''.
+    def step(self, should_p_attack):
+        self.pos = self.actions.get_next_pos(self.pos)
+        return self.actions.get_next_attack(should_p_attack)
+
+
+class EnemyGroupState(object):
+    def __init__(self, description, map, projectiles):
+        super(EnemyGroupState, self).__init__()
+        self.description = description
+        self.map = map
+        self.center = tuple(description["center"])
+        self.sound_thresh = description["sound_thresh"]
+        self.mel_thresh = description["mel_thresh"]
+        self.melody = description["melody"]
+        self.type = description["pacify"] # this will be either 'individual' or 'all'
+        self.melody_progress = 0 # how many correct notes in a row, used for pacifying all of them
+        self.melody_index = 0 # index of next note to expect/play
+        # for 'all' type groups, keep track if the whole melody is completed
+        self.melody_complete = False
+
+        self.cur_pitch = None
+        self.pitch_matched = False # True if matched the pitch this beat already
+
+        # what the most recent note judgement looked at, for views to display:
+        # how many notes were judged so far, the index of the enemy whose note it
+        # judged, how close the player's pitch was (0 - 1) and the pacified
+        # enemies after it.
+        self.check_count = 0
+        self.checked_index = 0
+        self.checked_saturation = 0
+        self.checked_pacified = []
+
+        # pacified enemies only change when the inputs to get_pacified_enemies()
+        # do, so they are recomputed only then. pacified_version goes up every time
+        # the pacified enemies actually change, so views can skip updates.
+        self.pacified_key = None
+        self.pacified_ids = []
+        self.pacified = frozenset()
+        self.pacified_version = 0
+
+        self.enemies = [EnemyState(desc, EnemyActionDescription(desc, self),
+                                   self.is_enemy_pacified, self.should_p_attack, projectiles)
+                        for desc in description["enemies"]]
+
+        # a group sleeps while the player is farther than wake_distance. It then
+        # skips its beats, and catches up on them when it wakes up.
+        # None means it never sleeps.
+        self.wake_distance = self.find_wake_distance()
+        self.asleep = False
+        self.asleep_since = 0 # first beat skipped
+
+    def find_wake_distance(self):
+        reach = max(self.sound_thresh, self.mel_thresh)
+        for enemy in self.enemies:
+            squares = enemy.reachable_squares(self.map)
+            if squares is None:
+                return None
+            for row, col in squares:
+                reach = max(reach, abs(self.center[0] - row), abs(self.center[1] - col))
+        return reach + WAKE_MARGIN
+
+    # the squares the group's enemies, or their projectiles, can be on, and
+    # the squares its enemies walk on. None if an enemy wanders off.
+    def reachable_squares(self):
+        squares = set()
+        for enemy in self.enemies:
+            enemy_squares = enemy.reachable_squares(self.map)
+            if enemy_squares is None:
+                return None
+            squares.update(enemy_squares)
+        return squares
+
+    def walking_squares(self):
+        squares = set()
+        for enemy in self.enemies:
+            enemy_squares = enemy.walking_squares()
+            if enemy_squares is None:
+                return None
+            squares.update(enemy_squares)
+        return squares
+
+    def player_distance(self):
+        # distance along longer axis from enemy group's center to the player
+        row, col = self.map.player_location()
+        return max(abs(self.center[0] - row), abs(self.center[1] - col))
+
+    def is_player_in_sound_threshold(self):
+        return self.player_distance() <= self.sound_thresh
+
+    def is_player_in_melody_threshold(self):
+        return self.player_distance() <= self.mel_thresh
+
+    def is_group_pacified(self):
+        return self.melody_complete
+
+    # return a list of the IDs of pacified enemies
+    def get_pacified_enemies(self):
+        key = (self.is_player_in_melody_threshold(), self.melody_complete, self.melody_index,
+               self.melody_progress, self.pitch_matched, self.cur_pitch)
+        if key != self.pacified_key:
+            self.pacified_key = key
+            ids = self._find_pacified_enemies()
+            if ids != self.pacified_ids:
+                self.pacified_ids = ids
+                self.pacified = frozenset(ids)
+                self.pacified_version += 1
+        return self.pacified_ids
+
+    def _find_pacified_enemies(self):
+        # nobody is angry if you're outside the melody threshold
+        if not self.is_player_in_melody_threshold():
+            return [e.id for e in self.enemies]
+        if self.type == "all":
+            # if all the enemies have to be pacified at once
+            if self.melody_complete:
+                # return all the IDs if the melody has been completed
+                return [e.id for e in self.enemies]
+            else:
+                result = []
+                idx = (self.melody_index - 1 - int(not self.pitch_matched)) % len(self.melody)
+                for i in range(self.melody_progress):
+                    result.append(self.enemies[idx - i].id)
+                return result
+        # otherwise return a list of enemies whose pacifying note is the current note
+        else:
+            idx = (self.melody_index - 1) % len(self.melody)
+            if idx < len(self.enemies):
+                target = self.enemies[idx]
+                return [target.id] if 60 + target.note % 12 == self.cur_pitch else []
+            else:
+                return []
+
+    # a callback for enemies to see if they're pacified
+    def is_enemy_pacified(self, id):
+        self.get_pacified_enemies()
+        return id in self.pacified
+
+    def should_p_attack(self, id):
+        return self.is_group_pacified() or (self.is_player_in_melody_threshold() and self.is_enemy_pacified(id))
+
+    # the melody note to play on this beat, or None
+    def get_beat_note(self):
+        if not self.is_player_in_sound_threshold():
+            return None
+        if self.is_group_pacified() or not self.is_player_in_melody_threshold():
+            return self.melody[self.melody_index]
+        return None
+
+    # whether the note sung right now counts for this group
+    def needs_judgement(self):
+        return not self.pitch_matched and self.is_player_in_melody_threshold()
+
+    # the note the player has to sing
+    def target_note(self):
+        return self.melody[self.melody_index - 1]
+
+    # no note is required on this beat
+    def is_rest(self):
+        return self.melody[self.melody_index] == 0
+
+    # music may be None if there is no voice input at all
+    def check_note(self, music, is_last):
+        # check if player sang correct note (or if no note was required)
+        if self.needs_judgement():
+            is_pitch = music is not None and music.is_pitch()
+            saturation = music.to_saturation(self.target_note()) if is_pitch else 0
+            self.apply_judgement(self.is_rest() or saturation == 1, saturation,
+                                 music.get_held_midi() if is_pitch else None, is_last)
+        elif not self.pitch_matched:
+            self.cur_pitch = 0
+
+    # correct is whether the player sang the target note (or there was none).
+    # held_midi is None if there was no pitch.
+    def apply_judgement(self, correct, saturation, held_midi, is_last):
+        # Increment the melody progress for all or nothing groups
+        if correct:
+            # correct pitch
+            self.melody_progress += 1
+            self.pitch_matched = True
+        elif is_last:
+            # incorrect pitch for all samples, and this is the last one, so we now punish
+            self.melody_progress = 0
+
+        if self.melody_progress >= len(self.melody):
+            self.melody_complete = True
+
+        if held_midi is not None:
+            self.cur_pitch = held_midi
+
+        self.check_count += 1
+        self.checked_index = self.melody_index - 1
+        self.checked_saturation = saturation
+        self.checked_pacified = self.get_pacified_enemies()
+
+    # everything after the note check on a beat: enemies move and attack, and the
+    # melody moves on.
+    def advance(self, map):
+        for enemy in self.enemies:
+            enemy.on_beat(map)
+
+        self.pitch_matched = False
+
+        self.melody_index = (self.melody_index + 1) % len(self.melody)
+
+    def on_beat(self, map, music):
+        self.check_note(music, True)
+        self.advance(map)
+
+    # back to the first beat, with nothing sung yet
+    def reset(self):
+        self.melody_progress = 0
+        self.melody_index = 0
+        self.melody_complete = False
+        self.cur_pitch = None
+        self.pitch_matched = False
+        self.pacified_key = None # pacified enemies get recomputed
+        for enemy in self.enemies:
+            enemy.reset()
+        self.asleep = False
+
+    # skip beats from beat on. The player is too far away for anything to depend on them.
+    def fall_asleep(self, beat):
+        self.asleep = True
+        self.asleep_since = beat
+
+    # catch up, so that beat is the next one this group does
+    def wake(self, beat):
+        beats = beat - self.asleep_since
+        self.melody_index = (self.melody_index + beats) % len(self.melody)
+        # what check_note() does every beat with the player out of range
+        self.pitch_matched = False
+        self.cur_pitch = 0
+
+        # only projectiles shot recently enough to still be flying matter, so
+        # the beats before that are skipped in one go
+        flight_beats = max(self.map.map_size()) + 1 # longest a projectile can stay on the map
+        skip = max(beats - flight_beats, 0)
+        for enemy in self.enemies:
+            enemy.pos = enemy.actions.skip(enemy.pos, skip)
+
+        # the rest are played. With the player out of range, every enemy is
+        # pacified, so they all block projectiles.
+        shots = [] # (enemy, position, direction, beat)
+        blocked = [] # squares with an enemy on them, per beat
+        for b in range(skip, beats):
+            for enemy in self.enemies:
+                attack = enemy.step(self.melody_complete)
+                if attack != '':
+                    shots.append((enemy, enemy.pos, attack, b))
+            blocked.append(set(enemy.pos for enemy in self.enemies))
+
+        for enemy, pos, attack, b in shots:
+            moves = beats - b
+            if moves > self.map.flight_distance(pos, attack):
+                continue
+            # the k-th move is on beat b + k - 1
+            drow, dcol = direction_map[attack]
+            if any((pos[0] + drow * k, pos[1] + dcol * k) in blocked[b - skip + k - 1]
+                   for k in range(1, moves + 1)):
+                continue
+            enemy.projectiles.spawn(pos, attack, enemy.projectile_owner, self.map, moves)
+
+        self.asleep = False
+
+
+class EnemyActionDescription:
+    def __init__(self, description, enemy_group):
+        self.motions = description["motions"]
+        self.attacks = description["attacks"]
+        self.p_attacks = description["p_attacks"] if "p_attacks" in description else None
+        self.id = description["id"]
+        self.enemy_group = enemy_group
+
+        if len(self.motions) == 0:
+            self.motions = [(0, 0)]
+
+        if len(self.attacks) == 0:
+            self.attacks = [""]
+
+        # travel[k] is how far the first k motions move the enemy
+        self.travel = np.vstack(([(0, 0)], np.cumsum(self.motions, axis=0))).astype(int)
+
+        self.motion_index = 0
+        self.attack_index = 0
+
+    def get_next_pos(self, old_pos):
+        drow, dcol = self.motions[self.motion_index]
+        self.motion_index = (self.motion_index + 1) % len(self.motions)
+        return old_pos[0] + drow, old_pos[1] + dcol
+
+    # where the next beats motions take the enemy from old_pos, without going
+    # through them one by one. The attacks are skipped along with them.
+    def skip(self, old_pos, beats):
+        start = self.motion_index
+        drow, dcol = self.distance(start + beats) - self.distance(start)
+        self.motion_index = (start + beats) % len(self.motions)
+        self.attack_index = (self.attack_index + beats) % len(self.attacks)
+        return old_pos[0] + int(drow), old_pos[1] + int(dcol)
+
+    # how far the first moves motions move the enemy, cycling through them
+    def distance(self, moves):
+        cycles, rest = divmod(moves, len(self.motions))
+        return cycles * self.travel[-1] + self.travel[rest]
+
+    def get_next_attack(self, should_p_attack):
+        if should_p_attack:
+            attack = self.p_attacks[self.attack_index] if self.p_attacks else ""
+        else:
+            attack = self.attacks[self.attack_index]
+        self.attack_index = (self.attack_index + 1) % len(self.attacks)
+        return attack
+
+
+# Finds the enemy groups close enough to the player to be awake. Group centers
+# are bucketed in a coarse grid, so only the buckets around the player are looked at.
+class GroupBroadphase(object):
+    def __init__(self, enemy_groups, bucket_size = BROADPHASE_BUCKET_SIZE):
+        super(GroupBroadphase, self).__init__()
+        self.enemy_groups = enemy_groups
+        self.bucket_size = bucket_size
+        self.order = dict((eg, i) for i, eg in enumerate(enemy_groups))
+
+        entangled = self.entangled_groups(enemy_groups)
+        self.always_awake = [eg for eg in enemy_groups if eg.wake_distance is None or eg in entangled]
+        self.buckets = {}
+        self.max_distance = 0
+        for eg in enemy_groups:
+            if eg not in self.always_awake:
+                key = (eg.center[0] // bucket_size, eg.center[1] // bucket_size)
+                self.buckets.setdefault(key, []).append(eg)
+                self.max_distance = max(self.max_distance, eg.wake_distance)
+
+    # Enemies (once pacified) stop other groups' projectiles. A sleeping
+    # group's enemies are off the map, and a waking group only catches up
+    # against its own, so groups that could get in each other's way never
+    # sleep: those whose enemies walk where another group's enemies or
+    # projectiles can be, and that other group. If a group wanders off, its
+    # enemies could end up anywhere, so nobody sleeps.
+    @staticmethod
+    def entangled_groups(enemy_groups):
+        reach = [eg.reachable_squares() for eg in enemy_groups]
+        if any(squares is None for squares in reach):
+            return set(enemy_groups)
+
+        entangled = set()
+        for eg, squares in zip(enemy_groups, reach):
+            for other in enemy_groups:
+                if other is not eg and any(eg.map.is_tile_passable(square) and square in squares
+                                           for square in other.walking_squares()):
+                    entangled.update([eg, other])
+        return entangled
+
+    # list of the groups that should be awake with the player at position, in
+    # the order they were given
+    def awake_groups(self, position):
+        row, col = position
+        size = self.bucket_size
+        dist = self.max_distance
+        awake = set(self.always_awake)
+        for brow in range((row - dist) // size, (row + dist) // size + 1):
+            for bcol in range((col - dist) // size, (col + dist) // size + 1):
+                for eg in self.buckets.get((brow, bcol), ()):
+                    if eg.player_distance() <= eg.wake_distance:
+                        awake.add(eg)
+        return sorted(awake, key=self.order.get)
+
+
+# The squares an enemy group makes dangerous on every beat, in each of the
+# DANGER_MODES. Enemies cycle through their motions and attacks, and projectiles
+# fly straight, so once the group has kept the same mode for longer than a
+# projectile can fly, the dangerous squares only depend on the beat modulo the
+# group's period (the lcm of its enemies' cycle lengths).
+#
+# masks[mode][beat % period] is a bool array over the squares from origin on,
+# which covers everywhere the group can ever reach. None if the group isn't
+# tabulated: its enemies wander off, its period is longer than
+# MAX_DANGER_PERIOD, or another group's enemies could get in the way of its
+# projectiles.
+class DangerTable(object):
+    def __init__(self, group, map, flight_beats):
+        super(DangerTable, self).__init__()
+        self.group = group
+        self.flight_beats = flight_beats
+        self.masks = None
+        self.origin = (0, 0)
+
+        # the mode the group has been in since stable_since
+        self.mode = MIXED
+        self.stable_since = 0
+
+        enemies = [(tuple(desc["init_pos"]), enemy.actions) for enemy, desc
+                   in zip(group.enemies, group.description["enemies"])]
+        if group.wake_distance is None:
+            self.period = 1
+            return
+        self.period = reduce(lcm, [len(a.motions) for _, a in enemies] + [len(a.attacks) for _, a in enemies], 1)
+        if self.period > MAX_DANGER_PERIOD:
+            return
+
+        # the masks only cover the box around the squares the group can reach
+        squares = np.array([square for square in group.reachable_squares() if map.in_bounds(square)[0]])
+        if len(squares) == 0:
+            squares = np.zeros((1, 2), dtype=int)
+        r0, c0 = squares.min(axis=0)
+        r1, c1 = squares.max(axis=0) + 1
+        self.origin = (r0, c0)
+        self.shape = (r1 - r0, c1 - c0)
+
+        self.masks = [self.run(enemies, map, mode) for mode in DANGER_MODES]
+        self.reach = np.logical_or.reduce([m.any(axis=0) for m in self.masks])
+
+    # play the group's enemies on their own, never changing mode, for long
+    # enough to get to the steady state plus one period. Returns the
+    # dangerous squares of each beat of the period, from origin on.
+    def run(self, enemies, map, mode):
+        r0, c0 = self.origin
+        rows, cols = self.shape
+        masks = np.zeros((self.period, rows, cols), dtype=bool)
+        positions = [pos for pos, _ in enemies]
+        projectiles = [] # (row, col, drow, dcol)
+        for beat in range(self.flight_beats + self.period):
+            for i, (_, actions) in enumerate(enemies):
+                drow, dcol = actions.motions[beat % len(actions.motions)]
+                positions[i] = (positions[i][0] + drow, positions[i][1] + dcol)
+                if mode == PACIFIED:
+                    attack = actions.p_attacks[beat % len(actions.attacks)] if actions.p_attacks else ""
+                else:
+                    attack = actions.attacks[beat % len(actions.attacks)]
+                if attack != "":
+                    projectiles.append(positions[i] + direction_map[attack])
+
+            # every projectile moves one square, and whatever is on the map is dangerous
+            projectiles = [(r + dr, c + dc, dr, dc) for r, c, dr, dc in projectiles]
+            if beat >= self.flight_beats:
+                mask = masks[beat % self.period]
+                for r, c in positions + [p[:2] for p in projectiles]:
+                    if 0 <= r - r0 < rows and 0 <= c - c0 < cols:
+                        mask[r - r0, c - c0] = True
+
+            # projectiles die once they fly into something they can't pass through
+            blocked = set(positions) if mode != ANGRY else ()
+            projectiles = [p for p in projectiles
+                           if map.is_tile_passable(p[:2]) and p[:2] not in blocked]
+        return masks
+
+    def is_tabulated(self):
+        return self.masks is not None
+
+    # whether the group can ever make position dangerous. Only for tabulated groups.
+    def reaches(self, position):
+        r = position[0] - self.origin[0]
+        c = position[1] - self.origin[1]
+        return 0 <= r < self.reach.shape[0] and 0 <= c < self.reach.shape[1] and bool(self.reach[r, c])
+
+    # squares the group's enemies can ever be on
+    def enemy_squares(self, map):
+        squares = set()
+        for enemy, desc in zip(self.group.enemies, self.group.description["enemies"]):
+            motions = enemy.actions.motions
+            pos = tuple(desc["init_pos"])
+            for drow, dcol in motions:
+                pos = (pos[0] + drow, pos[1] + dcol)
+                squares.add(pos)
+        return squares
+
+    # call after the group's beat. The group's mode is that of its enemies.
+    def on_beat(self, beat):
+        modes = set()
+        for enemy in self.group.enemies:
+            if enemy.p_attacking:
+                modes.add(MIXED if enemy.is_passable() else PACIFIED)
+            else:
+                modes.add(ANGRY if enemy.is_passable() else CALM)
+        self.set_mode(modes.pop() if len(modes) == 1 else MIXED, beat)
+
+    # call when the group wakes up: it slept since beat, with the player out of
+    # range (see EnemyGroupState.wake). Whatever the group did before doesn't
+    # count, as it may not have happened (see LevelSimulation.seek).
+    def on_wake(self, beat):
+        self.mode = PACIFIED if self.group.melody_complete else CALM
+        self.stable_since = beat
+
+    def set_mode(self, mode, beat):
+        if mode != self.mode:
+            self.mode = mode
+            self.stable_since = beat
+
+    # whether the table gives the dangerous squares of beat
+    def is_valid(self, beat):
+        return self.masks is not None and self.mode != MIXED and \
+            beat - self.stable_since >= self.flight_beats
+
+    # the mask of the group's dangerous squares on beat, in the group's
+    # current mode. Starts at origin.
+    def mask(self, beat):
+        return self.masks[self.mode][beat % self.period]
+
+    def is_square_dangerous(self, beat, position):
+        r = position[0] - self.origin[0]
+        c = position[1] - self.origin[1]
+        mask = self.mask(beat)
+        return 0 <= r < mask.shape[0] and 0 <= c < mask.shape[1] and bool(mask[r, c])
+
+
+# The DangerTables of all the groups of a level. Answers whether a square is
+# dangerous on a beat with table lookups, as long as every awake group's
+# table is valid.
+class DangerTables(object):
+    def __init__(self, map, enemy_groups):
+        super(DangerTables, self).__init__()
+        self.map = map
+        # longest a projectile can stay on the map
+        flight_beats = max(map.map_size()) + 1
+        self.tables = dict((eg, DangerTable(eg, map, flight_beats)) for eg in enemy_groups)
+
+        # other groups' enemies could block a group's projectiles
+        for eg, table in self.tables.items():
+            if not table.is_tabulated():
+                continue
+            for other, other_table in self.tables.items():
+                if other is not eg and any(table.reaches(square) for square in other_table.enemy_squares(map)
+                                           if map.is_tile_passable(square)):
+                    table.masks = None
+                    break
+
+    def on_wake(self, group, beat):
+        self.tables[group].on_wake(beat)
+
+    def on_beat(self, awake_groups, beat):
+        for eg in awake_groups:
+            self.tables[eg].on_beat(beat)
+
+    # whether position is dangerous on beat, or None if the tables can't tell.
+    # Groups that are asleep are too far away to matter.
+    def is_square_dangerous(self, awake_groups, beat, position):
+        tables = [self.tables[eg] for eg in awake_groups]
+        if not all(table.is_valid(beat) for table in tables):
+            return None
+        return any(table.is_square_dangerous(beat, position) for table in tables)
+
+    # a map of the squares that will be dangerous on beat, if the awake groups
+    # stay in the mode they are in. Groups without a table (or with a MIXED
+    # mode) are left out.
+    def preview(self, awake_groups, beat):
+        result = np.zeros(self.map.map_size(), dtype=bool)
+        for eg in awake_groups:
+            table = self.tables[eg]
+            if table.is_tabulated() and table.mode != MIXED:
+                mask = table.mask(beat)
+                r0, c0 = table.origin
+                result[r0:r0 + mask.shape[0], c0:c0 + mask.shape[1]] |= mask
+        return result
+
+
+def lcm(a, b):
+    return a * b // gcd(a, b)
+
+
+# Judges one snapshot of the player's singing against the target notes of many
+# enemy groups at once. The snapshot is boiled down to a saturation per pitch
+# class, so each group's judgement is a table lookup.
+class NoteJudgement(object):
+    def __init__(self, music):
+        super(NoteJudgement, self).__init__()
+        self.is_pitch = music is not None and music.is_pitch()
+        if self.is_pitch:
+            self.saturations = np.array([music.to_saturation(pc) for pc in range(12)], dtype=float)
+            self.held_midi = music.get_held_midi()
+        else:
+            self.saturations = np.zeros(12)
+            self.held_midi = None
+
+        # results of the last judge(): the groups judged, and for each of them
+        # whether the note was correct and how close it was
+        self.groups = []
+        self.correct = np.zeros(0, dtype=bool)
+        self.saturation = np.zeros(0)
+
+    def judge(self, enemy_groups, is_last):
+        groups = []
+        for eg in enemy_groups:
+            if eg.needs_judgement():
+                groups.append(eg)
+            elif not eg.pitch_matched:
+                eg.cur_pitch = 0
+
+        targets = np.array([eg.target_note() % 12 for eg in groups], dtype=int)
+        rests = np.array([eg.is_rest() for eg in groups], dtype=bool)
+        self.groups = groups
+        self.saturation = self.saturations[targets]
+        self.correct = rests | (self.saturation == 1)
+
+        for eg, correct, saturation in zip(groups, self.correct, self.saturation):
+            eg.apply_judgement(bool(correct), float(saturation), self.held_midi, is_last)
+
+
+def enemy_group_states_from_spec(filename, map, projectiles):
+    with open(filename) as f:
+        specs = json.load(f)
+    return [EnemyGroupState(desc, map, projectiles) for desc in specs]
+
+
+# A whole level: the map, the player and the enemy groups. The beat is split
+# up the same way Level schedules it: beat_on (just before the beat),
+# beat_on_exact (on the beat) and beat_off (just after the beat, or as soon as
+# the player moves). step_beat() does all three at once.
+#
+# sleep = False keeps every group awake, and tables = False looks up danger on
+# the map only. The level plays the same either way, just slower; they are
+# there to check the shortcuts against.
+class LevelSimulation(object):
+    def __init__(self, map, enemy_groups, projectiles, sleep = True, tables = True):
+        super(LevelSimulation, self).__init__()
+        self.map = map
+        self.player = PlayerState(map)
+        self.enemy_groups = enemy_groups
+        self.projectiles = projectiles
+        self.broadphase = GroupBroadphase(enemy_groups) if sleep else None
+        self.awake_groups = list(enemy_groups)
+        self.danger = DangerTables(map, enemy_groups) if tables else None
+        self.judgement = None # the most recent NoteJudgement
+
+        self.beat = 0 # number of beats started so far
+        self.restart_pause_time_remaining = 0
+        self.deaths = 0
+
+    @staticmethod
+    def from_dir(level_dir, sleep = True, tables = True):
+        map = MapState.from_file(level_dir + "/advanced_map.txt")
+        projectiles = ProjectileSystem()
+        enemy_groups = enemy_group_states_from_spec(level_dir + "/enemies.json", map, projectiles)
+        return LevelSimulation(map, enemy_groups, projectiles, sleep, tables)
+
+    def beat_on(self):
+        self.map.start_new_timestep()
+
+    # get_music returns the current music input (or None). It is called once,
+    # and all the groups are judged on that one snapshot.
+    def beat_on_exact(self, get_music = None):
+        awake = self.wake_groups()
+
+        self.judge_notes(get_music() if get_music else None, True)
+        for eg in awake:
+            eg.advance(self.map)
+
+        # projectiles shot this beat make their first move too
+        self.projectiles.on_beat(self.map)
+        self.projectiles.cull(self.map)
+        if self.danger is not None:
+            self.danger.on_beat(awake, self.beat)
+
+        self.beat += 1
+
+    # only groups near the player do anything. The others are left alone
+    # until the player comes close, and then catch up. Returns the awake groups.
+    def wake_groups(self):
+        if self.broadphase is None:
+            awake = list(self.enemy_groups)
+        else:
+            awake = self.broadphase.awake_groups(self.map.player_location())
+        for eg in set(self.awake_groups) - set(awake):
+            eg.fall_asleep(self.beat)
+        self.awake_groups = awake
+
+        for eg in awake:
+            if eg.asleep:
+                if self.danger is not None:
+                    self.danger.on_wake(eg, eg.asleep_since)
+                eg.wake(self.beat)
+        return awake
+
+    # jump to just before beat (counting from 0), with the player back at the
+    # start and nothing sung. Enemies keep to their schedules whatever the
+    # player does, so this doesn't play through the beats in between: every
+    # group sleeps from the start, and catches up when it wakes up (right
+    # away for the groups near the player).
+    def seek(self, beat):
+        self.map.start_new_timestep()
+        self.projectiles.clear()
+        self.player.return_to_start()
+        self.player.disabled = False
+        self.restart_pause_time_remaining = 0
+        self.judgement = None
+
+        for eg in self.enemy_groups:
+            eg.reset()
+            eg.fall_asleep(0)
+        self.awake_groups = []
+        self.beat = beat
+        self.wake_groups()
+
+    # called with every new bit of music input in between beats
+    def receive_audio(self, get_music):
+        self.judge_notes(get_music(), False)
+
+    # judge the music (which may be None) for all the awake groups at once.
+    # is_last is True on the beat, when a wrong note finally counts against the player.
+    def judge_notes(self, music, is_last):
+        self.judgement = NoteJudgement(music)
+        self.judgement.judge(self.awake_groups, is_last)
+        self.map.enemies_changed()
+        return self.judgement
+
+    # moves the player. Returns True if the player reached the exit.
+    def beat_off(self, movement):
+        if self.restart_pause_time_remaining > 0:
+            # player can't move due to losing recently
+            self.restart_pause_time_remaining -= 1
+            if self.restart_pause_time_remaining == RESET_MOVE_BACK_TIME:
+                self.player.return_to_start()
+            elif self.restart_pause_time_remaining == 0:
+                self.player.disabled = False
+            return False
+
+        self.player.on_beat(movement)
+
+        # handle game over
+        if self.is_square_dangerous(self.map.player_location()):
+            self.restart()
+
+        # handle move to next level
+        return self.map.is_player_at_exit()
+
+    # whether position is dangerous on the current beat. Looked up in the
+    # danger tables, or else in what is on the map.
+    def is_square_dangerous(self, position):
+        if position is None:
+            return False
+        danger = None
+        if self.danger is not None:
+            danger = self.danger.is_square_dangerous(self.awake_groups, self.beat - 1, position)
+        if danger is None:
+            return self.map.is_square_dangerous(position)
+        return danger
+
+    # the squares that will be dangerous on the next beat, as far as the danger tables know
+    def danger_preview(self):
+        if self.danger is None:
+            return np.zeros(self.map.map_size(), dtype=bool)
+        return self.danger.preview(self.awake_groups, self.beat)
+
+    def restart(self):
+        self.player.disabled = True
+        self.restart_pause_time_remaining = RESET_PAUSE_TIME
+        self.deaths += 1
+
+    def step_beat(self, movement = (0, 0), get_music = None):
+        self.beat_on()
+        self.beat_on_exact(get_music)
+        return self.beat_off(movement)
@@ -0,0 +1,143 @@
+import os
+import tempfile
+
+from kivy.core.image import Image as CoreImage, ImageLoader
+from kivy.atlas import Atlas
+
+# Hands out textures for sprites, by path. Sprites are looked up by file name
+# without regard to case (the sprite files and the paths that refer to them
+# don't always agree on .png vs .PNG), and each one is only loaded once.
+#
+# Small sprites are packed into an atlas, so they all share one texture. A
+# pre-baked atlas at data/sprites/sprites.atlas is used if there is one.
+# Otherwise, one is packed into ATLAS_CACHE_DIR (this needs PIL), and reused
+# there until the sprites change. Without either, each sprite gets its own
+# texture.
+#
+# Textures can only be made on the main thread, but decoding the image files
+# can be done ahead of time on any thread, with preload_sprites.
+
+SPRITE_DIR = './data/sprites/'
+ATLAS_NAME = 'sprites'
+ATLAS_SIZE = 2048
+ATLAS_MAX_SPRITE_SIZE = 512 # bigger images (ie, splash screens) stay out of the atlas
+ATLAS_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'dunjams_atlas')
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+class SpriteManager(object):
+    def __init__(self, sprite_dir = SPRITE_DIR):
+        super(SpriteManager, self).__init__()
+        self.sprite_dir = sprite_dir
+
+        # lowercase file name -> actual file name
+        self.files = dict((name.lower(), name) for name in os.listdir(sprite_dir)
+                          if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+
+        self.textures = {} # lowercase file name -> texture
+        self.decoded = {} # lowercase file name -> decoded image that has no texture yet
+        self.atlas = self.load_atlas()
+
+    def load_atlas(self):
+        atlas_path = os.path.join(self.sprite_dir, ATLAS_NAME + '.atlas')
+        if not os.path.exists(atlas_path):
+            atlas_path = self.pack_atlas()
+            if atlas_path is None:
+                return None
+        return Atlas(atlas_path)
+
+    # pack the small sprites into an atlas in ATLAS_CACHE_DIR, unless the one
+    # there is up to date. Returns its path, or None if it can't be done.
+    def pack_atlas(self):
+        cached_path = os.path.join(ATLAS_CACHE_DIR, ATLAS_NAME + '.atlas')
+        if self.is_up_to_date(cached_path):
+            return cached_path
+
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+
+        filenames = []
+        for name in sorted(self.files.values()):
+            filename = os.path.join(self.sprite_dir, name)
+            width, height = Image.open(filename).size
+            if width <= ATLAS_MAX_SPRITE_SIZE and height <= ATLAS_MAX_SPRITE_SIZE:
+                filenames.append(filename)
+
+        if not os.path.exists(ATLAS_CACHE_DIR):
+            os.makedirs(ATLAS_CACHE_DIR)
+        result = Atlas.create(os.path.join(ATLAS_CACHE_DIR, ATLAS_NAME), filenames, ATLAS_SIZE)
+        if not result:
+            return None
+        return result[0]
+
+    # whether the atlas at atlas_path was packed after any sprite last changed.
+    # Atlas.create writes the .atlas file after its images, so it's the newest.
+    # The sprite directory itself changes when sprites are added or removed.
+    def is_up_to_date(self, atlas_path):
+        if not os.path.exists(atlas_path):
+            return False
+        sources = [self.sprite_dir] + [os.path.join(self.sprite_dir, name) for name in self.files.values()]
+        return os.path.getmtime(atlas_path) > max(os.path.getmtime(path) for path in sources)
+
+    # the texture for the sprite at path
+    def get(self, path):
+        key = os.path.basename(path).lower()
+        if key not in self.textures:
+            self.textures[key] = self.load(key, path)
+        return self.textures[key]
+
+    def load(self, key, path):
+        decoded = self.decoded.pop(key, None)
+        if decoded is not None:
+            return CoreImage(decoded).texture
+
+        name = self.files.get(key)
+        if name is None:
+            return CoreImage(path).texture # not one of ours, so load it as is
+
+        atlas_id = os.path.splitext(name)[0]
+        if self.atlas is not None and atlas_id in self.atlas.textures:
+            return self.atlas[atlas_id]
+        return CoreImage(os.path.join(self.sprite_dir, name)).texture
+
+    # decode the images of the sprites at paths that don't have a texture yet,
+    # so that get only has to make their textures. Safe to call from any thread.
+    def preload(self, paths):
+        for path in paths:
+            key = os.path.basename(path).lower()
+            if key in self.textures or key in self.decoded:
+                continue
+            name = self.files.get(key)
+            if name is None:
+                filename = path
+            elif self.atlas is not None and os.path.splitext(name)[0] in self.atlas.textures:
+                continue # already in the atlas' texture
+            else:
+                filename = os.path.join(self.sprite_dir, name)
+            self.decoded[key] = ImageLoader.load(filename)
+
+
+# the SpriteManager is made on first use, once there is a window to load textures for
+sprite_manager = None
+
+def get_texture(path):
+    global sprite_manager
+    if sprite_manager is None:
+        sprite_manager = SpriteManager()
+    return sprite_manager.get(path)
+
+# decode the sprites at paths ahead of time (ie, on a worker thread). Only
+# does anything once the SpriteManager exists, since making it loads textures.
+def preload_sprites(paths):
+    if sprite_manager is not None:
+        sprite_manager.preload(paths)
+
+# show the sprite at path on instruction (ie, a Rectangle). Does nothing if
+# it already shows it.
+def set_sprite(instruction, path):
+    texture = get_texture(path)
+    if instruction.texture is not texture:
+        instruction.texture = texture
@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+# the game's modules are at the top of the repo, and open their data by paths
+# relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+# config.py needs the machine's environment.py, which isn't in the repo (see
+# config.py). Without one, the tests get the default calibration.
+try:
+    import environment
+except ImportError:
+    environment = types.ModuleType("environment")
+    environment.ENVIRONMENT = "tests"
+    sys.modules["environment"] = environment
+
+
+# imported_packages(module, packages) imports module in a fresh interpreter, and
+# returns which of packages (ie, kivy) got imported along with it
+@pytest.fixture
+def imported_packages():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def imported(module, packages):
+        code = ("import sys; sys.path.insert(0, %r); import conftest, %s; "
+                "print(' '.join(sorted(set(m.split('.')[0] for m in sys.modules) & set(%r))))" %
+                (tests_dir, module, packages))
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=tests_dir)
+        return output.decode().splitlines()[-1].split() if output.strip() else []
+    return imported
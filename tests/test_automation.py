@@ -0,0 +1,73 @@
+import numpy as np
+
+from common.automation import Automation, ScheduledGenerator
+from common.clock import AudioScheduler, SimpleTempoMap, kTicksPerQuarter
+
+
+class Ones(object):
+    def generate(self, num_frames, num_channels):
+        return np.ones(num_frames * num_channels), True
+
+
+# the automation's values for the first num_frames frames, rendered in blocks of
+# block_size (or per frame)
+def render(changes, num_frames, block_size):
+    sched = AudioScheduler(SimpleTempoMap(120))
+    automation = Automation(sched, 1.0)
+    for change in changes:
+        change(automation)
+    values = []
+    while sched.cur_frame < num_frames:
+        block = automation.render(block_size)
+        values.extend(np.broadcast_to(block, block_size).tolist())
+        sched.generate(block_size, 1)
+    return np.array(values[:num_frames])
+
+CHANGES = [
+    lambda a: a.set_at_tick(100, 0.5),
+    lambda a: a.ramp_at_tick(400, 0.0, kTicksPerQuarter),
+    # interrupts the ramp halfway
+    lambda a: a.ramp_at_tick(400 + kTicksPerQuarter // 2, 2.0, 100),
+    lambda a: a.set_at_tick(3000, 1.0),
+]
+
+
+def test_automation_is_the_same_whatever_the_block_size():
+    by_frame = render(CHANGES, 4 * 44100, 1)
+    for block_size in [64, 500, 512, 4096]:
+        assert np.allclose(render(CHANGES, 4 * 44100, block_size), by_frame)
+
+def test_automation_changes_land_on_exact_frames():
+    sched = AudioScheduler(SimpleTempoMap(120))
+    values = render(CHANGES, 4 * 44100, 512)
+    set_frame = sched.tick_to_frame(100)
+    ramp_start = sched.tick_to_frame(400)
+    ramp_end = sched.tick_to_frame(400 + kTicksPerQuarter)
+    interrupted = sched.tick_to_frame(400 + kTicksPerQuarter // 2)
+
+    assert values[set_frame - 1] == 1.0 and values[set_frame] == 0.5
+    assert values[ramp_start] == 0.5
+    # a quarter of the way through the ramp
+    assert np.isclose(values[ramp_start + (ramp_end - ramp_start) // 4], 0.375, atol = 1e-3)
+    assert np.isclose(values[interrupted], 0.25, atol = 1e-3)
+    assert values[sched.tick_to_frame(400 + kTicksPerQuarter // 2 + 100)] == 2.0
+    assert values[sched.tick_to_frame(3000)] == 1.0
+
+def test_automation_without_changes_renders_a_float():
+    sched = AudioScheduler(SimpleTempoMap(120))
+    automation = Automation(sched, 0.25)
+    assert automation.render(512) == 0.25
+
+
+def test_scheduled_generator_plays_between_its_frames():
+    sched = AudioScheduler(SimpleTempoMap(120))
+    generator = ScheduledGenerator(sched, Ones(), 0.5)
+    generator.start_at_tick(100)
+    generator.stop_at_tick(700)
+    sched.set_generator(generator)
+    output = np.concatenate([sched.generate(512, 2)[0] for _ in range(100)])
+
+    start, stop = sched.tick_to_frame(100), sched.tick_to_frame(700)
+    expected = np.zeros(len(output) // 2)
+    expected[start:stop] = 0.5
+    assert np.array_equal(output, np.repeat(expected, 2))
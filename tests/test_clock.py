@@ -0,0 +1,112 @@
+import json
+
+import numpy as np
+
+from common.clock import TempoMap, SimpleTempoMap, AudioScheduler, Command, DispatchStats, kTicksPerQuarter
+from common.audioconfig import SAMPLE_RATE
+
+# 120 bpm, then 60, then 180
+TEMPO_DATA = [(0, 0), (2, 4 * kTicksPerQuarter), (6, 8 * kTicksPerQuarter), (8, 14 * kTicksPerQuarter)]
+
+
+def test_tempo_map_lookups():
+    tempo_map = TempoMap(TEMPO_DATA)
+    assert tempo_map.time_to_tick(1) == 2 * kTicksPerQuarter
+    assert tempo_map.time_to_tick(4) == 6 * kTicksPerQuarter
+    assert tempo_map.tick_to_time(11 * kTicksPerQuarter) == 7
+    assert [tempo_map.get_tempo(t) for t in [1, 4, 7]] == [120, 60, 180]
+    # past the last point, the last segment goes on
+    assert tempo_map.time_to_tick(10) == 20 * kTicksPerQuarter
+
+def test_tempo_map_arrays_match_single_lookups():
+    rng = np.random.RandomState(0)
+    times = np.concatenate([np.linspace(-1, 10, 200), rng.uniform(-1, 10, 200), [0, 2, 6, 8]])
+    ticks = np.concatenate([np.linspace(-100, 5000, 200), rng.uniform(-100, 5000, 200), [0, 1920, 3840]])
+
+    # single lookups go in order and out of order, which uses the remembered segment both ways
+    tempo_map = TempoMap(TEMPO_DATA)
+    assert np.allclose(tempo_map.times_to_ticks(times), [tempo_map.time_to_tick(t) for t in times])
+    assert np.allclose(tempo_map.ticks_to_times(ticks), [tempo_map.tick_to_time(t) for t in ticks])
+
+    simple = SimpleTempoMap(90)
+    simple.set_tempo(150, 3)
+    assert simple.times_to_ticks(times).tolist() == [simple.time_to_tick(t) for t in times]
+    assert np.allclose(simple.ticks_to_times(ticks), [simple.tick_to_time(t) for t in ticks])
+
+
+def test_scheduler_splits_the_buffer_at_the_command():
+    sched = AudioScheduler(SimpleTempoMap(120))
+    frames = []
+    tick = kTicksPerQuarter // 7
+    frame = sched.tick_to_frame(tick)
+    sched.post_at_tick(lambda tick, arg: frames.append(sched.cur_frame), tick)
+    sched.post_at_tick(lambda tick, arg: frames.append(sched.cur_frame), tick, deferred = True)
+    while sched.cur_frame <= frame:
+        sched.generate(512, 2)
+    sched.on_update()
+
+    # the regular command runs at its exact frame, the deferred one on the next update
+    assert frames[0] == frame and frames[1] == sched.cur_frame
+    assert sched.tick_to_frame(kTicksPerQuarter * 2) == SAMPLE_RATE
+
+
+def on_beat(tick, arg):
+    pass
+
+def on_note(tick, arg):
+    pass
+
+def test_unsplit_commands_are_on_time():
+    sched = AudioScheduler(SimpleTempoMap(120))
+    sched.post_at_tick(on_beat, kTicksPerQuarter // 7, split = False)
+    for _ in range(10):
+        sched.generate(512, 2)
+    lateness = sched.stats.get_records()['lateness']
+    assert len(lateness) == 1 and 0 <= lateness[0] < .001
+
+
+# a DispatchStats of size records, with num_beats on_beat records 12ms late
+# each and one on_note record, in between, 50ms early
+def filled_stats(size, num_beats):
+    stats = DispatchStats(size)
+    for i in range(num_beats):
+        stats.run(Command(i, on_beat, None), i, i + .012, i * 100)
+        if i == num_beats // 2:
+            stats.run(Command(i, on_note, None), i, i - .05, i * 100)
+    return stats
+
+def test_dispatch_stats_keep_the_latest_records():
+    stats = filled_stats(8, 20)
+    assert stats.count == 21
+    records = stats.get_records()
+    assert records['target_time'].tolist() == list(range(12, 20))
+    assert records['name'] == ['on_beat'] * 8
+    assert np.allclose(records['lateness'], .012)
+
+    stats = filled_stats(8, 6)
+    beats = stats.get_records('on_beat')
+    assert beats['target_time'].tolist() == list(range(6)) and beats['dispatch_frame'].tolist() == [0, 100, 200, 300, 400, 500]
+    assert stats.get_records('on_note')['target_time'].tolist() == [3]
+    assert len(stats.get_records('on_chord')['lateness']) == 0
+
+    stats.clear()
+    assert len(stats.get_records()['name']) == 0
+
+def test_dispatch_stats_summaries(tmpdir):
+    stats = filled_stats(64, 20)
+    counts, edges = stats.lateness_histogram('on_beat', bin_ms = 5, max_ms = 100)
+    assert counts.sum() == 20 and counts[np.searchsorted(edges, 12) - 1] == 20
+    counts, edges = stats.lateness_histogram('on_note', bin_ms = 5, max_ms = 20)
+    assert counts[0] == 1 # clipped into the first bin
+
+    summary = stats.summary()
+    assert summary['on_beat']['count'] == 20 and np.isclose(summary['on_beat']['lateness_p95'], 12)
+    assert np.isclose(summary['on_note']['lateness_max'], -50)
+
+    path = str(tmpdir.join("stats.json"))
+    stats.export(path)
+    with open(path) as f:
+        exported = json.load(f)
+    assert exported['summary'] == summary
+    assert exported['histograms']['on_beat']['counts'] == stats.lateness_histogram('on_beat')[0].tolist()
+    assert exported['records']['name'] == stats.get_records()['name']
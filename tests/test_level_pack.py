@@ -0,0 +1,108 @@
+import json
+import shutil
+import wave
+
+import numpy as np
+import pytest
+
+from level_pack import compile_level, current_pack, LevelPack, LevelPackError
+from simulation import LevelSimulation
+
+LEVEL_DIR = "data/basic_world/level0"
+LEVELS = ["data/basic_world/level0", "data/basic_world/level2", "data/basic_world/level3"]
+
+
+def test_level_pack_imports_without_kivy_or_audio(imported_packages):
+    assert imported_packages("level_pack", ["kivy", "pyaudio"]) == []
+
+
+# a copy of LEVEL_DIR with change(specs) made to its enemies.json
+def changed_level(tmpdir, change):
+    level_dir = str(tmpdir.join("level"))
+    shutil.copytree(LEVEL_DIR, level_dir)
+    with open(level_dir + "/enemies.json") as f:
+        specs = json.load(f)
+    change(specs)
+    with open(level_dir + "/enemies.json", "w") as f:
+        json.dump(specs, f)
+    return level_dir
+
+def compile_errors(level_dir, tmpdir):
+    with pytest.raises(LevelPackError) as error:
+        compile_level(level_dir, str(tmpdir.join("level.pack")))
+    return error.value.errors
+
+def test_compiles_a_level(tmpdir):
+    compile_level(LEVEL_DIR, str(tmpdir.join("level.pack")))
+
+@pytest.mark.parametrize("level_dir", LEVELS)
+def test_pack_matches_the_level_files(level_dir, tmpdir):
+    pack = LevelPack(compile_level(level_dir, str(tmpdir.join("level.pack"))))
+    with open(level_dir + "/enemies.json") as f:
+        assert pack.enemy_specs() == json.load(f)
+
+    packed = pack.simulation()
+    loaded = LevelSimulation.from_dir(level_dir)
+    assert np.array_equal(packed.map.grid, loaded.map.grid)
+    assert np.array_equal(packed.map.in_map, loaded.map.in_map)
+    assert packed.map.player_start_location() == loaded.map.player_start_location()
+
+    # and the level plays the same
+    rng = np.random.RandomState(0)
+    for _ in range(500):
+        movement = [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)][rng.randint(5)]
+        assert packed.step_beat(movement) == loaded.step_beat(movement)
+        assert (packed.player.position, packed.deaths) == (loaded.player.position, loaded.deaths)
+        assert [e.pos for eg in packed.enemy_groups for e in eg.enemies] == \
+            [e.pos for eg in loaded.enemy_groups for e in eg.enemies]
+        assert np.array_equal(packed.projectiles.next_pos[packed.projectiles.live_slots()],
+                              loaded.projectiles.next_pos[loaded.projectiles.live_slots()])
+
+def test_rejects_p_attacks_shorter_than_attacks(tmpdir):
+    def change(specs):
+        enemy = specs[0]["enemies"][0]
+        enemy["attacks"] = ["u", "d", "l"]
+        enemy["p_attacks"] = ["u"]
+    errors = compile_errors(changed_level(tmpdir, change), tmpdir)
+    assert any("p_attacks has 1 entries, fewer than attacks (3)" in error for error in errors)
+
+def test_rejects_a_melody_without_a_note_per_enemy(tmpdir):
+    def change(specs):
+        specs[0]["pacify"] = "all"
+        specs[0]["melody"] = specs[0]["melody"] + [67]
+    errors = compile_errors(changed_level(tmpdir, change), tmpdir)
+    assert any("melody has" in error for error in errors)
+
+def test_rejects_motions_into_a_wall(tmpdir):
+    def change(specs):
+        specs[0]["enemies"][0]["init_pos"] = [5, 12]
+        specs[0]["enemies"][0]["motions"] = [[1, 0], [-1, 0]]
+    errors = compile_errors(changed_level(tmpdir, change), tmpdir)
+    assert any("motions take it to [6, 12], inside a wall" in error for error in errors)
+
+def test_rejects_music_at_another_sample_rate(tmpdir):
+    level_dir = changed_level(tmpdir, lambda specs: None)
+    with wave.open(level_dir + "/background.wav", "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(22050)
+        f.writeframes(b"\0" * 4000)
+    errors = compile_errors(level_dir, tmpdir)
+    assert any("must be 16 bit at 44100 Hz, is 16 bit at 22050 Hz" in error for error in errors)
+
+def test_stale_packs_are_not_used(tmpdir):
+    level_dir = changed_level(tmpdir, lambda specs: None)
+    assert current_pack(level_dir) is None
+    compile_level(level_dir)
+    assert current_pack(level_dir) is not None
+
+    # enemies.json edited after compiling
+    with open(level_dir + "/enemies.json") as f:
+        specs = json.load(f)
+    specs[0]["sound_thresh"] += 1
+    with open(level_dir + "/enemies.json", "w") as f:
+        json.dump(specs, f)
+    assert current_pack(level_dir) is None
+
+    compile_level(level_dir)
+    assert current_pack(level_dir).enemy_specs() == specs
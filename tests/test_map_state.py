@@ -0,0 +1,31 @@
+import numpy as np
+
+from benchmark import crowded_map, Enemy
+
+
+def all_squares(map):
+    rows, cols = map.grid.shape
+    return np.array([(r, c) for r in range(-1, rows + 1) for c in range(-1, cols + 1)])
+
+def test_passable_matches_is_square_passable():
+    map, enemies = crowded_map(64)
+    squares = all_squares(map)
+    assert map.passable(squares).tolist() == [map.is_square_passable(tuple(s)) for s in squares]
+
+def test_passable_follows_enemies_changing():
+    map, enemies = crowded_map(64)
+    squares = all_squares(map)
+    map.passable(squares)
+
+    for enemy in enemies:
+        enemy.pacified = not enemy.pacified
+    map.enemies_changed()
+    assert map.passable(squares).tolist() == [map.is_square_passable(tuple(s)) for s in squares]
+
+    # and enemies added later block too
+    map.add_enemy(tuple(np.argwhere(map.passable_mask)[0]), Enemy(False))
+    assert map.passable(squares).tolist() == [map.is_square_passable(tuple(s)) for s in squares]
+
+    # a new timestep starts with nobody on the map
+    map.start_new_timestep()
+    assert map.passable(squares).tolist() == [map.is_tile_passable(tuple(s)) for s in squares]
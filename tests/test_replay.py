@@ -0,0 +1,113 @@
+import random
+
+import numpy as np
+
+import replay
+from replay import HeadlessGame, InputRecorder, read_log, key_value, \
+    BEAT_ON, BEAT_ON_EXACT, HALF_BEAT, BEAT_OFF, KEY_DOWN, KEY_UP, PITCH, CHECK
+
+
+def test_replay_imports_without_kivy_or_audio(imported_packages):
+    assert imported_packages("replay", ["kivy", "pyaudio", "aubio"]) == []
+
+
+# A HeadlessGame that records a session as Game and Level would, from
+# random keys and pitches in between the beat commands
+class RecordingGame(HeadlessGame):
+    def __init__(self, path, seed, start_beat = 0):
+        self.recorder = InputRecorder(path, start_beat)
+        self.rng = random.Random(seed)
+        self.frame = 0
+        super(RecordingGame, self).__init__(np.zeros(0, dtype=replay.LOG_RECORD), start_beat)
+
+    def record(self, kind, value = 0):
+        self.recorder.record(kind, self.screen_index, self.frame, value)
+
+    def press_key(self, keycode, modifiers):
+        self.record(KEY_DOWN, key_value(keycode))
+        super(RecordingGame, self).press_key(keycode, modifiers)
+
+    def release_key(self, keycode):
+        self.record(KEY_UP, key_value(keycode))
+        super(RecordingGame, self).release_key(keycode)
+
+    def receive_pitch(self, midi):
+        self.record(PITCH, midi)
+        super(RecordingGame, self).receive_pitch(midi)
+
+    def run_command(self, kind):
+        self.record(kind)
+        super(RecordingGame, self).run_command(kind)
+
+    def perform_beat_off(self):
+        at_exit = self.driver.beat_off()
+        if at_exit is None:
+            return
+        self.record(CHECK, self.driver.digest())
+        if at_exit:
+            self.next_screen()
+
+    def play(self, beats):
+        held = None
+        for _ in range(beats):
+            self.frame += 1000
+            if self.driver is None:
+                self.press_key((0, "spacebar"), [])
+                continue
+            for kind in (BEAT_ON, BEAT_ON_EXACT, HALF_BEAT, BEAT_OFF):
+                for _ in range(self.rng.randint(0, 3)):
+                    self.frame += 10
+                    r = self.rng.random()
+                    if r < 0.2 and held is None:
+                        held = self.rng.choice(["up", "down", "left", "right", "right"])
+                        self.press_key((0, held), [])
+                    elif r < 0.4 and held is not None:
+                        self.release_key((0, held))
+                        held = None
+                    else:
+                        self.receive_pitch(self.rng.choice([0, 60.2, 62, 64.4, 65, 67]))
+                if self.driver is None:
+                    break
+                self.run_command(kind)
+        self.finish_screen()
+        self.recorder.close()
+
+
+def recorded_session(tmpdir, beats = 300, seed = 0, start_beat = 0):
+    path = str(tmpdir.join("session.dunjlog"))
+    game = RecordingGame(path, seed, start_beat)
+    game.play(beats)
+    return path, game.results
+
+def test_replay_plays_the_recorded_game(tmpdir):
+    path, results = recorded_session(tmpdir)
+    game = HeadlessGame(*read_log(path))
+    assert game.run() == []
+    assert [r[:4] for r in game.results] == [r[:4] for r in results]
+
+# LEVEL_START_BEAT is in the log, so the replay starts the levels there too
+def test_replay_starts_levels_at_the_recorded_beat(tmpdir):
+    path, results = recorded_session(tmpdir, start_beat = 8)
+    log, start_beat = read_log(path)
+    assert start_beat == 8
+    game = HeadlessGame(log, start_beat)
+    assert game.run() == []
+    assert [r[:4] for r in game.results] == [r[:4] for r in results]
+    assert HeadlessGame(log).run() != []
+
+def test_replay_finds_a_changed_input(tmpdir):
+    path, results = recorded_session(tmpdir)
+    log, start_beat = read_log(path)
+    log = log.copy()
+    keys = np.flatnonzero(log["kind"] == KEY_DOWN)
+    log["value"][keys[len(keys) // 2]] = (log["value"][keys[len(keys) // 2]] + 1) % 4
+    assert HeadlessGame(log).run() != []
+
+def test_cut_off_log_loses_only_its_last_record(tmpdir):
+    path, results = recorded_session(tmpdir, beats = 10)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-3])
+    header = len(replay.LOG_MAGIC) + replay.LOG_HEADER.size
+    assert len(read_log(path)[0]) == (len(data) - header) // replay.LOG_RECORD.itemsize - 1
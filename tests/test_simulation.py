@@ -0,0 +1,268 @@
+import numpy as np
+import pytest
+
+from music_controller import Pitch
+from simulation import LevelSimulation, MapState, ProjectileSystem, EnemyGroupState, OccupancyGrid, \
+    NoteJudgement
+
+LEVELS = ["data/basic_world/level0", "data/basic_world/level2", "data/basic_world/level3"]
+MOVES = [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1), (0, 1)]
+PITCHES_PER_BEAT = 20
+
+
+# a pitch held long enough to count
+def held_note(midi):
+    music = Pitch()
+    music.set_tempo(120)
+    for _ in range(PITCHES_PER_BEAT):
+        music.add_pitch(midi)
+    return music
+
+# what a player does on each of num_beats: (movement, note sung or None), at random
+def random_inputs(sim, num_beats, seed = 0):
+    rng = np.random.RandomState(seed)
+    notes = sorted(set(note for eg in sim.enemy_groups for note in eg.melody if note))
+    inputs = []
+    for _ in range(num_beats):
+        movement = MOVES[rng.randint(len(MOVES))]
+        note = notes[rng.randint(len(notes))] if notes and rng.rand() < .7 else None
+        inputs.append((movement, note))
+    return inputs
+
+# play the inputs, and return what the player saw on every beat
+def play(sim, inputs):
+    songs = {}
+    seen = []
+    for movement, note in inputs:
+        if note is not None and note not in songs:
+            songs[note] = held_note(note)
+        at_exit = sim.step_beat(movement, lambda: songs.get(note))
+        seen.append((sim.player.position, sim.deaths, at_exit))
+    return seen
+
+
+# what the awake groups and projectiles are up to
+def snapshot(sim):
+    enemies = [(e.pos, e.actions.motion_index, e.actions.attack_index)
+               for eg in sim.awake_groups for e in eg.enemies]
+    melody = [eg.melody_index for eg in sim.awake_groups]
+    projectiles = sorted(map(tuple, sim.projectiles.next_pos[sim.projectiles.live_slots()].tolist()))
+    return enemies, melody, projectiles, sim.player.position, sim.beat
+
+
+# a long corridor with num_groups enemy groups along it, far enough apart that
+# only the ones near the player are awake. The exit is at the far end.
+def corridor_level(num_groups, spacing = 40):
+    width = spacing * num_groups + 10
+    rows = ["w" * width] + ["w" + " " * (width - 2) + "w" for _ in range(5)] + ["w" * width]
+    rows[3] = "wp" + " " * (width - 4) + "ew"
+    map = MapState.from_rows(rows)
+    projectiles = ProjectileSystem()
+    groups = []
+    for i in range(num_groups):
+        col = spacing * (i + 1)
+        enemies = [{"id": 0, "init_pos": [1, col], "motions": [[0, 1], [0, -1]],
+                    "attacks": ["d", "", ""], "p_attacks": ["", "", "d"], "note": 60},
+                   {"id": 1, "init_pos": [5, col + 2], "motions": [[0, -1], [0, 1]],
+                    "attacks": ["", "u", "u"], "p_attacks": ["", "", ""], "note": 64}]
+        description = {"enemies": enemies, "melody": [60, 64], "pacify": "individual" if i % 2 else "all",
+                       "center": [3, col + 1], "sound_thresh": 5, "mel_thresh": 3}
+        groups.append(EnemyGroupState(description, map, projectiles))
+    return map, groups, projectiles
+
+def corridor_simulation(num_groups = 6, sleep = True, tables = True):
+    map, groups, projectiles = corridor_level(num_groups)
+    return LevelSimulation(map, groups, projectiles, sleep, tables)
+
+
+@pytest.mark.parametrize("level_dir", LEVELS)
+def test_seek_matches_stepping(level_dir):
+    stepped = LevelSimulation.from_dir(level_dir)
+    sought = LevelSimulation.from_dir(level_dir)
+    for beat in range(1, 200):
+        stepped.step_beat()
+        sought.seek(beat)
+        assert snapshot(sought)[:3] == snapshot(stepped)[:3], "beat %d" % beat
+
+@pytest.mark.parametrize("level_dir", LEVELS)
+def test_play_on_after_seek(level_dir):
+    stepped = LevelSimulation.from_dir(level_dir)
+    sought = LevelSimulation.from_dir(level_dir)
+    for _ in range(300):
+        stepped.step_beat()
+    sought.seek(150)
+    for _ in range(150):
+        sought.step_beat()
+    assert snapshot(sought) == snapshot(stepped)
+
+
+@pytest.mark.parametrize("level_dir", LEVELS)
+def test_shortcuts_match_the_reference(level_dir):
+    fast = LevelSimulation.from_dir(level_dir)
+    reference = LevelSimulation.from_dir(level_dir, sleep = False, tables = False)
+    inputs = random_inputs(fast, 1000)
+    assert play(fast, inputs) == play(reference, inputs)
+
+
+def test_shortcuts_match_the_reference_with_groups_asleep():
+    fast = corridor_simulation()
+    reference = corridor_simulation(sleep = False, tables = False)
+    # mostly walk towards the exit, so the player goes past every group
+    rng = np.random.RandomState(1)
+    inputs = [((0, 1) if rng.rand() < .6 else MOVES[rng.randint(len(MOVES))],
+               [60, 64, None][rng.randint(3)]) for _ in range(2000)]
+
+    asleep = []
+    songs = {}
+    for movement, note in inputs:
+        if note is not None and note not in songs:
+            songs[note] = held_note(note)
+        get_music = lambda: songs.get(note)
+        assert fast.step_beat(movement, get_music) == reference.step_beat(movement, get_music)
+        assert (fast.player.position, fast.deaths) == (reference.player.position, reference.deaths)
+        asleep.append(len(fast.enemy_groups) - len(fast.awake_groups))
+    assert max(asleep) > 0 and reference.deaths > 0
+
+
+# a group shooting along a lane, and another group far down it. Pacified (as
+# they are with the player out of range), the second group's enemy stops the
+# shots before they reach the player.
+def test_groups_in_another_groups_lane_stay_awake():
+    rows = ["w" * 80] + ["w" + " " * 78 + "w" for _ in range(5)] + ["w" * 80]
+    rows[5] = rows[5][:69] + "p" + rows[5][70:]
+    simulations = []
+    for sleep in [True, False]:
+        map = MapState.from_rows(rows)
+        projectiles = ProjectileSystem()
+        groups = []
+        for id, (pos, attacks) in enumerate([((3, 2), ["r"]), ((3, 40), [""])]):
+            enemies = [{"id": 0, "init_pos": list(pos), "motions": [[0, 0]], "attacks": attacks,
+                        "p_attacks": attacks, "note": 60}]
+            groups.append(EnemyGroupState({"enemies": enemies, "melody": [60], "pacify": "all",
+                                           "center": list(pos), "sound_thresh": 3, "mel_thresh": 3},
+                                          map, projectiles))
+        simulations.append(LevelSimulation(map, groups, projectiles, sleep))
+
+    for movement in [(-1, 0), (-1, 0)] + [(0, 0)] * 100:
+        for sim in simulations:
+            sim.step_beat(movement)
+        assert simulations[0].player.position == simulations[1].player.position
+    assert simulations[0].player.position == (3, 69)
+    assert simulations[0].deaths == simulations[1].deaths == 0
+    assert simulations[0].awake_groups == simulations[0].enemy_groups
+
+# with every group awake, so what sleeping groups leave behind (far from the
+# player) doesn't count
+def test_danger_tables_match_the_map():
+    sim = corridor_simulation(2, sleep = False)
+    rows, cols = sim.map.map_size()
+    squares = [(r, c) for r in range(rows) for c in range(cols)]
+    rng = np.random.RandomState(2)
+    tabulated = 0
+    for beat in range(1000):
+        sim.step_beat((0, 1) if rng.rand() < .1 else (0, 0), lambda: held_note(60) if rng.rand() < .3 else None)
+        for square in squares:
+            danger = sim.danger.is_square_dangerous(sim.awake_groups, sim.beat - 1, square)
+            if danger is not None:
+                tabulated += 1
+                assert danger == sim.map.is_square_dangerous(square), (beat, square)
+    assert tabulated > 0
+
+def test_danger_preview_shows_the_next_beat():
+    sim = corridor_simulation(2, sleep = False)
+    rows, cols = sim.map.map_size()
+    previewed = 0
+    for beat in range(400):
+        preview = sim.danger_preview()
+        sim.step_beat()
+        if all(sim.danger.tables[eg].is_valid(sim.beat - 1) for eg in sim.awake_groups):
+            previewed += 1
+            assert preview.tolist() == [[sim.map.is_square_dangerous((r, c)) for c in range(cols)]
+                                        for r in range(rows)]
+    assert previewed > 0
+    assert not corridor_simulation(2, tables = False).danger_preview().any()
+
+
+def test_danger_tables_only_cover_the_groups_reach():
+    # the last group's attack cycles, of 17 and 19 beats, only repeat every 323
+    def simulation(sleep = True, tables = True):
+        map, groups, projectiles = corridor_level(3)
+        for enemy, attack, length in zip(groups[2].enemies, ["d", "u"], [17, 19]):
+            enemy.actions.attacks = [attack] + [""] * (length - 1)
+        return LevelSimulation(map, groups, projectiles, sleep, tables)
+
+    sim = simulation()
+    first = sim.danger.tables[sim.enemy_groups[0]]
+    assert first.origin == (0, 40) and first.masks[0].shape == (first.period, 7, 3)
+    assert first.reaches((3, 41)) and not first.reaches((3, 80))
+    assert not sim.danger.tables[sim.enemy_groups[2]].is_tabulated()
+
+    # that group's danger comes from the map instead
+    inputs = [((0, 1), None)] * 150 + [((0, 0), None)] * 400
+    assert play(sim, inputs) == play(simulation(sleep = False, tables = False), inputs)
+
+
+def test_groups_sleep_away_from_the_player():
+    sim = corridor_simulation()
+    for _ in range(30):
+        sim.step_beat((0, 1))
+    awake = set(sim.awake_groups)
+    assert sim.enemy_groups[0] in awake and sim.enemy_groups[-1] not in awake
+    assert all(eg.asleep for eg in sim.enemy_groups if eg not in awake)
+
+    # a group that wakes up catches up on the beats it slept through
+    awake_all = corridor_simulation(sleep = False)
+    for _ in range(30):
+        awake_all.step_beat((0, 1))
+    for _ in range(70):
+        sim.step_beat()
+        awake_all.step_beat()
+    far = sim.enemy_groups[-1]
+    far.wake(sim.beat)
+    reference = awake_all.enemy_groups[-1]
+    assert [e.pos for e in far.enemies] == [e.pos for e in reference.enemies]
+    assert far.melody_index == reference.melody_index
+
+
+def test_occupancy_grid():
+    grid = OccupancyGrid((4, 5), capacity = 2)
+    grid.add((1, 2), "a", True)
+    grid.add((1, 2), "b", False)
+    grid.add((3, 4), "c", True)
+    grid.add((-1, 2), "off the map", True)
+    grid.add_many(np.array([[1, 2], [0, 0], [0, 0], [7, 7]]))
+    assert list(grid.occupants((1, 2))) == ["b", "a"]
+    assert list(grid.occupants((0, 0))) == []
+    assert grid.count((1, 2)) == 3 and grid.count((0, 0)) == 2 and grid.count((2, 2)) == 0
+    assert grid.counts_at(np.array([[1, 2], [3, 4], [0, 1]])).tolist() == [3, 1, 0]
+    assert grid.entity_blocking[:grid.num_entities].tolist() == [True, False, True]
+
+    # clearing starts over without touching every cell
+    grid.clear()
+    assert grid.count((1, 2)) == 0 and list(grid.occupants((1, 2))) == []
+    grid.add((3, 4), "d", True)
+    assert list(grid.occupants((3, 4))) == ["d"] and grid.count((0, 0)) == 0
+
+
+@pytest.mark.parametrize("sung", [None, 60, 62, 64, 67])
+def test_note_judgement_matches_check_note(sung):
+    # groups right next to the player, with rests in their melodies. The last
+    # one is out of the player's melody threshold.
+    def groups():
+        map, groups, projectiles = corridor_level(4, spacing = 1)
+        for eg, melody in zip(groups, [[60, 0], [64, 62], [0, 67], [62, 60]]):
+            eg.melody = melody
+        return groups
+    music = held_note(sung) if sung is not None else None
+    one_by_one, at_once = groups(), groups()
+    for beat in range(8):
+        for is_last in [False, True]:
+            for eg in one_by_one:
+                eg.check_note(music, is_last)
+            NoteJudgement(music).judge(at_once, is_last)
+            for a, b in zip(one_by_one, at_once):
+                assert (a.melody_progress, a.pitch_matched, a.cur_pitch, a.check_count, a.checked_saturation) == \
+                    (b.melody_progress, b.pitch_matched, b.cur_pitch, b.check_count, b.checked_saturation)
+        for a, b in zip(one_by_one, at_once):
+            a.advance(a.map)
+            b.advance(b.map)